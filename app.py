@@ -22,6 +22,9 @@ DB_NAME = os.getenv("DB_NAME", "postgres")
 DB_USER = os.getenv("DB_USER", "postgres")
 DB_PASS = os.getenv("DB_PASS", "password")
 
+CACHE_TTL_SECONDS = 300   # อายุ cache ของผล query (ปุ่ม Refresh ล้างได้ทันที)
+PAGE_SIZE = 50            # จำนวนโครงการต่อหน้าใน sidebar
+
 # ================= DATABASE CONNECTION POOL =================
 
 @st.cache_resource
@@ -76,12 +79,44 @@ def query_db(query, params=None, fetch_df=False):
 
 # ================= DATA FETCHING FUNCTIONS =================
 
-def get_all_project_ids():
-    """ดึงรายชื่อ Project ID ทั้งหมด"""
-    query = "SELECT project_id, created_at FROM batch_data.batch_json ORDER BY created_at DESC"
-    df = query_db(query, fetch_df=True)
-    return df if df is not None else pd.DataFrame()
+def _like_escape(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def get_project_page(search="", match_mode="prefix", cursor=None, limit=PAGE_SIZE):
+    """ดึงรายชื่อ Project ทีละหน้าแบบ keyset pagination (created_at, project_id) ใหม่ไปเก่า
+    cursor คือ (created_at, project_id) ของแถวสุดท้ายในหน้าก่อน ดึงเกิน 1 แถวเพื่อรู้ว่ามีหน้าถัดไปไหม"""
+    conditions = []
+    params = []
+    if search:
+        # prefix ใช้ index varchar_pattern_ops, substring ใช้ trigram index (pg_trgm)
+        if match_mode == "prefix":
+            conditions.append("project_id LIKE %s")
+            params.append(f"{_like_escape(search)}%")
+        else:
+            conditions.append("project_id ILIKE %s")
+            params.append(f"%{_like_escape(search)}%")
+    if cursor:
+        conditions.append("(created_at, project_id) < (%s, %s)")
+        params.extend(cursor)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    query = f"""
+        SELECT project_id, created_at FROM batch_data.batch_json
+        {where}
+        ORDER BY created_at DESC, project_id DESC
+        LIMIT %s
+    """
+    df = query_db(query, params=params + [limit + 1], fetch_df=True)
+    return df if df is not None else pd.DataFrame(columns=["project_id", "created_at"])
 
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def get_approx_project_count():
+    """จำนวนโครงการโดยประมาณจากสถิติของ Postgres (count(*) ทั้งตารางช้าเมื่อข้อมูลเยอะ)"""
+    rows = query_db("SELECT reltuples::bigint FROM pg_class WHERE oid = 'batch_data.batch_json'::regclass")
+    return max(rows[0][0], 0) if rows else 0
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
 def get_project_data(project_id):
     """ดึง JSON ข้อมูลของ Project นั้นๆ"""
     query = "SELECT json, created_at FROM batch_data.batch_json WHERE project_id = %s"
@@ -91,6 +126,152 @@ def get_project_data(project_id):
         return rows[0]  # คืนค่า (json_data, created_at)
     return None
 
+# ================= SEARCH & ANALYTICS =================
+# ค้นหาอ่านจากตาราง document_requirements ที่ main.py เขียนพร้อม batch_json (ข้อมูลล่าสุดเสมอ)
+# สถิติอ่านจาก document_requirement_counts_mv ที่สรุปจากตารางเดียวกัน
+
+CATEGORY_LABELS = {
+    "legal_partnership": "🏢 ห้างหุ้นส่วน",
+    "legal_company": "🏢 บริษัท",
+    "individual": "👤 บุคคลธรรมดา",
+    "joint_venture": "🤝 กิจการร่วมค้า",
+    "financial": "💰 หลักฐานการเงิน",
+    "general": "📎 เอกสารอื่นๆ",
+}
+
+# หมวดของหน้าสถิติ -> (category, sub_case) ในตาราง document_requirements
+CATEGORY_KEYS = {
+    "legal_partnership": ("legal_entity", "partnership"),
+    "legal_company": ("legal_entity", "company"),
+    "individual": ("individual", None),
+    "joint_venture": ("joint_venture", None),
+    "financial": ("financial", None),
+    "general": ("general", None),
+}
+CATEGORY_NAMES = {(category, sub_case or ""): CATEGORY_LABELS[key] for key, (category, sub_case) in CATEGORY_KEYS.items()}
+
+def category_label(category, sub_case):
+    return CATEGORY_NAMES.get((category, sub_case or ""), category)
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def search_documents(text, category=None, limit=200):
+    """ค้นหาเอกสารที่มีคำว่า text ข้ามทุก project (trigram index บน document_requirements.document_text)"""
+    query = """
+        SELECT project_id, category, sub_case, condition, document_text AS document, amount_baht
+        FROM batch_data.document_requirements
+        WHERE document_text ILIKE %s
+    """
+    params = [f"%{_like_escape(text)}%"]
+    if category:
+        query += " AND category = %s AND coalesce(sub_case, '') = %s"
+        requirement_category, sub_case = CATEGORY_KEYS[category]
+        params += [requirement_category, sub_case or ""]
+    query += " ORDER BY project_id, category, ordinal LIMIT %s"
+    df = query_db(query, params=params + [limit], fetch_df=True)
+    if df is None:
+        return pd.DataFrame()
+    df["category"] = [category_label(c, s) for c, s in zip(df["category"], df["sub_case"])]
+    return df.drop(columns="sub_case")
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def search_financial_amount(min_amount, keyword="", limit=200):
+    """หลักฐานการเงินที่ระบุจำนวนเงินตั้งแต่ min_amount บาทขึ้นไป เช่นวงเงินสินเชื่อ"""
+    query = """
+        SELECT project_id, amount_baht, condition, document_text AS document
+        FROM batch_data.document_requirements
+        WHERE category = 'financial' AND amount_baht >= %s
+    """
+    params = [min_amount]
+    if keyword:
+        query += " AND document_text ILIKE %s"
+        params.append(f"%{_like_escape(keyword)}%")
+    query += " ORDER BY amount_baht DESC, project_id LIMIT %s"
+    df = query_db(query, params=params + [limit], fetch_df=True)
+    return df if df is not None else pd.DataFrame()
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def get_category_summary():
+    query = """
+        SELECT category, sub_case, count(*) AS document_types, sum(projects) AS mentions
+        FROM batch_data.document_requirement_counts_mv
+        GROUP BY category, sub_case
+        ORDER BY mentions DESC
+    """
+    df = query_db(query, fetch_df=True)
+    if df is None:
+        return pd.DataFrame()
+    df["category"] = [category_label(c, s) for c, s in zip(df["category"], df["sub_case"])]
+    return df.drop(columns="sub_case")
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def get_top_documents(category, limit=50):
+    query = """
+        SELECT condition, document_text AS document, projects
+        FROM batch_data.document_requirement_counts_mv
+        WHERE category = %s AND sub_case = %s
+        ORDER BY projects DESC
+        LIMIT %s
+    """
+    requirement_category, sub_case = CATEGORY_KEYS[category]
+    df = query_db(query, params=(requirement_category, sub_case or "", limit), fetch_df=True)
+    return df if df is not None else pd.DataFrame()
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def get_projects_requiring(category, document, limit=200):
+    """Project ที่ต้องใช้เอกสารนี้แบบตรงตัว อ่านจาก document_requirements (เขียนพร้อม batch_json) จึงเป็นข้อมูลล่าสุดเสมอ"""
+    requirement_category, sub_case = CATEGORY_KEYS[category]
+    query = """
+        SELECT b.project_id, b.created_at
+        FROM batch_data.batch_json b
+        WHERE EXISTS (
+            SELECT 1 FROM batch_data.document_requirements d
+            WHERE d.project_id = b.project_id
+              AND d.category = %s
+              AND coalesce(d.sub_case, '') = %s
+              AND md5(d.document_text) = md5(%s)
+        )
+        ORDER BY b.created_at DESC
+        LIMIT %s
+    """
+    df = query_db(query, params=(requirement_category, sub_case or "", document, limit), fetch_df=True)
+    return df if df is not None else pd.DataFrame()
+
+def render_analytics_view():
+    st.subheader("🔎 ค้นหาเอกสารข้ามโครงการ")
+    col_text, col_cat = st.columns([3, 1])
+    text = col_text.text_input("เอกสารที่มีคำว่า:", placeholder="เช่น สินเชื่อ, ร่วมค้า, บัตรประจำตัวประชาชน").strip()
+    category = col_cat.selectbox(
+        "หมวด", [None] + list(CATEGORY_LABELS),
+        format_func=lambda c: "ทุกหมวด" if c is None else CATEGORY_LABELS[c]
+    )
+    if text:
+        df = search_documents(text, category)
+        st.caption(f"พบ {len(df)} รายการ (แสดงสูงสุด 200)")
+        st.dataframe(df, use_container_width=True, hide_index=True)
+
+    st.subheader("💰 วงเงินตามหลักฐานการเงิน")
+    col_amount, col_keyword = st.columns([1, 2])
+    min_amount = col_amount.number_input("ตั้งแต่ (บาท)", min_value=0, value=1_000_000, step=100_000)
+    keyword = col_keyword.text_input("document มีคำว่า:", value="สินเชื่อ").strip()
+    st.dataframe(search_financial_amount(min_amount, keyword), use_container_width=True, hide_index=True)
+
+    st.subheader("📊 สถิติเอกสารที่ต้องใช้")
+    summary = get_category_summary()
+    if summary.empty:
+        st.caption("*(ยังไม่มีข้อมูลสถิติ — รันการบันทึกผลจาก main.py ก่อน)*")
+        return
+    st.bar_chart(summary, x="category", y="mentions")
+
+    top_category = st.selectbox("หมวดที่ต้องการดู", list(CATEGORY_LABELS), format_func=CATEGORY_LABELS.get)
+    top = get_top_documents(top_category)
+    st.dataframe(top, use_container_width=True, hide_index=True)
+
+    if not top.empty:
+        document = st.selectbox("ดูโครงการที่ต้องใช้เอกสาร:", top["document"].tolist())
+        projects = get_projects_requiring(top_category, document)
+        st.caption(f"{len(projects)} โครงการ (แสดงสูงสุด 200)")
+        st.dataframe(projects, use_container_width=True, hide_index=True)
+
 # ================= UI HELPER FUNCTIONS =================
 
 def display_document_list(title, docs_list, icon="📄"):
@@ -108,16 +289,39 @@ def main():
     st.title("📂 TOR Document Extraction Viewer")
     st.markdown("---")
 
+    view = st.sidebar.radio("มุมมอง", ["📄 รายโครงการ", "📊 ค้นหาเอกสาร & สถิติ"])
+    if view == "📊 ค้นหาเอกสาร & สถิติ":
+        if st.sidebar.button("🔄 Refresh Data"):
+            st.cache_data.clear()
+            st.rerun()
+        render_analytics_view()
+        return
+
     # --- SIDEBAR ---
     st.sidebar.header("🔍 เลือกโครงการ")
-    
-    # ดึงข้อมูลผ่าน Pool
-    df_projects = get_all_project_ids()
-    
+
+    search = st.sidebar.text_input("ค้นหา Project ID:").strip()
+    match_mode = st.sidebar.radio(
+        "รูปแบบการค้นหา",
+        ["prefix", "substring"],
+        format_func=lambda mode: "ขึ้นต้นด้วย" if mode == "prefix" else "มีคำว่า",
+        horizontal=True
+    )
+
+    # เก็บ cursor ของแต่ละหน้าไว้ใน session เพื่อย้อนกลับได้ (reset เมื่อเปลี่ยนคำค้น)
+    if st.session_state.get("page_query") != (search, match_mode):
+        st.session_state.page_query = (search, match_mode)
+        st.session_state.page_cursors = [None]
+    cursors = st.session_state.page_cursors
+
+    df_projects = get_project_page(search, match_mode, cursors[-1])
+    has_next = len(df_projects) > PAGE_SIZE
+    df_projects = df_projects.head(PAGE_SIZE)
+
     if df_projects.empty:
-        st.sidebar.warning("ไม่พบข้อมูลในฐานข้อมูล")
+        st.sidebar.warning("ไม่พบข้อมูลในฐานข้อมูล" if not search else "ไม่พบ Project ID ที่ค้นหา")
         st.stop()
-        
+
     project_options = df_projects['project_id'].tolist()
     
     selected_id = st.sidebar.selectbox(
@@ -125,9 +329,21 @@ def main():
         project_options,
         index=0
     )
+
+    col_prev, col_page, col_next = st.sidebar.columns([1, 1, 1])
+    if col_prev.button("◀", disabled=len(cursors) == 1):
+        cursors.pop()
+        st.rerun()
+    col_page.caption(f"หน้า {len(cursors)}")
+    if col_next.button("▶", disabled=not has_next):
+        last = df_projects.iloc[-1]
+        cursors.append((last['created_at'].to_pydatetime(), last['project_id']))
+        st.rerun()
+    st.sidebar.caption(f"ทั้งหมดประมาณ {get_approx_project_count():,} โครงการ")
     
     if st.sidebar.button("🔄 Refresh Data"):
         # Clear Cache เพื่อบังคับให้โหลดข้อมูลใหม่ (แต่ Pool ยังอยู่)
+        st.cache_data.clear()
         st.rerun()
 
     # --- MAIN CONTENT ---
@@ -0,0 +1,232 @@
+"""HTTP stub ของ OpenAI Files / Batches / Chat Completions สำหรับรัน pipeline แบบ offline
+
+รองรับเฉพาะ endpoint ที่ main.py ใช้:
+    POST /v1/files                    อัปโหลดไฟล์ JSONL (multipart)
+    GET  /v1/files/{id}/content       ดาวน์โหลด output / error file
+    POST /v1/batches                  สร้าง Batch
+    GET  /v1/batches/{id}             สถานะ Batch (validating -> in_progress -> finalizing -> completed ตามเวลา)
+    POST /v1/chat/completions         สำหรับโหมด Realtime
+
+ผลลัพธ์ถูกสร้างแบบ deterministic จากข้อความ section ตาม TARGET_JSON_SCHEMA
+
+ใช้งานแบบ standalone:
+    uv run python bench/fake_openai_server.py --port 8765 --batch-seconds 10
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=sk-fake uv run main.py
+"""
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ================= FAKE RESULT =================
+
+def fake_section_result(section_text):
+    """สร้างผลลัพธ์ตาม schema จากรายการ (๑) (๒) ... ในข้อความ section"""
+    items = [item.strip() for item in re.split(r"\([๐-๙0-9]+\)", section_text)[1:] if item.strip()]
+    financial = [item for item in items if "สินเชื่อ" in item or "งบแสดงฐานะการเงิน" in item]
+    joint_venture = [item for item in items if "ร่วมค้า" in item]
+    individual = [item for item in items if "บัตรประจำตัวประชาชน" in item]
+    company = [item for item in items if item not in financial + joint_venture + individual]
+    return {
+        "bid_submission_documents_part_1": {
+            "1_legal_entity_documents": {
+                "case_partnership": {"description": "ห้างหุ้นส่วนสามัญหรือห้างหุ้นส่วนจำกัด", "required_documents": company[:2]},
+                "case_company": {"description": "บริษัทจำกัดหรือบริษัทมหาชนจำกัด", "required_documents": company},
+            },
+            "2_individual_documents": {"description": "บุคคลธรรมดา", "required_documents": individual},
+            "3_joint_venture_documents": {"description": "ผู้ร่วมค้า", "required_documents": joint_venture},
+            "4_financial_capability_evidence": {
+                "description": "หลักฐานการเงิน",
+                "options": [{"condition": "กรณีทั่วไป", "document": item} for item in financial],
+                "note": None,
+            },
+            "5_general_documents": {"description": "เอกสารอื่นๆ", "required_documents": []},
+        }
+    }
+
+def make_fake_completion(body):
+    """สร้าง response ของ chat.completions จาก request body"""
+    user_content = body["messages"][-1]["content"]
+    content = json.dumps(fake_section_result(user_content), ensure_ascii=False)
+    digest = hashlib.sha256(user_content.encode("utf-8")).hexdigest()[:24]
+    prompt_tokens = sum(len(m["content"]) for m in body["messages"]) // 2
+    completion_tokens = len(content) // 2
+    return {
+        "id": f"chatcmpl-{digest}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+# ================= SERVER STATE =================
+
+class FakeOpenAIState:
+    def __init__(self, batch_seconds=5.0):
+        self.batch_seconds = batch_seconds
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def add_file(self, data, filename, purpose):
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        with self.lock:
+            self.files[file_id] = data
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(data),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+
+    def create_batch(self, params):
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        with self.lock:
+            lines = [line for line in self.files[params["input_file_id"]].splitlines() if line.strip()]
+            self.batches[batch_id] = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": params["endpoint"],
+                "input_file_id": params["input_file_id"],
+                "completion_window": params["completion_window"],
+                "status": "validating",
+                "created_at": int(time.time()),
+                "output_file_id": None,
+                "error_file_id": None,
+                "errors": None,
+                "request_counts": {"total": len(lines), "completed": 0, "failed": 0},
+                "_started": time.monotonic(),
+            }
+        return self.get_batch(batch_id)
+
+    def get_batch(self, batch_id):
+        with self.lock:
+            batch = self.batches[batch_id]
+            progress = (time.monotonic() - batch["_started"]) / max(self.batch_seconds, 1e-9)
+            total = batch["request_counts"]["total"]
+            if batch["status"] != "completed":
+                if progress < 0.1:
+                    batch["status"] = "validating"
+                elif progress < 0.9:
+                    batch["status"] = "in_progress"
+                    batch["request_counts"]["completed"] = int(total * progress)
+                elif progress < 1:
+                    batch["status"] = "finalizing"
+                    batch["request_counts"]["completed"] = total
+                else:
+                    batch["status"] = "completed"
+                    batch["request_counts"]["completed"] = total
+                    batch["output_file_id"] = self._build_output(batch)
+            return {k: v for k, v in batch.items() if not k.startswith("_")}
+
+    def _build_output(self, batch):
+        out = []
+        for line in self.files[batch["input_file_id"]].splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            out.append(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex[:24]}",
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": make_fake_completion(request["body"])},
+                "error": None,
+            }, ensure_ascii=False))
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        self.files[file_id] = ("\n".join(out) + "\n").encode("utf-8")
+        return file_id
+
+# ================= HTTP HANDLER =================
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, payload, status=200):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _read_body(self):
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def do_GET(self):
+            match = re.fullmatch(r"/v1/batches/([\w-]+)", self.path)
+            if match and match.group(1) in state.batches:
+                return self._send_json(state.get_batch(match.group(1)))
+
+            match = re.fullmatch(r"/v1/files/([\w-]+)/content", self.path)
+            if match and match.group(1) in state.files:
+                data = state.files[match.group(1)]
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+
+            self._send_json({"error": {"message": "not found", "type": "invalid_request_error"}}, 404)
+
+        def do_POST(self):
+            body = self._read_body()
+            if self.path == "/v1/files":
+                raw = b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + body
+                message = BytesParser(policy=policy.HTTP).parsebytes(raw)
+                fields = {}
+                for part in message.iter_parts():
+                    name = part.get_param("name", header="content-disposition")
+                    fields[name] = (part.get_filename(), part.get_payload(decode=True))
+                filename, data = fields["file"]
+                purpose = fields.get("purpose", (None, b"batch"))[1].decode()
+                return self._send_json(state.add_file(data, filename, purpose))
+
+            if self.path == "/v1/batches":
+                return self._send_json(state.create_batch(json.loads(body)))
+
+            if self.path == "/v1/chat/completions":
+                return self._send_json(make_fake_completion(json.loads(body)))
+
+            self._send_json({"error": {"message": "not found", "type": "invalid_request_error"}}, 404)
+
+    return Handler
+
+def start_server(port=0, batch_seconds=5.0):
+    """เริ่ม server ใน background thread คืนค่า (server, base_url)"""
+    state = FakeOpenAIState(batch_seconds)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI Files/Batches API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--batch-seconds", type=float, default=10.0)
+    args = parser.parse_args()
+    server, base_url = start_server(args.port, args.batch_seconds)
+    print(f"🧪 Fake OpenAI API: {base_url} (Batch เสร็จใน {args.batch_seconds} วินาที)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
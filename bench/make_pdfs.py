@@ -0,0 +1,202 @@
+"""สร้าง PDF TOR ภาษาไทยแบบสังเคราะห์สำหรับ benchmark (ไม่ต้องติดตั้ง library เพิ่ม)
+
+PDF ที่สร้างใช้ฟอนต์ Type0 / Identity-H ที่ไม่ได้ฝังฟอนต์จริง โดยให้ CID = Unicode code point
+และแนบ ToUnicode CMap ไว้ ทำให้ pdfplumber / pdfminer / pypdfium2 ดึงข้อความไทยออกมาได้ถูกต้อง
+(เปิดดูด้วย viewer อาจแสดงผลไม่สวย แต่ไม่จำเป็นสำหรับการวัดความเร็ว)
+
+ใช้งาน:
+    uv run python bench/make_pdfs.py --out bench_pdfs --files 200
+"""
+import argparse
+import json
+import os
+import random
+
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+FONT_SIZE = 12
+LINE_HEIGHT = 18
+TOP_MARGIN = 60
+LINES_PER_PAGE = (PAGE_HEIGHT - 2 * TOP_MARGIN) // LINE_HEIGHT
+
+THAI_DIGITS = str.maketrans("0123456789", "๐๑๒๓๔๕๖๗๘๙")
+
+FILLER_LINES = [
+    "ผู้ยื่นข้อเสนอต้องปฏิบัติตามเงื่อนไขที่กำหนดไว้ในเอกสารประกวดราคาอิเล็กทรอนิกส์ฉบับนี้",
+    "หน่วยงานของรัฐสงวนสิทธิ์ที่จะไม่พิจารณาข้อเสนอที่ไม่ถูกต้องตามเงื่อนไข",
+    "ราคาที่เสนอจะต้องเป็นราคาที่รวมภาษีมูลค่าเพิ่ม และภาษีอื่นๆ ทั้งปวงไว้แล้ว",
+    "ผู้ยื่นข้อเสนอจะต้องกำหนดยืนราคาไม่น้อยกว่า ๙๐ วัน นับแต่วันเสนอราคา",
+    "การพิจารณาผลการยื่นข้อเสนอจะใช้หลักเกณฑ์ราคาประกอบเกณฑ์อื่น",
+    "ผู้ชนะการประกวดราคาจะต้องทำสัญญาจ้างภายใน ๗ วัน นับถัดจากวันที่ได้รับแจ้ง",
+]
+
+SECTION_ITEMS = [
+    "สำเนาหนังสือรับรองการจดทะเบียนนิติบุคคล",
+    "บัญชีรายชื่อหุ้นส่วนผู้จัดการ ผู้มีอำนาจควบคุม (ถ้ามี)",
+    "สำเนาหนังสือบริคณห์สนธิ บัญชีรายชื่อกรรมการผู้จัดการ",
+    "บัญชีผู้ถือหุ้นรายใหญ่ (ถ้ามี) พร้อมรับรองสำเนาถูกต้อง",
+    "สำเนาบัตรประจำตัวประชาชนของผู้นั้น",
+    "สำเนาสัญญาของการเข้าร่วมค้า",
+    "หนังสือรับรองวงเงินสินเชื่อจากธนาคารภายในประเทศ ไม่น้อยกว่า ๑,๐๐๐,๐๐๐ บาท",
+    "สำเนางบแสดงฐานะการเงินที่มีการตรวจรับรองแล้ว",
+    "บัญชีเอกสารส่วนที่ ๑ ทั้งหมดที่ได้ยื่นพร้อมกับการเสนอราคาทางระบบ",
+]
+
+END_MARKERS = {
+    "thai_sub": "๓.๒ ส่วนที่ ๒ อย่างน้อยต้องมีเอกสารดังต่อไปนี้",
+    "arabic_sub": "3.2 ส่วนที่ ๒ อย่างน้อยต้องมีเอกสารดังต่อไปนี้",
+    "part2": "ส่วนที่ ๒ เอกสารทางเทคนิค",
+}
+
+# ================= PDF WRITER =================
+
+TO_UNICODE_CMAP = b"""/CIDInit /ProcSet findresource begin
+12 dict begin
+begincmap
+/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def
+/CMapName /Adobe-Identity-UCS def
+/CMapType 2 def
+1 begincodespacerange
+<0000> <FFFF>
+endcodespacerange
+2 beginbfrange
+<0020> <007E> <0020>
+<0E00> <0E7F> <0E00>
+endbfrange
+endcmap
+CMapName currentdict /CMap defineresource pop
+end
+end
+"""
+
+def _hex_text(text):
+    return "<" + "".join(f"{ord(ch):04X}" for ch in text if ch == " " or 0x20 < ord(ch) < 0x7F or 0x0E00 <= ord(ch) <= 0x0E7F) + ">"
+
+def _stream(data):
+    return b"<< /Length %d >>\nstream\n" % len(data) + data + b"\nendstream"
+
+def write_pdf(path, pages):
+    """เขียน PDF โดย pages เป็น list ของ list บรรทัดข้อความ"""
+    objects = {}
+    objects[3] = b"<< /Type /Font /Subtype /Type0 /BaseFont /BenchThai /Encoding /Identity-H /DescendantFonts [4 0 R] /ToUnicode 6 0 R >>"
+    objects[4] = (
+        b"<< /Type /Font /Subtype /CIDFontType2 /BaseFont /BenchThai "
+        b"/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> "
+        b"/FontDescriptor 5 0 R /DW 500 /CIDToGIDMap /Identity >>"
+    )
+    objects[5] = (
+        b"<< /Type /FontDescriptor /FontName /BenchThai /Flags 32 /FontBBox [0 -250 1000 900] "
+        b"/ItalicAngle 0 /Ascent 900 /Descent -250 /CapHeight 700 /StemV 80 >>"
+    )
+    objects[6] = _stream(TO_UNICODE_CMAP)
+
+    kids = []
+    next_id = 7
+    for lines in pages:
+        page_id, content_id = next_id, next_id + 1
+        next_id += 2
+        kids.append(page_id)
+
+        content = ["BT", f"/F1 {FONT_SIZE} Tf"]
+        y = PAGE_HEIGHT - TOP_MARGIN
+        for line in lines:
+            content.append(f"1 0 0 1 50 {y} Tm {_hex_text(line)} Tj")
+            y -= LINE_HEIGHT
+        content.append("ET")
+        objects[content_id] = _stream("\n".join(content).encode("ascii"))
+        objects[page_id] = (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>"
+        ).encode("ascii")
+
+    objects[1] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[2] = f"<< /Type /Pages /Kids [{' '.join(f'{k} 0 R' for k in kids)}] /Count {len(kids)} >>".encode("ascii")
+
+    out = bytearray(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+    offsets = {}
+    for obj_id in sorted(objects):
+        offsets[obj_id] = len(out)
+        out += b"%d 0 obj\n" % obj_id + objects[obj_id] + b"\nendobj\n"
+
+    xref_offset = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (next_id)
+    for obj_id in range(1, next_id):
+        out += b"%010d 00000 n \n" % offsets[obj_id]
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (next_id, xref_offset)
+
+    with open(path, "wb") as f:
+        f.write(out)
+
+# ================= CORPUS =================
+
+def build_tor_lines(rng, page_count, section_page, numeral, end_marker, cross_page):
+    """สร้างบรรทัดข้อความของ TOR ทั้งฉบับ คืนค่า (pages, section_body)"""
+    heading_number = "๓" if numeral == "thai" else "3"
+    section = [f"{heading_number}. หลักฐานการยื่นข้อเสนอ"]
+    section.append("ผู้ยื่นข้อเสนอจะต้องเสนอเอกสารหลักฐานยื่นมาพร้อมกับการเสนอราคาทางระบบ โดยแยกเป็น ๒ ส่วน คือ")
+    section.append("๓.๑ ส่วนที่ ๑ อย่างน้อยต้องมีเอกสารดังต่อไปนี้")
+    items = rng.sample(SECTION_ITEMS, rng.randint(4, len(SECTION_ITEMS)))
+    for i, item in enumerate(items, 1):
+        number = str(i).translate(THAI_DIGITS) if numeral == "thai" else str(i)
+        section.append(f"({number}) {item}")
+    body = section[1:]
+
+    pages = []
+    for page_no in range(1, page_count + 1):
+        lines = [f"หน้า {str(page_no).translate(THAI_DIGITS)}"]
+        if page_no == section_page:
+            # cross_page = เริ่ม section ใกล้ท้ายหน้า ให้เนื้อหาล้นไปหน้าถัดไป
+            filler_count = LINES_PER_PAGE - 4 if cross_page else rng.randint(2, 8)
+            lines += [rng.choice(FILLER_LINES) for _ in range(filler_count)]
+            overflow = section + [END_MARKERS[end_marker]]
+            room = LINES_PER_PAGE - len(lines)
+            lines += overflow[:room]
+            pages.append(lines)
+            pending = overflow[room:]
+            continue
+        if pages and page_no == section_page + 1 and pending:
+            lines += pending
+        lines += [rng.choice(FILLER_LINES) for _ in range(LINES_PER_PAGE - len(lines))]
+        pages.append(lines)
+    return pages, body
+
+def generate_corpus(out_dir, files, seed=42, page_counts=(5, 20, 40, 80)):
+    """สร้าง PDF สังเคราะห์หลายแบบ (จำนวนหน้า, ตำแหน่ง section, เลขไทย/อารบิก, end marker)
+    คืนค่า list ของ dict อธิบายแต่ละไฟล์ และเขียน corpus.json ไว้ในโฟลเดอร์เดียวกัน"""
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    corpus = []
+    for i in range(files):
+        page_count = page_counts[i % len(page_counts)]
+        position = ("early", "middle", "late")[(i // len(page_counts)) % 3]
+        section_page = {"early": min(2, page_count), "middle": max(1, page_count // 2), "late": page_count - 1}[position]
+        numeral = "thai" if i % 5 else "arabic"
+        end_marker = list(END_MARKERS)[i % len(END_MARKERS)]
+        cross_page = i % 4 == 0 and section_page < page_count
+
+        pages, body = build_tor_lines(rng, page_count, max(1, section_page), numeral, end_marker, cross_page)
+        filename = f"bench-{i:05d}.pdf"
+        write_pdf(os.path.join(out_dir, filename), pages)
+        corpus.append({
+            "filename": filename,
+            "page_count": page_count,
+            "section_page": max(1, section_page),
+            "position": position,
+            "numeral": numeral,
+            "end_marker": end_marker,
+            "cross_page": cross_page,
+            "expected_text": " ".join(body),
+        })
+
+    with open(os.path.join(out_dir, "corpus.json"), "w", encoding="utf-8") as f:
+        json.dump(corpus, f, ensure_ascii=False, indent=2)
+    return corpus
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic Thai TOR PDFs")
+    parser.add_argument("--out", default="bench_pdfs")
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    generate_corpus(args.out, args.files, args.seed)
+    print(f"✅ สร้าง PDF {args.files} ไฟล์ที่ {args.out}")
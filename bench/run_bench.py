@@ -0,0 +1,285 @@
+"""Benchmark ของ pipeline: สกัดข้อความ, สร้าง JSONL, บันทึกผลลง Postgres และ Auto Pilot แบบ offline
+
+ขั้นตอนที่ใช้ Postgres จะรันเฉพาะเมื่อระบุ --db-name และจะ "ลบ schema batch_data ทั้งหมด" ในฐานข้อมูลนั้น
+ดังนั้นให้ใช้ฐานข้อมูลสำหรับทดสอบเท่านั้น
+
+ใช้งาน:
+    uv run python bench/run_bench.py --files 200
+    uv run python bench/run_bench.py --files 200 --db-name tor_bench
+    uv run python bench/run_bench.py --files 200 --compare bench/results/<ไฟล์ก่อนหน้า>.json
+
+ผลลัพธ์ถูกเขียนเป็น JSON ที่ bench/results/bench-<commit>-<timestamp>.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.make_pdfs import generate_corpus
+from bench.fake_openai_server import fake_section_result, start_server
+
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+PAGE_HEADER_RE = re.compile(r"หน้า\s*[๐-๙0-9]+")
+
+def _normalize(text):
+    return re.sub(r"\s+", "", PAGE_HEADER_RE.sub("", text or ""))
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+# ================= STAGES =================
+
+def summarize_extraction(corpus, outcomes, elapsed):
+    """outcomes เป็น dict {filename: (text, stats, seconds)}"""
+    by_variant = {}
+    correct = 0
+    for entry in corpus:
+        text, _, _ = outcomes[entry["filename"]]
+        variant = f"{entry['numeral']}/{entry['end_marker']}/{'cross' if entry['cross_page'] else 'single'}"
+        matched, total = by_variant.get(variant, (0, 0))
+        by_variant[variant] = (matched + bool(text), total + 1)
+        if text and _normalize(text) == _normalize(entry["expected_text"]):
+            correct += 1
+
+    pages_parsed = sum(stats.get("pages_parsed", 0) for _, stats, _ in outcomes.values())
+    page_count = sum(entry["page_count"] for entry in corpus)
+    slowest = sorted(outcomes.items(), key=lambda item: item[1][2], reverse=True)[:5]
+    return {
+        "files": len(corpus),
+        "seconds": round(elapsed, 3),
+        "files_per_sec": round(len(corpus) / elapsed, 2) if elapsed else None,
+        "pages_parsed": pages_parsed,
+        "page_count": page_count,
+        "matched": sum(1 for text, _, _ in outcomes.values() if text),
+        "correct": correct,
+        "match_rate_by_variant": {k: round(m / t, 3) for k, (m, t) in sorted(by_variant.items())},
+        "slowest_files": [{"file": f, "seconds": round(sec, 3)} for f, (_, _, sec) in slowest],
+    }
+
+def bench_extract_thread(pipeline, corpus):
+    async def run():
+        sem = asyncio.Semaphore(pipeline.CONCURRENT_LIMIT)
+
+        async def one(entry):
+            async with sem:
+                stats = {}
+                path = os.path.join(pipeline.INPUT_FOLDER, entry["filename"])
+                start = time.perf_counter()
+                text = await asyncio.to_thread(pipeline.extract_evidence_section, path, stats=stats)
+                return entry["filename"], (text, stats, time.perf_counter() - start)
+
+        return dict(await asyncio.gather(*(one(entry) for entry in corpus)))
+
+    start = time.perf_counter()
+    outcomes = asyncio.run(run())
+    return summarize_extraction(corpus, outcomes, time.perf_counter() - start)
+
+def bench_extract_process(pipeline, corpus):
+    start = time.perf_counter()
+    extracted = asyncio.run(pipeline.extract_with_process_pool([entry["filename"] for entry in corpus]))
+    elapsed = time.perf_counter() - start
+    # process pool ไม่ได้วัดเวลารายไฟล์ ใช้ค่าเฉลี่ยแทน
+    per_file = elapsed / max(len(corpus), 1)
+    outcomes = {f: (text, stats, per_file) for f, (text, _, stats) in extracted.items()}
+    result = summarize_extraction(corpus, outcomes, elapsed)
+    result["workers"] = pipeline.PROCESS_WORKERS
+    del result["slowest_files"]
+    return result
+
+def bench_jsonl_build(pipeline, corpus, work_dir):
+    texts = {}
+    for entry in corpus:
+        text = pipeline.extract_evidence_section(os.path.join(pipeline.INPUT_FOLDER, entry["filename"]))
+        if text:
+            texts[entry["filename"]] = text
+
+    start = time.perf_counter()
+    tasks = []
+    for filename, text in texts.items():
+        tasks.extend(pipeline.prepare_requests(filename, text))
+    shard_paths = pipeline.write_batch_shards(tasks)
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": len(tasks),
+        "shards": len(shard_paths),
+        "bytes": sum(os.path.getsize(p) for p in shard_paths),
+        "seconds": round(elapsed, 4),
+        "requests_per_sec": round(len(tasks) / elapsed, 1) if elapsed else None,
+    }
+
+def reset_database(pipeline):
+    conn = pipeline.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DROP SCHEMA IF EXISTS batch_data CASCADE;")
+        conn.commit()
+    finally:
+        conn.close()
+    pipeline.init_db()
+
+def count_saved(pipeline):
+    conn = pipeline.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM batch_data.batch_json")
+            return cur.fetchone()[0]
+    finally:
+        conn.close()
+
+def bench_ingest(pipeline, rows_count):
+    reset_database(pipeline)
+    sample = fake_section_result("(๑) สำเนาหนังสือรับรองการจดทะเบียนนิติบุคคล (๒) หนังสือรับรองวงเงินสินเชื่อ (๓) สำเนาสัญญาของการเข้าร่วมค้า")
+    rows = [{"id": f"bench-ingest-{i:07d}", "data": sample} for i in range(rows_count)]
+
+    async def ingest():
+        # บันทึกทุก chunk พร้อมกันผ่าน pool (จำกัดที่ DB_POOL_SIZE connection)
+        chunks = [rows[i:i + pipeline.INGEST_CHUNK_SIZE] for i in range(0, len(rows), pipeline.INGEST_CHUNK_SIZE)]
+        return sum(await asyncio.gather(*(pipeline.asave_results_to_db(chunk) for chunk in chunks)))
+
+    start = time.perf_counter()
+    saved = pipeline.run_async(ingest())
+    elapsed = time.perf_counter() - start
+    return {
+        "rows": rows_count,
+        "saved": saved,
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(rows_count / elapsed, 1) if elapsed else None,
+    }
+
+def bench_create_batch(pipeline):
+    reset_database(pipeline)
+    start = time.perf_counter()
+    shard_paths = pipeline.run_async(pipeline.create_batch_file_async()) or []
+    return {"shards": len(shard_paths), "seconds": round(time.perf_counter() - start, 3)}
+
+def bench_auto_pilot(pipeline):
+    reset_database(pipeline)
+    if os.path.exists(pipeline.BATCH_MANIFEST):
+        os.remove(pipeline.BATCH_MANIFEST)
+    start = time.perf_counter()
+    pipeline.run_async(pipeline.run_auto_pilot())
+    return {"saved": count_saved(pipeline), "seconds": round(time.perf_counter() - start, 3)}
+
+# ================= COMPARE =================
+
+def compare_results(old, new):
+    print("\n--- 📊 เทียบกับผลก่อนหน้า ---")
+    print(f"   {old.get('commit')} -> {new.get('commit')}")
+    for stage, metrics in new["stages"].items():
+        old_metrics = old.get("stages", {}).get(stage)
+        if not old_metrics or "seconds" not in metrics or not old_metrics.get("seconds"):
+            continue
+        ratio = metrics["seconds"] / old_metrics["seconds"]
+        flag = "🔴" if ratio > 1.1 else ("🟢" if ratio < 0.9 else "⚪")
+        print(f"   {flag} {stage:<18} {old_metrics['seconds']:>9.3f}s -> {metrics['seconds']:>9.3f}s (x{ratio:.2f})")
+
+# ================= MAIN =================
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the TOR extraction pipeline")
+    parser.add_argument("--files", type=int, default=100, help="จำนวน PDF สังเคราะห์")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--db-name", help="ฐานข้อมูลสำหรับทดสอบ (schema batch_data จะถูกลบ!) ถ้าไม่ระบุจะข้ามขั้นตอนที่ใช้ DB")
+    parser.add_argument("--ingest-rows", type=int, default=20000)
+    parser.add_argument("--batch-seconds", type=float, default=3.0, help="เวลาที่ fake Batch ใช้จนเสร็จ")
+    parser.add_argument("--backend", choices=("http", "fake"), default="http",
+                        help="http = OpenAI SDK คุยกับ fake_openai_server, fake = FakeBatchBackend ใน process (เร็วกว่า เหมาะกับไฟล์จำนวนมาก)")
+    parser.add_argument("--text-backend", choices=("pdfium", "pdfminer", "pdfplumber"), default="pdfium")
+    parser.add_argument("--skip-process", action="store_true", help="ไม่วัดโหมด Process Pool")
+    parser.add_argument("--output", help="path ของไฟล์ผลลัพธ์ JSON")
+    parser.add_argument("--compare", help="ไฟล์ผลลัพธ์ JSON เดิมที่ต้องการเทียบ")
+    parser.add_argument("--keep", action="store_true", help="ไม่ลบโฟลเดอร์ทำงานชั่วคราว")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="tor-bench-")
+    pdf_dir = os.path.join(work_dir, "input_pdfs")
+    print(f"🧪 สร้าง PDF สังเคราะห์ {args.files} ไฟล์ที่ {pdf_dir}...")
+    corpus = generate_corpus(os.path.join(work_dir, "input_pdfs"), args.files, args.seed)
+
+    server = None
+    # ต้องตั้งค่า env ก่อน import main (config ถูกอ่านตอน import และ worker process อ่านค่าจาก env)
+    if args.backend == "http":
+        server, base_url = start_server(0, args.batch_seconds)
+        os.environ["OPENAI_API_KEY"] = "sk-bench"
+        os.environ["OPENAI_BASE_URL"] = base_url
+    else:
+        os.environ["LLM_BACKEND"] = "fake"
+        os.environ["FAKE_BACKEND_DIR"] = os.path.join(work_dir, "fake_backend")
+        os.environ["FAKE_BATCH_SECONDS"] = str(args.batch_seconds)
+    os.environ["EXTRACT_CACHE_ENABLED"] = "0"
+    os.environ["TEXT_BACKEND"] = args.text_backend
+    os.environ["EXTRACT_CACHE_DIR"] = os.path.join(work_dir, "extract_cache")
+    if args.db_name:
+        os.environ["DB_NAME"] = args.db_name
+    import main as pipeline
+
+    pipeline.INPUT_FOLDER = pdf_dir
+    pipeline.BATCH_FILE_NAME = os.path.join(work_dir, "batch_input_pg.jsonl")
+    pipeline.BATCH_MANIFEST = os.path.join(work_dir, "batch_manifest.json")
+    pipeline.BATCH_ID_LOG = os.path.join(work_dir, "current_batch_id.txt")
+    pipeline.REALTIME_PRIORITY_FILE = os.path.join(work_dir, "priority.txt")
+    pipeline.POLL_MIN_INTERVAL = 0.5
+    pipeline.POLL_FINALIZING_INTERVAL = 0.2
+    pipeline.INTERVAL_TIME = 2
+
+    results = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "params": {"files": args.files, "seed": args.seed, "ingest_rows": args.ingest_rows,
+                   "batch_seconds": args.batch_seconds, "backend": args.backend, "text_backend": args.text_backend, "db": bool(args.db_name)},
+        "stages": {},
+    }
+    stages = results["stages"]
+
+    try:
+        print("⏱️  extract (thread)...")
+        stages["extract_thread"] = bench_extract_thread(pipeline, corpus)
+        if not args.skip_process:
+            print("⏱️  extract (process)...")
+            stages["extract_process"] = bench_extract_process(pipeline, corpus)
+        print("⏱️  jsonl build...")
+        stages["jsonl_build"] = bench_jsonl_build(pipeline, corpus, work_dir)
+
+        if args.db_name:
+            print("⏱️  ingest (COPY + upsert)...")
+            stages["ingest"] = bench_ingest(pipeline, args.ingest_rows)
+            print("⏱️  create_batch_file_async...")
+            stages["create_batch"] = bench_create_batch(pipeline)
+            print("⏱️  auto pilot (offline)...")
+            stages["auto_pilot"] = bench_auto_pilot(pipeline)
+    finally:
+        if server:
+            server.shutdown()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"bench-{results['commit']}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    print("\n--- ✅ ผล Benchmark ---")
+    print(json.dumps(stages, ensure_ascii=False, indent=2))
+    print(f"💾 บันทึกผลที่ {output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare_results(json.load(f), results)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,41 @@
 import os
+import sys
 import json
+import io
 import re
+import hashlib
+import shutil
 import asyncio
 import time
+import random
+import functools
+import types
+import heapq
+import threading
+import contextlib
+from datetime import datetime, timezone
+import signal
+import socket
+import concurrent.futures
+import multiprocessing
+import atexit
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import pdfplumber
+import pypdfium2 as pdfium
+from pdfminer.converter import TextConverter
+from pdfminer.layout import LAParams
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdftypes import resolve1
 import psycopg2
-from psycopg2.extras import Json
-from openai import OpenAI
+import psycopg
+import openai
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
+import tiktoken
 
 # โหลดตัวแปรสภาพแวดล้อม
 load_dotenv()
@@ -16,23 +44,112 @@ load_dotenv()
 API_KEY = os.getenv("OPENAI_API_KEY")
 INPUT_FOLDER = "input_pdfs"
 BATCH_FILE_NAME = "batch_input_pg.jsonl"
-BATCH_ID_LOG = "current_batch_id.txt"
-INTERVAL_TIME = 120 # 2 นาที
+BATCH_ID_LOG = "current_batch_id.txt"  # (legacy) ใช้อ่าน Batch ID เดียวจากเวอร์ชันก่อน
+BATCH_MANIFEST = "batch_manifest.json"  # รายการ Batch ทุก shard ที่ส่งไปแล้ว
+BATCH_MAX_REQUESTS = 50000              # จำนวน request สูงสุดต่อ 1 shard (ข้อจำกัดของ Batch API)
+BATCH_MAX_BYTES = 190 * 1024 * 1024     # ขนาดไฟล์สูงสุดต่อ 1 shard (Batch API จำกัด 200 MB)
+INGEST_CHUNK_SIZE = 1000                # จำนวนผลลัพธ์ที่บันทึก (COPY + commit) ต่อ 1 รอบ
+STUCK_AFTER_HOURS = 26                  # ไฟล์ที่ไม่ขยับสถานะนานกว่านี้ถือว่าค้าง (Batch window 24h + เผื่อ)
+INTERVAL_TIME = 120 # 2 นาที (ระยะห่างสูงสุดระหว่างการเช็คสถานะ Batch)
+POLL_MIN_INTERVAL = 15        # วินาที: ช่วง validating / เริ่ม in_progress
+POLL_FINALIZING_INTERVAL = 5  # วินาที: ช่วง finalizing (ใกล้เสร็จแล้ว เช็คถี่ๆ)
+POLL_BACKOFF = 1.5            # ตัวคูณเพิ่มระยะห่างระหว่าง in_progress
 # Database Config
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_NAME = os.getenv("DB_NAME", "postgres")
 DB_USER = os.getenv("DB_USER", "postgres")
 DB_PASS = os.getenv("DB_PASS", "password")
+# Async Connection Pool (psycopg 3) สำหรับ hot path: กรองไฟล์ใหม่, อัปเดต file_state, บันทึกผลลัพธ์
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))           # จำนวน connection สูงสุด (= จำนวน Batch ที่บันทึกพร้อมกันได้)
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # วินาทีสูงสุดที่รอ connection ว่าง
+DB_PREPARE = os.getenv("DB_PREPARE", "1") == "1"              # prepared statements (ปิดเมื่อต่อผ่าน pgbouncer แบบ transaction pooling)
+ANALYTICS_REFRESH_SECONDS = int(os.getenv("ANALYTICS_REFRESH_SECONDS", "900"))  # refresh สถิติเอกสารห่างกันอย่างน้อยกี่วินาที (daemon / coordinator)
 
 # System Options
 SKIP_EXISTING = True       # True = ถ้ามีใน DB แล้วจะไม่ส่งไป AI ใหม่
+REPROCESS_IF_NEWER = False # True = ประมวลผลใหม่ถ้าไฟล์ PDF ถูกแก้ไขหลัง created_at ใน DB
 MODEL_NAME = "gpt-4o-mini" 
 CONCURRENT_LIMIT = 20      # จำนวนไฟล์ที่ประมวลผลพร้อมกัน
 
-if not API_KEY:
-    raise ValueError("❌ Error: OPENAI_API_KEY not found in .env file")
+# Extraction Engine
+# "thread"  = ใช้ asyncio.to_thread (เหมาะกับไฟล์น้อย แต่ติด GIL)
+# "process" = ใช้ Process Pool กระจายงานไปทุก core
+EXTRACT_MODE = os.getenv("EXTRACT_MODE", "thread")
+PROCESS_WORKERS = int(os.getenv("PROCESS_WORKERS", "0")) or max(1, (os.cpu_count() or 2) - 1)
+PROCESS_CHUNK_SIZE = 8        # จำนวนไฟล์ที่ส่งให้ worker ต่อ 1 งาน
+FILES_PER_WORKER = 200        # recycle worker หลังประมวลผลครบ N ไฟล์ (กัน memory บวม)
+EXTRACT_TIMEOUT = 120         # วินาทีสูงสุดต่อ 1 ไฟล์ (กัน PDF เสียที่ทำให้ค้าง)
 
-client = OpenAI(api_key=API_KEY)
+# Text Backend (ใช้ดึงข้อความดิบให้ regex)
+# "pdfium"     = pypdfium2 เร็วที่สุด (default)
+# "pdfminer"   = pdfminer plain text (ไม่ทำ layout ระดับตัวอักษรแบบ pdfplumber)
+# "pdfplumber" = ช้าที่สุดแต่ละเอียด ใช้เป็น fallback เมื่อ backend เร็วหา Section ไม่เจอหรือได้ภาษาไทยเพี้ยน
+TEXT_BACKEND = os.getenv("TEXT_BACKEND", "pdfium")
+THAI_BROKEN_RATIO = 0.01      # สัดส่วนสระ/วรรณยุกต์ที่วางผิดตำแหน่งต่อจำนวนอักษรไทย ที่ถือว่าข้อความเพี้ยน
+
+# Bounded-memory Mode (กัน OOM จาก TOR ขนาดใหญ่ เช่นภาคผนวกสแกน 500 หน้า)
+# คืน cache ของแต่ละหน้าทันทีที่อ่านเสร็จ, จำกัดข้อความใน buffer และข้ามไฟล์ที่เกินงบ
+LOW_MEMORY_MODE = os.getenv("LOW_MEMORY_MODE", "0") == "1"
+MAX_PDF_PAGES = int(os.getenv("MAX_PDF_PAGES", "300"))     # จำนวนหน้าสูงสุดต่อไฟล์ (0 = ไม่จำกัด)
+MAX_PDF_MB = int(os.getenv("MAX_PDF_MB", "100"))           # ขนาดไฟล์สูงสุด (0 = ไม่จำกัด)
+SECTION_MAX_CHARS = 100_000                                 # ความยาวสูงสุดของ buffer หลังเจอหัวข้อ Section 3
+
+# Extraction Cache (key = sha256 ของไฟล์ PDF + เวอร์ชันของ extractor)
+EXTRACT_CACHE_ENABLED = os.getenv("EXTRACT_CACHE_ENABLED", "1") == "1"
+EXTRACT_CACHE_DIR = os.getenv("EXTRACT_CACHE_DIR", ".extract_cache")
+EXTRACT_CACHE_MAX_MB = int(os.getenv("EXTRACT_CACHE_MAX_MB", "512"))
+
+# Token Accounting
+MAX_SECTION_TOKENS = 12_000     # จำนวน token สูงสุดของ section ต่อ 1 request
+OVERSIZE_POLICY = os.getenv("OVERSIZE_POLICY", "truncate")  # "truncate" = ตัดท้าย, "split" = แบ่งหลาย request, "skip" = ไม่ส่ง
+CHARS_PER_TOKEN = 2             # ค่าประมาณสำหรับภาษาไทยเมื่อโหลด encoding ของ tiktoken ไม่ได้
+EST_OUTPUT_TOKENS = 1000        # token ขาออกโดยประมาณต่อ request
+PRICE_INPUT_PER_1M = 0.15       # USD ต่อ 1M input tokens (gpt-4o-mini)
+PRICE_OUTPUT_PER_1M = 0.60      # USD ต่อ 1M output tokens (gpt-4o-mini)
+BATCH_DISCOUNT = 0.5            # Batch API ลดราคา 50%
+
+# Daemon Mode (เฝ้าโฟลเดอร์ แล้วส่ง micro-batch อัตโนมัติ)
+DAEMON_POLL_SECONDS = 5         # ตรวจโฟลเดอร์ทุกกี่วินาที
+DAEMON_BATCH_SIZE = 200         # ส่ง Batch ทันทีเมื่อมีไฟล์รอครบ N ไฟล์
+DAEMON_FLUSH_SECONDS = 600      # หรือเมื่อไฟล์แรกที่รออยู่รอครบ T วินาที
+DAEMON_RESCAN_EVERY = 60        # สแกนโฟลเดอร์เต็มทุก N รอบ (จับไฟล์ที่ถูกเขียนทับโดยไม่เปลี่ยนชื่อ)
+
+# Work Queue Mode (หลาย worker / หลายเครื่อง ที่แชร์ INPUT_FOLDER และ Postgres เดียวกัน)
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+WORK_CLAIM_SIZE = int(os.getenv("WORK_CLAIM_SIZE", "32"))   # จำนวนไฟล์ที่ worker จองต่อครั้ง
+WORK_LEASE_SECONDS = 300        # lease ที่ไม่ถูกต่ออายุภายในเวลานี้ -> worker อื่นจองไฟล์ต่อได้
+WORK_HEARTBEAT_SECONDS = 60     # worker ต่ออายุ lease ของไฟล์ที่ถืออยู่ทุกกี่วินาที
+WORK_MAX_ATTEMPTS = 3           # จองไฟล์เดิมได้สูงสุดกี่ครั้ง (กัน PDF ที่ทำให้ worker ล่มวนซ้ำ)
+
+# Realtime Mode (ส่งตรงไป Chat Completions สำหรับงานด่วน ไม่ต้องรอ Batch)
+REALTIME_PRIORITY_FILE = "priority.txt"   # รายชื่อไฟล์หรือ project_id ด่วน บรรทัดละ 1 รายการ
+REALTIME_MAX_CHARS = int(os.getenv("REALTIME_MAX_CHARS", "0"))  # section สั้นกว่านี้ส่ง realtime (0 = ปิด)
+REALTIME_CONCURRENCY = 8                  # จำนวน request ที่ส่งพร้อมกัน
+REALTIME_RPM = 500                        # requests / นาที
+REALTIME_TPM = 200_000                    # tokens / นาที
+REALTIME_MAX_RETRIES = 5                  # จำนวนครั้งที่ลองใหม่เมื่อเจอ 429 / 5xx (ครบแล้วย้ายไปรอบ Batch)
+
+# Validation & Retry (ผลลัพธ์ที่ error / JSON เสีย / ไม่ตรง schema ถูกส่งใหม่เป็น retry batch อัตโนมัติ)
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))  # จำนวนครั้งที่ส่งต่อ 1 request รวมครั้งแรก
+
+# LLM Backend
+# "openai" = OpenAI Batch API / Chat Completions จริง
+# "fake"   = จำลองในเครื่อง (deterministic, ไม่เสียเงิน) สำหรับ load test ทั้ง pipeline
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+FAKE_BACKEND_DIR = os.getenv("FAKE_BACKEND_DIR", ".fake_backend")                # เก็บไฟล์ input + สถานะของ Batch จำลอง
+FAKE_BATCH_SECONDS = float(os.getenv("FAKE_BATCH_SECONDS", "10"))              # เวลาที่ Batch จำลองใช้จนเสร็จ
+FAKE_API_LATENCY = float(os.getenv("FAKE_API_LATENCY", "0"))                   # วินาทีต่อ 1 API call
+FAKE_REQUEST_FAIL_RATE = float(os.getenv("FAKE_REQUEST_FAIL_RATE", "0"))       # สัดส่วน request ที่ไปอยู่ใน error file
+FAKE_BATCH_FAIL_RATE = float(os.getenv("FAKE_BATCH_FAIL_RATE", "0"))           # สัดส่วน Batch ที่จบด้วย failed
+FAKE_RATE_LIMIT_RATE = float(os.getenv("FAKE_RATE_LIMIT_RATE", "0"))           # สัดส่วน realtime request ที่ได้ 429
+FAKE_INVALID_OUTPUT_RATE = float(os.getenv("FAKE_INVALID_OUTPUT_RATE", "0"))   # สัดส่วนผลลัพธ์ที่ไม่ตรง schema
+FAKE_SEED = os.getenv("FAKE_SEED", "0")
+
+# Metrics / Telemetry
+METRICS_LOG = os.getenv("METRICS_LOG", "")              # ไฟล์ JSON Lines ของเวลารายไฟล์/รายขั้นตอน ("-" = stdout, ว่าง = ปิด)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))      # เปิด http://<host>:PORT/metrics แบบ Prometheus (0 = ปิด)
+SLOWEST_FILES_TOP_N = 10                                # จำนวนไฟล์ที่ช้าที่สุดที่แสดงท้ายแต่ละรอบ
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, 4 * 3600, 24 * 3600)
 
 # ================= PROMPT & SCHEMA =================
 TARGET_JSON_SCHEMA = """
@@ -58,10 +175,188 @@ Output: JSON ตาม Schema นี้เท่านั้น:
 
 กฎ:
 - ตอบกลับเป็น JSON เท่านั้น
-- ถ้าข้อมูลส่วนไหนไม่มี ให้ใส่ [] หรือ null
+- ถ้าข้อมูลส่วนไหนไม่มี ให้ใส่ [] (รายการ) หรือ null (ข้อความ) โดยคง Key ทุกตัวตาม Schema
 - ห้ามเพิ่ม Key อื่นนอกเหนือจาก Schema
 """
 
+USER_MESSAGE_PREFIX = "ข้อมูลเอกสาร:\n"
+
+# ต่อท้าย system prompt ของ request ที่ถูกส่งใหม่เพราะผลลัพธ์รอบก่อนใช้ไม่ได้
+RETRY_PROMPT_SUFFIX = """
+คำเตือน: คำตอบก่อนหน้าใช้ไม่ได้ (JSON ไม่สมบูรณ์หรือไม่ตรง Schema)
+- ตอบเป็น JSON object เดียว ไม่มีข้อความอื่นหรือ markdown
+- ใช้ Key ตาม Schema ทุกตัวอักษร ครบทุกระดับ ห้ามเพิ่ม ห้ามเปลี่ยนชื่อ ห้ามใส่ null แทน object หรือ list
+- required_documents ต้องเป็น list ของข้อความ (string) เท่านั้น
+- options ต้องเป็น list ของ object ที่มีเฉพาะ condition และ document
+"""
+
+# ผลลัพธ์ใน section_results ใช้ซ้ำได้เฉพาะเมื่อ model / prompt / การตัดข้อความเหมือนเดิม
+PROMPT_VERSION = hashlib.sha256(
+    f"{SYSTEM_PROMPT}|{USER_MESSAGE_PREFIX}|{OVERSIZE_POLICY}|{MAX_SECTION_TOKENS}".encode("utf-8")
+).hexdigest()[:12]
+SECTION_ID_PREFIX = "sec:"   # custom_id ของ request ที่ส่งครั้งเดียวต่อ Section ที่ไม่ซ้ำกัน
+
+# ================= METRICS =================
+
+class Metrics:
+    """เก็บ counter / histogram (วินาที) ของแต่ละขั้นตอนแบบ thread-safe
+    เขียน event เป็น JSON Lines ไปที่ METRICS_LOG และ render เป็น Prometheus text format ได้
+    ขั้นตอนใน worker process ส่งเวลากลับมาใน stats แล้วค่อยบันทึกที่ process หลัก"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.slow_files = {}
+        self.log_file = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, stage, seconds, **labels):
+        key = tuple(sorted({"stage": stage, **labels}.items()))
+        with self.lock:
+            hist = self.histograms.setdefault(key, {"buckets": [0] * len(METRICS_BUCKETS), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(METRICS_BUCKETS):
+                if seconds <= bound:
+                    hist["buckets"][i] += 1
+            hist["sum"] += seconds
+            hist["count"] += 1
+
+    def event(self, event, **fields):
+        if not METRICS_LOG:
+            return
+        line = json.dumps({"ts": datetime.now(timezone.utc).isoformat(), "event": event, **fields}, ensure_ascii=False, default=str)
+        with self.lock:
+            if METRICS_LOG == "-":
+                print(line, flush=True)
+                return
+            if self.log_file is None:
+                self.log_file = open(METRICS_LOG, "a", encoding="utf-8")
+            self.log_file.write(line + "\n")
+            self.log_file.flush()
+
+    @contextlib.contextmanager
+    def timer(self, stage, **fields):
+        """จับเวลา 1 ขั้นตอน: บันทึกลง histogram และเขียน event (fields เพิ่มเติมใส่ได้ระหว่างทางผ่าน dict ที่ yield)"""
+        extra = {}
+        start = time.perf_counter()
+        try:
+            yield extra
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(stage, seconds)
+            self.event(stage, seconds=round(seconds, 4), **fields, **extra)
+
+    def record_file(self, filename, seconds, **fields):
+        with self.lock:
+            self.slow_files[filename] = (seconds, fields)
+
+    def reset_slow_files(self):
+        with self.lock:
+            self.slow_files = {}
+
+    def report_slowest(self, n=SLOWEST_FILES_TOP_N):
+        with self.lock:
+            slowest = heapq.nlargest(n, self.slow_files.items(), key=lambda item: item[1][0])
+        if not slowest:
+            return
+        print(f"\n--- 🐢 ไฟล์ที่ช้าที่สุด {len(slowest)} อันดับ ---")
+        for filename, (seconds, fields) in slowest:
+            detail = " ".join(f"{k}={v}" for k, v in fields.items() if v is not None)
+            print(f"   {seconds:8.2f}s  {filename}  {detail}")
+
+    def report_stages(self):
+        with self.lock:
+            rows = sorted(
+                (" ".join([dict(key)["stage"]] + [v for k, v in key if k != "stage"]), hist["count"], hist["sum"])
+                for key, hist in self.histograms.items()
+            )
+        if not rows:
+            return
+        print("\n--- ⏱️  เวลาแต่ละขั้นตอน ---")
+        for stage, count, total in rows:
+            print(f"   {stage:<20} {count:>7} ครั้ง  รวม {total:10.2f}s  เฉลี่ย {total / count:8.3f}s")
+
+    def render(self):
+        """Prometheus text exposition format"""
+        def fmt(labels):
+            return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE tor_{name} counter")
+                for (counter_name, labels), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        lines.append(f"tor_{name}{fmt(labels)} {value}")
+
+            lines.append("# TYPE tor_stage_seconds histogram")
+            for labels, hist in sorted(self.histograms.items()):
+                for bound, count in zip(METRICS_BUCKETS, hist["buckets"]):
+                    lines.append(f"tor_stage_seconds_bucket{fmt(labels + (('le', bound),))} {count}")
+                lines.append(f"tor_stage_seconds_bucket{fmt(labels + (('le', '+Inf'),))} {hist['count']}")
+                lines.append(f"tor_stage_seconds_sum{fmt(labels)} {hist['sum']}")
+                lines.append(f"tor_stage_seconds_count{fmt(labels)} {hist['count']}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def start_metrics_server(port=METRICS_PORT):
+    """เปิด endpoint /metrics ใน background thread สำหรับ Prometheus scrape"""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            data = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"📈 Metrics endpoint: http://0.0.0.0:{server.server_address[1]}/metrics")
+    return server
+
+def record_file_metrics(filename, result, stats, seconds):
+    """บันทึก metrics ของ 1 ไฟล์จาก stats ที่ extractor เติมไว้ (ใช้ได้ทั้งโหมด thread และ process)"""
+    result = result if isinstance(result, str) else "ok"
+    metrics.inc("files_total", result=result)
+    metrics.inc("pages_parsed_total", stats.get("pages_parsed", 0))
+    metrics.inc("chars_extracted_total", stats.get("chars", 0))
+    metrics.observe("process_file", seconds)
+    if stats.get("text_backend"):
+        metrics.inc("text_backend_total", backend=stats["text_backend"], fallback=stats.get("fallback", "none"))
+    for stage in ("extract_file", "pdf_parse", "regex"):
+        if f"{stage}_seconds" in stats:
+            metrics.observe(stage, stats[f"{stage}_seconds"])
+
+    fields = {
+        "result": result,
+        "pages_parsed": stats.get("pages_parsed"),
+        "page_count": stats.get("page_count"),
+        "chars": stats.get("chars"),
+        "cache": stats.get("cache"),
+        "text_backend": stats.get("text_backend"),
+        "fallback": stats.get("fallback"),
+        "skip_reason": stats.get("skip_reason"),
+        "extract_error": stats.get("extract_error"),
+    }
+    metrics.record_file(filename, seconds, **fields)
+    metrics.event(
+        "file", filename=filename, seconds=round(seconds, 4), **fields,
+        **{k: round(v, 4) for k, v in stats.items() if k.endswith("_seconds")}
+    )
+
 # ================= DATABASE LAYER =================
 
 def get_db_connection():
@@ -69,6 +364,266 @@ def get_db_connection():
         host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS
     )
 
+# ================= ASYNC DATABASE POOL =================
+
+class AsyncDBPool:
+    """Connection pool แบบ async (psycopg 3) ผูกกับ event loop ที่สร้าง
+    เปิด connection เมื่อจำเป็นไม่เกิน DB_POOL_SIZE และเก็บ connection ที่คืนแล้วไว้ใช้ซ้ำ (ไม่ต่อใหม่ทุกครั้ง)
+    เวลารอ connection ว่างบันทึกเป็น db_pool_wait และเวลาที่ถือ connection บันทึกเป็น db_query แยกตามชื่อ query"""
+
+    def __init__(self, size=DB_POOL_SIZE):
+        self.loop = asyncio.get_running_loop()
+        self.slots = asyncio.Semaphore(size)
+        self.idle = []
+        self.closed = False
+        self.hostaddr = None
+        self.resolved = False
+
+    async def resolve(self):
+        """resolve DB_HOST ครั้งเดียวต่อ pool ด้วย loop.getaddrinfo (ไม่บล็อก event loop)
+        run_async เรียกตอนเปิด pool ก่อนมี thread อื่น เพราะ getaddrinfo ใช้ default executor ซึ่งภายหลังอาจเต็มไปด้วย
+        thread ของ asyncio.to_thread ที่รอ call_db อยู่ -> deadlock ถ้า resolve ไม่ได้ให้ psycopg resolve เอง"""
+        if self.resolved:
+            return
+        self.resolved = True
+        if not DB_HOST or DB_HOST.startswith("/"):
+            return  # unix socket
+        try:
+            infos = await self.loop.getaddrinfo(DB_HOST, None, type=socket.SOCK_STREAM)
+            self.hostaddr = infos[0][4][0]
+        except OSError as e:
+            print(f"⚠️ resolve {DB_HOST} ไม่ได้ ให้ psycopg resolve เองตอนต่อ: {e}")
+
+    async def _connect(self):
+        await self.resolve()
+        metrics.inc("db_connections_opened_total")
+        return await psycopg.AsyncConnection.connect(
+            host=DB_HOST, hostaddr=self.hostaddr, dbname=DB_NAME, user=DB_USER, password=DB_PASS,
+            prepare_threshold=5 if DB_PREPARE else None
+        )
+
+    async def _take(self):
+        while self.idle:
+            conn = self.idle.pop()
+            if not conn.closed and not conn.broken:
+                return conn
+        return await self._connect()
+
+    async def _give_back(self, conn):
+        if self.closed or conn.closed or conn.broken:
+            await conn.close()
+            return
+        if conn.info.transaction_status != psycopg.pq.TransactionStatus.IDLE:
+            await conn.rollback()
+        self.idle.append(conn)
+
+    @contextlib.asynccontextmanager
+    async def connection(self, query):
+        start = time.perf_counter()
+        await asyncio.wait_for(self.slots.acquire(), DB_POOL_TIMEOUT)
+        try:
+            metrics.observe("db_pool_wait", time.perf_counter() - start)
+            conn = await self._take()
+            start = time.perf_counter()
+            try:
+                yield conn
+            finally:
+                metrics.observe("db_query", time.perf_counter() - start, query=query)
+                await self._give_back(conn)
+        finally:
+            self.slots.release()
+
+    async def close(self):
+        self.closed = True
+        while self.idle:
+            await self.idle.pop().close()
+
+_db_pool = None
+
+def get_db_pool():
+    """pool ของ event loop ปัจจุบัน (ปกติ run_async เปิดไว้ให้แล้ว 1 pool ตลอดการรัน)"""
+    global _db_pool
+    if _db_pool is None or _db_pool.loop is not asyncio.get_running_loop():
+        _db_pool = AsyncDBPool()
+    return _db_pool
+
+async def open_db_pool():
+    pool = get_db_pool()
+    await pool.resolve()
+    return pool
+
+async def close_db_pool():
+    global _db_pool
+    if _db_pool is not None and _db_pool.loop is asyncio.get_running_loop():
+        await _db_pool.close()
+        _db_pool = None
+
+def run_async(coro):
+    """asyncio.run ที่เปิด pool ไว้ก่อน และปิด pool เมื่อจบ ใช้เป็นจุดเข้าของทุกคำสั่ง (1 การรัน = 1 pool)
+    thread ของ asyncio.to_thread ใช้ pool เดียวกันผ่าน call_db"""
+    async def runner():
+        await open_db_pool()
+        try:
+            return await coro
+        finally:
+            await close_db_pool()
+    return asyncio.run(runner())
+
+def call_db(func, *args, **kwargs):
+    """เรียกฟังก์ชัน DB แบบ async จากโค้ด sync ที่รันใน thread ของ asyncio.to_thread ภายใน run_async
+    ส่ง coroutine ไปรันใน event loop ที่ถือ pool อยู่ (ใช้ connection ร่วมกัน ไม่สร้าง pool ใหม่ต่อการเรียก)"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        raise RuntimeError(f"{func.__name__}() ถูกเรียกใน event loop ให้ await โดยตรงแทน")
+    pool = _db_pool
+    if pool is None or pool.closed or not pool.loop.is_running():
+        raise RuntimeError(f"{func.__name__}() ต้องถูกเรียกภายใน run_async (ไม่มี pool ที่เปิดอยู่)")
+    return asyncio.run_coroutine_threadsafe(func(*args, **kwargs), pool.loop).result()
+
+# สถิติเอกสารที่ต้องใช้ สรุปจาก document_requirements (แหล่งข้อมูลเดียวของหน้าค้นหา/สถิติ)
+# sub_case เก็บเป็น '' แทน NULL เพราะ REFRESH ... CONCURRENTLY ต้องมี unique index บนคอลัมน์ตรงๆ
+ANALYTICS_VIEWS_SQL = """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS batch_data.document_requirement_counts_mv AS
+    SELECT category, coalesce(sub_case, '') AS sub_case,
+           md5(coalesce(condition, '') || '|' || document_text) AS document_hash,
+           min(condition) AS condition, min(document_text) AS document_text,
+           count(DISTINCT project_id) AS projects
+    FROM batch_data.document_requirements
+    GROUP BY category, coalesce(sub_case, ''), md5(coalesce(condition, '') || '|' || document_text);
+
+    CREATE UNIQUE INDEX IF NOT EXISTS document_requirement_counts_mv_key
+    ON batch_data.document_requirement_counts_mv (category, sub_case, document_hash);
+    CREATE INDEX IF NOT EXISTS document_requirement_counts_rank_idx
+    ON batch_data.document_requirement_counts_mv (category, sub_case, projects DESC);
+"""
+
+# แตก JSON ของแต่ละ project เป็นแถวในตาราง document_requirements (1 แถวต่อ 1 เอกสาร)
+# {source} ต้องมีคอลัมน์ project_id, json และไม่มี project_id ซ้ำ
+# amount_baht = จำนวนเงินใน document ของหลักฐานการเงิน (เลขไทยแปลงเป็นอารบิก, "ล้านบาท" คูณ 1,000,000)
+DOCUMENT_REQUIREMENTS_INSERT_SQL = """
+    INSERT INTO batch_data.document_requirements
+        (project_id, category, sub_case, ordinal, document_text, condition, amount_baht)
+    WITH root AS (
+        SELECT project_id, coalesce(json -> 'bid_submission_documents_part_1', json) AS r
+        FROM {source} AS src
+    )
+    SELECT root.project_id, p.category, p.sub_case, d.ordinal, d.value #>> '{{}}', NULL, NULL
+    FROM root
+    CROSS JOIN (VALUES
+        ('legal_entity', 'partnership', '$."1_legal_entity_documents".case_partnership.required_documents[*]'),
+        ('legal_entity', 'company', '$."1_legal_entity_documents".case_company.required_documents[*]'),
+        ('individual', NULL, '$."2_individual_documents".required_documents[*]'),
+        ('joint_venture', NULL, '$."3_joint_venture_documents".required_documents[*]'),
+        ('general', NULL, '$."5_general_documents".required_documents[*]')
+    ) AS p(category, sub_case, path)
+    CROSS JOIN LATERAL jsonb_path_query(root.r, p.path::jsonpath) WITH ORDINALITY AS d(value, ordinal)
+    WHERE jsonb_typeof(d.value) = 'string'
+    UNION ALL
+    SELECT root.project_id, 'financial', NULL, o.ordinal, o.value ->> 'document', o.value ->> 'condition',
+           m[1]::numeric * CASE WHEN m[2] IS NULL THEN 1 ELSE 1000000 END
+    FROM root
+    CROSS JOIN LATERAL jsonb_path_query(root.r, '$."4_financial_capability_evidence".options[*]')
+        WITH ORDINALITY AS o(value, ordinal)
+    LEFT JOIN LATERAL regexp_match(
+        translate(replace(o.value ->> 'document', ',', ''), '๐๑๒๓๔๕๖๗๘๙', '0123456789'),
+        '([0-9]+(?:\\.[0-9]+)?)\\s*(ล้าน)?\\s*บาท'
+    ) AS m ON true
+    WHERE o.value ->> 'document' IS NOT NULL;
+"""
+
+def document_requirements_sql(source):
+    """คืนค่า (DELETE แถวเดิมของ project ใน source, INSERT ... SELECT แถวใหม่ทั้งหมด)"""
+    return f"""
+        DELETE FROM batch_data.document_requirements d
+        USING {source} s
+        WHERE d.project_id = s.project_id;
+    """, DOCUMENT_REQUIREMENTS_INSERT_SQL.format(source=source)
+
+async def abackfill_document_requirements(chunk_size=INGEST_CHUNK_SIZE):
+    """เติม document_requirements จาก batch_json ที่บันทึกไว้ก่อนมีตารางนี้ (รันซ้ำได้ แถวเดิมถูกแทนที่)
+    ทำทีละ chunk ตาม project_id และ commit ทุก chunk เพื่อไม่ล็อกตารางนาน"""
+    delete_sql, insert_sql = document_requirements_sql(
+        "(SELECT project_id, json FROM batch_data.batch_json WHERE project_id = ANY(%(ids)s))"
+    )
+    total_projects = total_rows = 0
+    last_id = ""
+    start = time.perf_counter()
+    try:
+        async with get_db_pool().connection("backfill_requirements") as conn:
+            while True:
+                cur = await conn.execute("""
+                    SELECT project_id FROM batch_data.batch_json
+                    WHERE project_id > %s ORDER BY project_id LIMIT %s;
+                """, (last_id, chunk_size))
+                ids = [row[0] for row in await cur.fetchall()]
+                if not ids:
+                    break
+                await conn.execute(delete_sql, {"ids": ids})
+                cur = await conn.execute(insert_sql, {"ids": ids})
+                await conn.commit()
+                total_rows += cur.rowcount
+                total_projects += len(ids)
+                last_id = ids[-1]
+                print(f"   ...เติมแล้ว {total_projects} projects ({total_rows} เอกสาร)")
+        print(f"✅ Backfill document_requirements เสร็จ: {total_projects} projects, {total_rows} เอกสาร "
+              f"ใน {time.perf_counter() - start:.1f} วินาที")
+    except Exception as e:
+        print(f"❌ Backfill Error: {e}")
+    # batch_json ไม่เปลี่ยน refresh ปกติจะไม่เห็นว่ามีข้อมูลใหม่ จึงบังคับ refresh สถิติเอง (รวม chunk ที่ commit แล้วกรณี error)
+    await asyncio.to_thread(refresh_analytics_views, force=True)
+
+def refresh_analytics_views(min_interval=ANALYTICS_REFRESH_SECONDS, force=False):
+    """Refresh materialized view ของหน้าสถิติ (CONCURRENTLY = ผู้ใช้ Viewer ยังอ่านได้ระหว่าง refresh)
+    ข้ามถ้าไม่มีผลใหม่ใน batch_json ตั้งแต่ครั้งก่อน หรือ refresh ไปแล้วไม่ถึง min_interval วินาที
+    force=True refresh เสมอ (ใช้หลังแก้ document_requirements โดยตรง เช่น backfill ซึ่ง batch_json ไม่เปลี่ยน)
+    สถานะอยู่ในตาราง analytics_refresh ใช้ร่วมกันทุก process และกัน refresh ซ้อนกันด้วย advisory lock
+    คืนค่า True ถ้า refresh จริง"""
+    conn = get_db_connection()
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            if force:
+                # รอ refresh ของ process อื่นให้จบก่อน เพราะอาจเริ่มไปก่อนข้อมูลที่เพิ่ง commit
+                cur.execute("SELECT pg_advisory_lock(hashtext('batch_data.analytics_refresh'));")
+            else:
+                cur.execute("SELECT pg_try_advisory_lock(hashtext('batch_data.analytics_refresh'));")
+                if not cur.fetchone()[0]:
+                    return False  # process อื่นกำลัง refresh อยู่ (lock ถูกปล่อยเมื่อปิด connection)
+            cur.execute("""
+                SELECT r.refreshed_at > CURRENT_TIMESTAMP - make_interval(secs => %s),
+                       EXISTS (SELECT 1 FROM batch_data.batch_json b WHERE b.created_at >= r.refreshed_at)
+                FROM batch_data.analytics_refresh r
+                WHERE r.view_name = 'document_requirement_counts_mv';
+            """, (min_interval,))
+            row = cur.fetchone()
+            if row and (row[0] or not row[1]) and not force:
+                return False
+            # created_at ของ batch_json คือเวลาเริ่ม transaction ที่บันทึก ผลที่ยัง commit ไม่เสร็จตอน refresh
+            # จึงอาจมีเวลาเก่ากว่าตอนนี้ ใช้เวลาของ transaction ที่เก่าที่สุดที่ยังเปิดอยู่เป็นจุดตัดแทน
+            cur.execute("""
+                SELECT coalesce(min(xact_start), CURRENT_TIMESTAMP) FROM pg_stat_activity
+                WHERE datname = current_database() AND xact_start IS NOT NULL;
+            """)
+            watermark = cur.fetchone()[0]
+            start = time.perf_counter()
+            cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY batch_data.document_requirement_counts_mv;")
+            cur.execute("""
+                INSERT INTO batch_data.analytics_refresh (view_name, refreshed_at)
+                VALUES ('document_requirement_counts_mv', %s)
+                ON CONFLICT (view_name) DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at;
+            """, (watermark,))
+            metrics.observe("refresh_analytics", time.perf_counter() - start)
+        print("📊 อัปเดตข้อมูลสถิติเอกสาร (analytics views) แล้ว")
+        return True
+    except Exception as e:
+        print(f"⚠️ Refresh analytics views ไม่สำเร็จ: {e}")
+        return False
+    finally:
+        conn.close()
+
 def init_db():
     conn = get_db_connection()
     try:
@@ -81,311 +636,2745 @@ def init_db():
                     created_at timestamp not null default current_timestamp
                 );
             """)
+            # สถานะรายไฟล์: discovered -> extracted -> submitted(batch_id) -> saved / failed(reason)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS batch_data.file_state(
+                    project_id varchar(255) primary key not null,
+                    filename varchar(255) not null,
+                    status varchar(20) not null,
+                    batch_id varchar(64),
+                    reason text,
+                    updated_at timestamp not null default current_timestamp
+                );
+            """)
+            # Work queue: ไฟล์ discovered คือคิว worker จองด้วย lease (ต้องต่ออายุด้วย heartbeat)
+            cur.execute("""
+                ALTER TABLE batch_data.file_state
+                    ADD COLUMN IF NOT EXISTS lease_owner varchar(128),
+                    ADD COLUMN IF NOT EXISTS lease_expires_at timestamp,
+                    ADD COLUMN IF NOT EXISTS attempts integer not null default 0;
+            """)
+            # request ที่ worker สกัดเสร็จแล้ว รอ coordinator รวมส่งเป็น Batch
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS batch_data.extracted_requests(
+                    project_id varchar(255) primary key not null,
+                    section_hash varchar(64) not null,
+                    requests jsonb not null,
+                    created_at timestamp not null default current_timestamp
+                );
+            """)
+            # hash ของ Section 3 ที่สกัดได้ ใช้กระจายผลของ request เดียวไปยังทุกไฟล์ที่ข้อความเหมือนกัน
+            cur.execute("ALTER TABLE batch_data.file_state ADD COLUMN IF NOT EXISTS section_hash varchar(64);")
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS file_state_section_idx
+                ON batch_data.file_state (section_hash, status);
+            """)
+            # ผลลัพธ์ต่อ Section ที่ไม่ซ้ำกัน (hash รวม MODEL_NAME และ PROMPT_VERSION แล้ว)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS batch_data.section_results(
+                    section_hash varchar(64) primary key not null,
+                    model varchar(64) not null,
+                    json jsonb,
+                    created_at timestamp not null default current_timestamp
+                );
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS file_state_status_idx
+                ON batch_data.file_state (status, updated_at);
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS file_state_batch_idx
+                ON batch_data.file_state (batch_id);
+            """)
+            # สำหรับหน้า Viewer: keyset pagination ตาม created_at และค้นหา project_id แบบขึ้นต้นด้วย (LIKE 'abc%')
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS batch_json_created_idx
+                ON batch_data.batch_json (created_at DESC, project_id DESC);
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS batch_json_project_prefix_idx
+                ON batch_data.batch_json (project_id varchar_pattern_ops);
+            """)
+            # ผลลัพธ์แบบตาราง 1 แถวต่อ 1 เอกสาร ให้ query รายงานใช้ SQL + index ปกติแทนการไล่ JSON
+            # sub_case ใช้กับ legal_entity (partnership / company), condition ใช้กับ financial
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS batch_data.document_requirements(
+                    project_id varchar(255) not null
+                        references batch_data.batch_json (project_id) on delete cascade,
+                    category varchar(32) not null,
+                    sub_case varchar(32),
+                    ordinal integer not null,
+                    document_text text not null,
+                    condition text
+                );
+            """)
+            cur.execute("ALTER TABLE batch_data.document_requirements ADD COLUMN IF NOT EXISTS amount_baht numeric;")
+            # ค้นหาหลักฐานการเงินตามวงเงิน (amount_baht >= ...)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS document_requirements_amount_idx
+                ON batch_data.document_requirements (amount_baht) WHERE category = 'financial';
+            """)
+            cur.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS document_requirements_key
+                ON batch_data.document_requirements (project_id, category, coalesce(sub_case, ''), ordinal);
+            """)
+            # ค้นหา project ที่ต้องใช้เอกสารนี้แบบตรงตัว (md5 เพราะข้อความยาวเกินขนาด btree ได้)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS document_requirements_document_idx
+                ON batch_data.document_requirements (category, coalesce(sub_case, ''), md5(document_text));
+            """)
+            cur.execute(ANALYTICS_VIEWS_SQL)
+            # เวลาที่ refresh materialized view ล่าสุด (ใช้ตัดสินว่ามีผลใหม่ต้อง refresh ไหม)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS batch_data.analytics_refresh(
+                    view_name varchar(64) primary key not null,
+                    refreshed_at timestamp not null
+                );
+            """)
         conn.commit()
     except Exception as e:
         print(f"❌ DB Init Error: {e}")
-    finally:
-        conn.close()
+        conn.rollback()
 
-def get_all_existing_ids():
-    conn = get_db_connection()
-    existing_ids = set()
+    # ค้นหาแบบมีคำว่า (ILIKE '%abc%') ใช้ trigram index ซึ่งต้องมี extension pg_trgm
+    # แยก transaction เพราะ user ที่ไม่มีสิทธิ์สร้าง extension จะ error แต่ส่วนอื่นยังใช้งานได้
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT project_id FROM batch_data.batch_json")
-            rows = cur.fetchall()
-            for row in rows:
-                existing_ids.add(row[0])
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS batch_json_project_trgm_idx
+                ON batch_data.batch_json USING gin (project_id gin_trgm_ops);
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS document_requirements_text_trgm_idx
+                ON batch_data.document_requirements USING gin (document_text gin_trgm_ops);
+            """)
+        conn.commit()
+    except Exception as e:
+        print(f"⚠️ สร้าง pg_trgm index ไม่ได้ (ค้นหาแบบมีคำว่าจะช้าลง): {e}")
+        conn.rollback()
     finally:
         conn.close()
-    return existing_ids
 
-def save_results_to_db(results_list):
-    conn = get_db_connection()
-    success_count = 0
+async def afilter_new_project_ids(candidates):
+    """ส่ง project_id ทั้งหมดจาก input_pdfs ไปให้ Postgres anti-join ในครั้งเดียว
+    candidates เป็น dict {project_id: เวลาแก้ไขไฟล์ (datetime)} คืนค่าเฉพาะ id ที่ต้องประมวลผล
+    - ข้ามไฟล์ที่มีใน batch_json แล้ว (ถ้า SKIP_EXISTING) เว้นแต่ไฟล์ใหม่กว่า created_at (ถ้า REPROCESS_IF_NEWER)
+    - ข้ามไฟล์ที่ส่งไปแล้วและยังรอผล (file_state.status = 'submitted') เสมอ"""
+    if not candidates:
+        return set()
+    async with get_db_pool().connection("filter_new_ids") as conn:
+        cur = await conn.execute("""
+            SELECT c.project_id
+            FROM unnest(%s::text[], %s::timestamptz[]) AS c(project_id, file_mtime)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM batch_data.file_state f
+                WHERE f.project_id = c.project_id AND f.status = 'submitted'
+            )
+            AND NOT (%s AND EXISTS (
+                SELECT 1 FROM batch_data.batch_json b
+                WHERE b.project_id = c.project_id
+                  AND (NOT %s OR b.created_at >= c.file_mtime)
+            ));
+        """, (list(candidates.keys()), list(candidates.values()), SKIP_EXISTING, REPROCESS_IF_NEWER), prepare=DB_PREPARE)
+        return {row[0] for row in await cur.fetchall()}
+
+# ================= FILE STATE =================
+
+async def aupdate_file_states(rows, status, batch_id=None, section_hashes=None):
+    """อัปเดตสถานะหลายไฟล์ในครั้งเดียว rows เป็น list ของ (filename, reason)
+    section_hashes (dict filename -> hash) ใช้ตอนสกัดเสร็จ ถ้าไม่ส่งมาจะคง hash เดิมไว้"""
+    if not rows:
+        return
+    section_hashes = section_hashes or {}
+    values = [
+        (os.path.splitext(filename)[0], filename, status, batch_id, reason, section_hashes.get(filename))
+        for filename, reason in rows
+    ]
+    async with get_db_pool().connection("file_states") as conn:
+        try:
+            # executemany ของ psycopg 3 ส่งทุกแถวใน pipeline เดียว (ไม่รอผลทีละแถว) ด้วย prepared statement
+            async with conn.pipeline(), conn.cursor() as cur:
+                await cur.executemany("""
+                    INSERT INTO batch_data.file_state (project_id, filename, status, batch_id, reason, section_hash, updated_at)
+                    VALUES (%s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+                    ON CONFLICT (project_id)
+                    DO UPDATE SET
+                        filename = EXCLUDED.filename,
+                        status = EXCLUDED.status,
+                        batch_id = EXCLUDED.batch_id,
+                        reason = EXCLUDED.reason,
+                        section_hash = coalesce(EXCLUDED.section_hash, file_state.section_hash),
+                        updated_at = CURRENT_TIMESTAMP;
+                """, values)
+            await conn.commit()
+        except Exception as e:
+            print(f"❌ File State Error: {e}")
+            await conn.rollback()
+
+async def aupdate_section_states(rows, status, batch_id=None):
+    """อัปเดตสถานะทุกไฟล์ที่รอผลของ Section เดียวกัน rows เป็น list ของ (section_hash, reason)
+    batch_id เป็น None = คง batch_id เดิมไว้"""
+    if not rows:
+        return
+    async with get_db_pool().connection("section_states") as conn:
+        try:
+            async with conn.pipeline(), conn.cursor() as cur:
+                await cur.executemany("""
+                    UPDATE batch_data.file_state
+                    SET status = %s, reason = %s, batch_id = coalesce(%s, batch_id), updated_at = CURRENT_TIMESTAMP
+                    WHERE section_hash = %s AND status IN ('extracted', 'submitted');
+                """, [(status, reason, batch_id, section_hash) for section_hash, reason in rows])
+            await conn.commit()
+        except Exception as e:
+            print(f"❌ File State Error: {e}")
+            await conn.rollback()
+
+async def aupdate_request_states(rows, status, batch_id=None):
+    """rows เป็น list ของ (ชื่อ request, reason) โดยชื่อ request คือ filename หรือ sec:<hash>"""
+    section_rows = [(request_section_hash(name), reason) for name, reason in rows if request_section_hash(name)]
+    file_rows = [(name, reason) for name, reason in rows if not request_section_hash(name)]
+    await asyncio.gather(
+        aupdate_section_states(section_rows, status, batch_id),
+        aupdate_file_states(file_rows, status, batch_id)
+    )
+
+async def afail_unsaved_batch_files(batch_id, reason):
+    """ไฟล์ใน Batch ที่ยังไม่ได้บันทึก (ล้มเหลว/หมดอายุ/ไม่มีผลลัพธ์) -> failed เพื่อให้รอบถัดไปส่งใหม่"""
+    async with get_db_pool().connection("fail_unsaved") as conn:
+        cur = await conn.execute("""
+            UPDATE batch_data.file_state
+            SET status = 'failed', reason = %s, updated_at = CURRENT_TIMESTAMP
+            WHERE batch_id = %s AND status = 'submitted';
+        """, (reason, batch_id), prepare=DB_PREPARE)
+        await conn.commit()
+        return cur.rowcount
+
+async def aget_inflight_batch_ids():
+    async with get_db_pool().connection("inflight_batches") as conn:
+        cur = await conn.execute(
+            "SELECT DISTINCT batch_id FROM batch_data.file_state WHERE status = 'submitted'", prepare=DB_PREPARE
+        )
+        return [row[0] for row in await cur.fetchall()]
+
+async def aget_pipeline_status():
+    """คืนค่า (จำนวนไฟล์แยกตามสถานะ, รายการไฟล์ที่ค้าง)"""
+    async with get_db_pool().connection("pipeline_status") as conn:
+        cur = await conn.execute("""
+            SELECT status, count(*) FROM batch_data.file_state
+            GROUP BY status ORDER BY status;
+        """)
+        counts = await cur.fetchall()
+        cur = await conn.execute("""
+            SELECT filename, status, batch_id, reason, updated_at
+            FROM batch_data.file_state
+            WHERE status = 'failed'
+               OR (status IN ('discovered', 'extracted', 'submitted')
+                   AND updated_at < CURRENT_TIMESTAMP - make_interval(hours => %s))
+            ORDER BY updated_at;
+        """, (STUCK_AFTER_HOURS,))
+        stuck = await cur.fetchall()
+        return counts, stuck
+
+async def asave_results_to_db(results_list):
+    """COPY ผลลัพธ์เข้า staging table แล้ว merge เข้า batch_json ด้วย INSERT ... ON CONFLICT ครั้งเดียว
+    รายการที่ id เป็น sec:<hash> จะถูกเก็บใน section_results และกระจายให้ทุกไฟล์ที่รอผลของ Section นั้น
+    คำสั่งหลัง COPY ส่งใน pipeline เดียว (prepared statements, รอผลครั้งเดียวตอนจบ) แล้ว commit
+    ใช้ connection จาก pool จึงเรียกพร้อมกันได้หลาย Batch โดยไม่ต้องต่อใหม่ทุกครั้ง
+    error จะถูก raise ต่อ ผู้เรียกต้องไม่ถือว่ารายการใน chunk นี้บันทึกแล้ว"""
+    success_count = requirement_rows = 0
+    start = time.perf_counter()
     try:
-        with conn.cursor() as cur:
-            query = """
-                INSERT INTO batch_data.batch_json (project_id, json, created_at)
-                VALUES (%s, %s, CURRENT_TIMESTAMP)
-                ON CONFLICT (project_id) 
-                DO UPDATE SET 
-                    json = EXCLUDED.json, 
-                    created_at = CURRENT_TIMESTAMP;
-            """
-            data_tuples = [(item['id'], Json(item['data'])) for item in results_list]
-            cur.executemany(query, data_tuples)
-            success_count = len(results_list)
-        conn.commit()
+        async with get_db_pool().connection("save_results") as conn:
+            try:
+                async with conn.cursor() as cur:
+                    await cur.execute("""
+                        CREATE TEMP TABLE IF NOT EXISTS batch_json_stage (
+                            seq integer,
+                            project_id varchar(255),
+                            json jsonb
+                        ) ON COMMIT DELETE ROWS;
+                    """)
+                    async with cur.copy("COPY batch_json_stage (seq, project_id, json) FROM STDIN") as copy:
+                        for seq, item in enumerate(results_list):
+                            await copy.write_row((seq, item['id'], json.dumps(item['data'], ensure_ascii=False)))
+
+                async with conn.pipeline():
+                    if any(item['id'].startswith(SECTION_ID_PREFIX) for item in results_list):
+                        params = {"prefix": SECTION_ID_PREFIX, "model": MODEL_NAME}
+                        await conn.execute("""
+                            INSERT INTO batch_data.section_results (section_hash, model, json, created_at)
+                            SELECT DISTINCT ON (project_id)
+                                   substr(project_id, length(%(prefix)s) + 1), %(model)s, json, CURRENT_TIMESTAMP
+                            FROM batch_json_stage
+                            WHERE left(project_id, length(%(prefix)s)) = %(prefix)s
+                            ORDER BY project_id, seq DESC
+                            ON CONFLICT (section_hash)
+                            DO UPDATE SET
+                                json = EXCLUDED.json,
+                                created_at = CURRENT_TIMESTAMP;
+                        """, params, prepare=DB_PREPARE)
+                        # แทนแถว sec:<hash> ด้วยแถวของทุก project ที่ยังรอผลของ Section นั้น
+                        await conn.execute("""
+                            INSERT INTO batch_json_stage (seq, project_id, json)
+                            SELECT s.seq, f.project_id, s.json
+                            FROM batch_json_stage s
+                            JOIN batch_data.file_state f
+                              ON f.section_hash = substr(s.project_id, length(%(prefix)s) + 1)
+                            WHERE left(s.project_id, length(%(prefix)s)) = %(prefix)s
+                              AND f.status IN ('extracted', 'submitted');
+                        """, params, prepare=DB_PREPARE)
+                        await conn.execute("""
+                            DELETE FROM batch_json_stage WHERE left(project_id, length(%(prefix)s)) = %(prefix)s;
+                        """, params, prepare=DB_PREPARE)
+
+                    # ถ้า project_id ซ้ำใน chunk เดียวกัน ให้ใช้รายการล่าสุด (ON CONFLICT แก้แถวเดิมซ้ำไม่ได้)
+                    saved = await conn.execute("""
+                        INSERT INTO batch_data.batch_json (project_id, json, created_at)
+                        SELECT DISTINCT ON (project_id) project_id, json, CURRENT_TIMESTAMP
+                        FROM batch_json_stage
+                        ORDER BY project_id, seq DESC
+                        ON CONFLICT (project_id)
+                        DO UPDATE SET
+                            json = EXCLUDED.json,
+                            created_at = CURRENT_TIMESTAMP;
+                    """, prepare=DB_PREPARE)
+
+                    delete_sql, insert_sql = document_requirements_sql("""(
+                        SELECT DISTINCT ON (project_id) project_id, json
+                        FROM batch_json_stage
+                        ORDER BY project_id, seq DESC
+                    )""")
+                    await conn.execute(delete_sql, prepare=DB_PREPARE)
+                    requirements = await conn.execute(insert_sql, prepare=DB_PREPARE)
+
+                    await conn.execute("""
+                        UPDATE batch_data.file_state f
+                        SET status = 'saved', reason = NULL, updated_at = CURRENT_TIMESTAMP
+                        FROM (SELECT DISTINCT project_id FROM batch_json_stage) s
+                        WHERE f.project_id = s.project_id;
+                    """, prepare=DB_PREPARE)
+                await conn.commit()
+                success_count, requirement_rows = saved.rowcount, requirements.rowcount
+            except Exception:
+                await conn.rollback()
+                raise
     except Exception as e:
         print(f"❌ Database Insert Error: {e}")
-        conn.rollback()
+        raise
     finally:
-        conn.close()
+        seconds = time.perf_counter() - start
+        metrics.observe("db_insert", seconds)
+        metrics.inc("rows_saved_total", success_count)
+        metrics.inc("requirement_rows_saved_total", requirement_rows)
+        metrics.event("db_insert", rows=len(results_list), saved=success_count,
+                      requirements=requirement_rows, seconds=round(seconds, 4))
     return success_count
 
-# ================= TEXT EXTRACTION LAYER =================
+# เวอร์ชัน sync ของ hot path สำหรับโค้ดที่รันใน thread (เช่น download_and_save_results) หรือเมนูแบบ sync
+# ทำงานผ่าน pool เดียวกับ event loop หลัก (ดู call_db)
 
-def clean_text(text):
-    text = re.sub(r'\s+', ' ', text)
-    return text.strip()
+def filter_new_project_ids(candidates):
+    return call_db(afilter_new_project_ids, candidates)
 
-def extract_evidence_section(pdf_path):
-    full_text = ""
-    try:
-        with pdfplumber.open(pdf_path) as pdf:
-            for page in pdf.pages:
-                text = page.extract_text()
-                if text:
-                    full_text += text + "\n"
-        
-        pattern = r"(๓\.\s*หลักฐานการยื่นข้อเสนอ.*?)(?=\n\s*๓\.๒|\n\s*3\.2|\n\s*ส่วนที่\s*๒)"
-        match = re.search(pattern, full_text, re.DOTALL)
-        
-        if match:
-            extracted_content = match.group(1)
-            extracted_content = re.sub(r"^๓\.\s*หลักฐานการยื่นข้อเสนอ", "", extracted_content).strip()
-            return clean_text(extracted_content)
-        else:
-            return None
-    except Exception as e:
-        return None
+def update_file_states(rows, status, batch_id=None, section_hashes=None):
+    return call_db(aupdate_file_states, rows, status, batch_id, section_hashes)
 
-# ================= ASYNC PROCESS (STEP 1) =================
+def update_section_states(rows, status, batch_id=None):
+    return call_db(aupdate_section_states, rows, status, batch_id)
 
-async def process_single_file(sem, filename, existing_ids):
-    async with sem:
-        project_id = os.path.splitext(filename)[0]
+def update_request_states(rows, status, batch_id=None):
+    return call_db(aupdate_request_states, rows, status, batch_id)
 
-        if SKIP_EXISTING and project_id in existing_ids:
-            return "SKIPPED"
+def fail_unsaved_batch_files(batch_id, reason):
+    return call_db(afail_unsaved_batch_files, batch_id, reason)
 
-        file_path = os.path.join(INPUT_FOLDER, filename)
-        extracted_text = await asyncio.to_thread(extract_evidence_section, file_path)
-
-        if not extracted_text:
-            return "REGEX_FAILED"
-
-        return {
-            "custom_id": filename,
-            "method": "POST",
-            "url": "/v1/chat/completions",
-            "body": {
-                "model": MODEL_NAME,
-                "messages": [
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": f"ข้อมูลเอกสาร:\n{extracted_text}"}
-                ],
-                "response_format": {"type": "json_object"},
-                "temperature": 0.1
-            }
-        }
+def save_results_to_db(results_list):
+    return call_db(asave_results_to_db, results_list)
 
-async def create_batch_file_async():
-    if not os.path.exists(INPUT_FOLDER):
-        print(f"❌ ไม่พบโฟลเดอร์ {INPUT_FOLDER}")
-        return None
+def get_inflight_batch_ids():
+    return call_db(aget_inflight_batch_ids)
 
-    pdf_files = [f for f in os.listdir(INPUT_FOLDER) if f.lower().endswith('.pdf')]
-    if not pdf_files:
-        print("❌ ไม่พบไฟล์ PDF")
-        return None
+# ================= WORK QUEUE =================
 
-    print("⏳ กำลังเตรียม Database...")
-    await asyncio.to_thread(init_db)
-    existing_ids = await asyncio.to_thread(get_all_existing_ids)
-    print(f"📋 พบข้อมูลเดิมใน DB {len(existing_ids)} รายการ")
+async def aenqueue_files(filenames):
+    """เพิ่มไฟล์เข้าคิว (status = discovered) ไฟล์ที่อยู่ในคิว / รอ coordinator / รอผล Batch อยู่แล้วจะไม่ถูกรีเซ็ต
+    คืนค่าจำนวนไฟล์ที่เข้าคิว"""
+    if not filenames:
+        return 0
+    async with get_db_pool().connection("enqueue_files") as conn:
+        cur = await conn.execute("""
+            INSERT INTO batch_data.file_state (project_id, filename, status, updated_at)
+            SELECT project_id, filename, 'discovered', CURRENT_TIMESTAMP
+            FROM unnest(%s::text[], %s::text[]) AS v(project_id, filename)
+            ON CONFLICT (project_id)
+            DO UPDATE SET
+                filename = EXCLUDED.filename,
+                status = 'discovered',
+                batch_id = NULL,
+                reason = NULL,
+                lease_owner = NULL,
+                lease_expires_at = NULL,
+                attempts = 0,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE file_state.status IN ('failed', 'saved');
+        """, ([os.path.splitext(f)[0] for f in filenames], list(filenames)), prepare=DB_PREPARE)
+        await conn.commit()
+        return cur.rowcount
+
+async def aclaim_work_items(worker_id, limit=WORK_CLAIM_SIZE):
+    """จองไฟล์ในคิวที่ยังไม่มีใครถือ (หรือ lease หมดอายุ) ด้วย FOR UPDATE SKIP LOCKED คืนค่า list ของ filename
+    ไฟล์ที่ถูกจองครบ WORK_MAX_ATTEMPTS ครั้งแล้ว lease ยังหมดอายุ (worker ล่มทุกครั้ง) จะถูก failed"""
+    async with get_db_pool().connection("claim_work") as conn:
+        await conn.execute("""
+            UPDATE batch_data.file_state
+            SET status = 'failed', reason = 'extract_attempts_exceeded',
+                lease_owner = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE status = 'discovered' AND attempts >= %s AND lease_expires_at < CURRENT_TIMESTAMP;
+        """, (WORK_MAX_ATTEMPTS,), prepare=DB_PREPARE)
+        cur = await conn.execute("""
+            UPDATE batch_data.file_state f
+            SET lease_owner = %s,
+                lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                attempts = f.attempts + 1,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE f.project_id IN (
+                SELECT project_id FROM batch_data.file_state
+                WHERE status = 'discovered'
+                  AND (lease_expires_at IS NULL OR lease_expires_at < CURRENT_TIMESTAMP)
+                  AND attempts < %s
+                ORDER BY updated_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING f.filename;
+        """, (worker_id, WORK_LEASE_SECONDS, WORK_MAX_ATTEMPTS, limit), prepare=DB_PREPARE)
+        filenames = [row[0] for row in await cur.fetchall()]
+        await conn.commit()
+        return filenames
+
+async def arenew_leases(worker_id):
+    """Heartbeat: ต่ออายุ lease ของทุกไฟล์ที่ worker นี้ถืออยู่ คืนค่าจำนวนไฟล์"""
+    async with get_db_pool().connection("renew_leases") as conn:
+        cur = await conn.execute("""
+            UPDATE batch_data.file_state
+            SET lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+            WHERE lease_owner = %s AND status = 'discovered';
+        """, (WORK_LEASE_SECONDS, worker_id), prepare=DB_PREPARE)
+        await conn.commit()
+        return cur.rowcount
+
+async def arelease_work_items(worker_id):
+    """คืนไฟล์ที่ยังสกัดไม่เสร็จให้ worker อื่นจองต่อได้ทันที (ตอนหยุด worker) ไม่นับเป็น attempt"""
+    async with get_db_pool().connection("release_work") as conn:
+        await conn.execute("""
+            UPDATE batch_data.file_state
+            SET lease_owner = NULL, lease_expires_at = NULL, attempts = greatest(attempts - 1, 0),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE lease_owner = %s AND status = 'discovered';
+        """, (worker_id,), prepare=DB_PREPARE)
+        await conn.commit()
+
+async def acomplete_work_items(worker_id, results, file_stats):
+    """บันทึกผลการสกัดของไฟล์ที่จองไว้ใน transaction เดียว
+    - สำเร็จ -> status extracted + เก็บ request ไว้ใน extracted_requests ให้ coordinator
+    - ล้มเหลว -> status failed พร้อมเหตุผล
+    อัปเดตเฉพาะไฟล์ที่ worker นี้ยังถือ lease อยู่ (ถ้า lease หมดและถูกจองใหม่ ผลนี้จะถูกทิ้ง)
+    คืนค่า (จำนวนสำเร็จ, จำนวนล้มเหลว)"""
+    extracted = [
+        (os.path.splitext(f)[0], file_stats[f]["section_hash"], json.dumps(res, ensure_ascii=False))
+        for f, res in results if isinstance(res, list)
+    ]
+    failed = [
+        (os.path.splitext(f)[0], failure_reason(res, file_stats.get(f)))
+        for f, res in results if isinstance(res, str) and res in FAILURE_REASONS
+    ]
+    async with get_db_pool().connection("complete_work") as conn:
+        owned = set()
+        if extracted:
+            project_ids, hashes, requests = (list(column) for column in zip(*extracted))
+            cur = await conn.execute("""
+                UPDATE batch_data.file_state f
+                SET status = 'extracted', section_hash = v.section_hash, reason = NULL,
+                    lease_owner = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+                FROM unnest(%s::text[], %s::text[]) AS v(project_id, section_hash)
+                WHERE f.project_id = v.project_id AND f.lease_owner = %s AND f.status = 'discovered'
+                RETURNING f.project_id;
+            """, (project_ids, hashes, worker_id), prepare=DB_PREPARE)
+            owned = {row[0] for row in await cur.fetchall()}
+            rows = [row for row in extracted if row[0] in owned]
+            if rows:
+                project_ids, hashes, requests = (list(column) for column in zip(*rows))
+                await conn.execute("""
+                    INSERT INTO batch_data.extracted_requests (project_id, section_hash, requests, created_at)
+                    SELECT project_id, section_hash, requests::jsonb, CURRENT_TIMESTAMP
+                    FROM unnest(%s::text[], %s::text[], %s::text[]) AS v(project_id, section_hash, requests)
+                    ON CONFLICT (project_id)
+                    DO UPDATE SET
+                        section_hash = EXCLUDED.section_hash,
+                        requests = EXCLUDED.requests,
+                        created_at = CURRENT_TIMESTAMP;
+                """, (project_ids, hashes, requests), prepare=DB_PREPARE)
+        failed_count = 0
+        if failed:
+            project_ids, reasons = (list(column) for column in zip(*failed))
+            cur = await conn.execute("""
+                UPDATE batch_data.file_state f
+                SET status = 'failed', reason = v.reason,
+                    lease_owner = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+                FROM unnest(%s::text[], %s::text[]) AS v(project_id, reason)
+                WHERE f.project_id = v.project_id AND f.lease_owner = %s AND f.status = 'discovered';
+            """, (project_ids, reasons, worker_id), prepare=DB_PREPARE)
+            failed_count = cur.rowcount
+        await conn.commit()
+        return len(owned), failed_count
+
+async def aget_extracted_backlog():
+    """คืนค่า (จำนวนไฟล์ที่สกัดเสร็จรอส่ง, วินาทีที่ไฟล์เก่าสุดรอ, จำนวนไฟล์ที่ยังอยู่ในคิว)"""
+    async with get_db_pool().connection("extracted_backlog") as conn:
+        cur = await conn.execute("""
+            SELECT count(*), extract(epoch FROM CURRENT_TIMESTAMP - min(r.created_at))
+            FROM batch_data.extracted_requests r
+            JOIN batch_data.file_state f ON f.project_id = r.project_id
+            WHERE f.status = 'extracted';
+        """, prepare=DB_PREPARE)
+        ready, oldest = await cur.fetchone()
+        cur = await conn.execute(
+            "SELECT count(*) FROM batch_data.file_state WHERE status = 'discovered';", prepare=DB_PREPARE
+        )
+        queued = (await cur.fetchone())[0]
+        return ready, float(oldest or 0), queued
+
+async def aload_extracted_requests(limit=BATCH_MAX_REQUESTS):
+    """อ่าน request ที่รอส่ง (ไฟล์ status extracted) ลบรายการของไฟล์ที่ส่ง/บันทึก/ล้มเหลวไปแล้ว
+    คืนค่า (tasks ของ Section ที่ไม่ซ้ำกัน, {section_hash: [filename]})"""
+    async with get_db_pool().connection("load_extracted") as conn:
+        await conn.execute("""
+            DELETE FROM batch_data.extracted_requests r
+            USING batch_data.file_state f
+            WHERE f.project_id = r.project_id AND f.status <> 'extracted';
+        """, prepare=DB_PREPARE)
+        cur = await conn.execute("""
+            SELECT f.filename, r.section_hash, r.requests
+            FROM batch_data.extracted_requests r
+            JOIN batch_data.file_state f ON f.project_id = r.project_id
+            WHERE f.status = 'extracted'
+            ORDER BY r.created_at
+            LIMIT %s;
+        """, (limit,), prepare=DB_PREPARE)
+        rows = await cur.fetchall()
+        await conn.commit()
 
-    print(f"🚀 เริ่มประมวลผล {len(pdf_files)} ไฟล์ (พร้อมกัน {CONCURRENT_LIMIT} threads)...")
-    
-    sem = asyncio.Semaphore(CONCURRENT_LIMIT)
     tasks = []
-    for filename in pdf_files:
-        tasks.append(process_single_file(sem, filename, existing_ids))
+    section_files = {}
+    for filename, digest, requests in rows:
+        if digest not in section_files:
+            tasks.extend(requests)
+        section_files.setdefault(digest, []).append(filename)
+    return tasks, section_files
 
-    results = await asyncio.gather(*tasks)
+async def aget_active_workers():
+    """คืนค่า list ของ (worker, จำนวนไฟล์ที่ถือ lease อยู่)"""
+    async with get_db_pool().connection("active_workers") as conn:
+        cur = await conn.execute("""
+            SELECT lease_owner, count(*) FROM batch_data.file_state
+            WHERE status = 'discovered' AND lease_expires_at > CURRENT_TIMESTAMP
+            GROUP BY lease_owner ORDER BY lease_owner;
+        """, prepare=DB_PREPARE)
+        return await cur.fetchall()
 
-    valid_tasks = []
-    skipped_count = 0
-    regex_failed_count = 0
+# ================= TEXT EXTRACTION LAYER =================
 
-    for res in results:
-        if res == "SKIPPED":
-            skipped_count += 1
-        elif res == "REGEX_FAILED":
-            regex_failed_count += 1
-        elif isinstance(res, dict):
-            valid_tasks.append(res)
+# Section 3 อยู่ระหว่างหัวข้อ "๓. หลักฐานการยื่นข้อเสนอ" และหัวข้อถัดไป (๓.๒ / 3.2 / ส่วนที่ ๒)
+SECTION_START_PATTERN = r"๓\.\s*หลักฐานการยื่นข้อเสนอ"
+SECTION_END_PATTERN = r"\n\s*๓\.๒|\n\s*3\.2|\n\s*ส่วนที่\s*๒"
+SECTION_START_RE = re.compile(SECTION_START_PATTERN)
+SECTION_END_RE = re.compile(SECTION_END_PATTERN)
+SECTION_RE = re.compile(rf"({SECTION_START_PATTERN}.*?)(?={SECTION_END_PATTERN})", re.DOTALL)
+SECTION_CARRY_CHARS = 200     # ความยาวท้ายหน้าที่เก็บไว้ต่อกับหน้าถัดไป
+SECTION_PAGE_HINT = None      # ช่วงหน้าที่คาดว่ามี Section 3 เช่น (1, 10) ค้นก่อนแล้วค่อยค้นทั้งไฟล์
 
-    print(f"\n--- สรุปผลการเตรียมข้อมูล ---")
-    print(f"⏩ ข้าม (มีใน DB แล้ว): {skipped_count}")
-    print(f"⚠️  ข้าม (หา Section ไม่เจอ): {regex_failed_count}")
-    print(f"✅ พร้อมส่ง (งานใหม่): {len(valid_tasks)}")
+# เพิ่มเลขนี้ทุกครั้งที่แก้ logic การสกัดที่ไม่ใช่ regex (regex ถูกนับรวมใน hash ให้อัตโนมัติ)
+EXTRACTOR_REVISION = 1
+EXTRACTOR_VERSION = hashlib.sha256(
+    f"{EXTRACTOR_REVISION}|{TEXT_BACKEND}|{SECTION_START_PATTERN}|{SECTION_END_PATTERN}".encode("utf-8")
+).hexdigest()[:12]
 
-    if not valid_tasks:
-        print("❌ ไม่มีงานใหม่ให้ส่ง")
-        return None
+# สระบน/ล่าง วรรณยุกต์ และสระอำ ต้องตามหลังพยัญชนะ (หรือเครื่องหมายอื่นในกลุ่มเดียวกัน) เสมอ
+THAI_COMBINING = "\u0E31\u0E33-\u0E3A\u0E47-\u0E4E"
+BROKEN_THAI_RE = re.compile(
+    rf"(?<![ก-ฮ{THAI_COMBINING}])[{THAI_COMBINING}]"  # สระ/วรรณยุกต์ลอยอยู่หน้าคำหรือหลังช่องว่าง
+    r"|[เแโใไ](?![ก-ฮ])"                               # สระหน้าไม่ได้ตามด้วยพยัญชนะ
+    r"|[\uF700-\uF71F\uFFFD]"                          # glyph ตำแหน่งพิเศษของฟอนต์ไทยรุ่นเก่า / อักขระที่แปลงไม่ได้
+)
+THAI_CHAR_RE = re.compile(r"[\u0E01-\u0E5B]")
 
-    with open(BATCH_FILE_NAME, "w", encoding="utf-8") as f:
-        for task in valid_tasks:
-            f.write(json.dumps(task, ensure_ascii=False) + "\n")
-            
-    print(f"💾 สร้างไฟล์ Batch เรียบร้อย: {BATCH_FILE_NAME}")
-    return BATCH_FILE_NAME
+class ExtractionTimeout(BaseException):
+    """สืบทอดจาก BaseException เพื่อไม่ให้ถูกกลืนโดย except Exception ภายใน extractor"""
 
-# ================= SHARED LOGIC (SUBMIT & PROCESS) =================
+class PdfBudgetExceeded(Exception):
+    """ไฟล์เกินงบหน้า/ขนาด/ความยาว Section ของ LOW_MEMORY_MODE ข้อความคือเหตุผลที่บันทึกใน file_state"""
 
-def upload_and_submit_batch(jsonl_file):
-    """ส่ง Batch ไป OpenAI และคืนค่า Batch ID"""
-    print("\n☁️  กำลังอัปโหลดและส่งคำสั่ง...")
+def _check_page_budget(stats, page_count):
+    stats["page_count"] = page_count
+    if LOW_MEMORY_MODE and MAX_PDF_PAGES and page_count > MAX_PDF_PAGES:
+        raise PdfBudgetExceeded(f"pdf_over_page_budget: {page_count} pages > {MAX_PDF_PAGES}")
+
+def clean_text(text):
+    text = re.sub(r'\s+', ' ', text)
+    return text.strip()
+
+def _pdfplumber_pages(pdf_path, page_range, stats):
+    with pdfplumber.open(pdf_path) as pdf:
+        pages = pdf.pages
+        _check_page_budget(stats, len(pages))
+        first, last = page_range or (1, len(pages))
+        for page in pages[max(first, 1) - 1:min(last, len(pages))]:
+            try:
+                yield page.extract_text() or ""
+            finally:
+                if LOW_MEMORY_MODE:
+                    # pdfplumber เก็บ object ของทุกหน้าไว้จนกว่าจะปิดไฟล์ ล้าง cache ทิ้งทันทีที่อ่านเสร็จ
+                    page.close()
+
+def _pdfium_pages(pdf_path, page_range, stats):
+    pdf = pdfium.PdfDocument(pdf_path)
     try:
-        batch_input_file = client.files.create(
-            file=open(jsonl_file, "rb"),
-            purpose="batch"
-        )
-        
-        batch_job = client.batches.create(
-            input_file_id=batch_input_file.id,
-            endpoint="/v1/chat/completions",
-            completion_window="24h"
-        )
-        
-        with open(BATCH_ID_LOG, "w") as f:
-            f.write(batch_job.id)
-            
-        print(f"✅ ส่งคำสั่งสำเร็จ! Batch ID: {batch_job.id}")
-        return batch_job.id
-        
-    except Exception as e:
-        print(f"❌ Submit Error: {e}")
-        return None
+        _check_page_budget(stats, len(pdf))
+        first, last = page_range or (1, len(pdf))
+        for index in range(max(first, 1) - 1, min(last, len(pdf))):
+            page = pdf[index]
+            textpage = page.get_textpage()
+            try:
+                yield textpage.get_text_range().replace("\r\n", "\n")
+            finally:
+                textpage.close()
+                page.close()
+    finally:
+        pdf.close()
 
-def download_and_save_results(batch_id):
-    """โหลดผลลัพธ์และบันทึกลง DB"""
-    print(f"⬇️  กำลังดาวน์โหลดผลลัพธ์ (ID: {batch_id})...")
+def _pdfminer_pages(pdf_path, page_range, stats):
+    resources = PDFResourceManager()
+    with open(pdf_path, "rb") as fp:
+        document = PDFDocument(PDFParser(fp))
+        page_count = resolve1(document.catalog["Pages"]).get("Count", 0)
+        _check_page_budget(stats, page_count)
+        first, last = page_range or (1, page_count)
+        for page_no, page in enumerate(PDFPage.create_pages(document), 1):
+            if page_no < first:
+                continue
+            if page_no > last:
+                break
+            output = io.StringIO()
+            device = TextConverter(resources, output, laparams=LAParams())
+            try:
+                PDFPageInterpreter(resources, device).process_page(page)
+            finally:
+                device.close()
+            yield output.getvalue()
+
+PAGE_TEXT_BACKENDS = {
+    "pdfium": _pdfium_pages,
+    "pdfminer": _pdfminer_pages,
+    "pdfplumber": _pdfplumber_pages,
+}
+
+def _iter_page_texts(pdf_path, page_range=None, stats=None, backend="pdfplumber"):
+    """อ่านข้อความทีละหน้า (lazy) page_range เป็นเลขหน้าแบบเริ่มที่ 1 เช่น (1, 10)
+    เวลาที่ใช้ใน PDF library สะสมไว้ใน stats["pdf_parse_seconds"]"""
+    stats = stats if stats is not None else {}
+    pages = PAGE_TEXT_BACKENDS[backend](pdf_path, page_range, stats)
     try:
-        batch_job = client.batches.retrieve(batch_id)
-        content = client.files.content(batch_job.output_file_id).text
-        
-        lines = content.strip().split('\n')
-        data_to_save = []
-        
-        for line in lines:
+        while True:
+            start = time.perf_counter()
             try:
-                data = json.loads(line)
-                filename = data['custom_id']
-                project_id = os.path.splitext(filename)[0]
-                
-                response_body = data['response']['body']
-                if 'choices' in response_body:
-                    ai_content = response_body['choices'][0]['message']['content']
-                    parsed_json = json.loads(ai_content)
-                    
-                    data_to_save.append({
-                        "id": project_id,
-                        "data": parsed_json
-                    })
-            except Exception as e:
-                print(f"   ❌ Parse Error: {e}")
-        
-        if data_to_save:
-            print(f"💾 กำลังบันทึก {len(data_to_save)} รายการลง Database...")
-            saved_count = save_results_to_db(data_to_save)
-            print(f"✅ บันทึกเสร็จสิ้น {saved_count} รายการ")
-            return True
-    except Exception as e:
-        print(f"❌ Save Error: {e}")
+                text = next(pages)
+            except StopIteration:
+                return
+            finally:
+                stats["pdf_parse_seconds"] = stats.get("pdf_parse_seconds", 0) + time.perf_counter() - start
+            yield text
+    finally:
+        pages.close()
+
+def looks_broken_thai(text):
+    """ตรวจข้อความไทยที่ลำดับสระ/วรรณยุกต์เพี้ยน (มักเกิดจากฟอนต์ที่ไม่มี ToUnicode ที่ถูกต้อง)"""
+    thai_chars = len(THAI_CHAR_RE.findall(text))
+    if not thai_chars:
         return False
+    return len(BROKEN_THAI_RE.findall(text)) > max(2, thai_chars * THAI_BROKEN_RATIO)
 
-# ================= OPTION 3: AUTO PILOT =================
+def scan_evidence_section(page_texts, stats=None):
+    """ค้นหา Section 3 ทีละหน้า และหยุดอ่านทันทีเมื่อเจอหัวข้อถัดไป (end marker)
+    รองรับกรณีหัวข้อหรือเนื้อหาถูกตัดข้ามหน้า เพราะต่อข้อความหน้าเดิมไว้ใน buffer"""
+    buffer = ""
+    found_start = False
+    end_search_from = 0
+    pages_parsed = 0
 
-async def run_auto_pilot():
-    print("\n" + "="*40)
-    print("   🚀 STARTING AUTO PILOT MODE")
-    print("="*40)
-    
-    # 1. Prepare & Submit
-    jsonl_path = await create_batch_file_async()
-    if not jsonl_path:
+    try:
+        for text in page_texts:
+            pages_parsed += 1
+            buffer += text + "\n"
+
+            if not found_start:
+                start_match = SECTION_START_RE.search(buffer)
+                if not start_match:
+                    # ยังไม่เจอหัวข้อ: เก็บไว้แค่ท้าย buffer เผื่อหัวข้อถูกตัดข้ามหน้า
+                    buffer = buffer[-SECTION_CARRY_CHARS:]
+                    continue
+                buffer = buffer[start_match.start():]
+                found_start = True
+
+            if SECTION_END_RE.search(buffer, end_search_from):
+                break
+            if LOW_MEMORY_MODE and len(buffer) > SECTION_MAX_CHARS:
+                # ไม่เจอ end marker ภายใน window แปลว่าไม่ใช่ Section 3 ปกติ หยุดก่อน buffer โตไม่จำกัด
+                raise PdfBudgetExceeded(f"section_over_{SECTION_MAX_CHARS}_chars")
+            # end marker อาจเริ่มก่อนรอยต่อหน้าเล็กน้อย จึงย้อนกลับไปค้นเผื่อไว้
+            end_search_from = max(0, len(buffer) - SECTION_CARRY_CHARS)
+    finally:
+        if stats is not None:
+            stats["pages_parsed"] = stats.get("pages_parsed", 0) + pages_parsed
+
+    match = SECTION_RE.search(buffer) if found_start else None
+    if not match:
+        return None
+    extracted_content = SECTION_START_RE.sub("", match.group(1), count=1).strip()
+    return clean_text(extracted_content)
+
+def _scan_pdf(pdf_path, page_range, stats, backend):
+    if page_range:
+        result = scan_evidence_section(_iter_page_texts(pdf_path, page_range, stats, backend), stats)
+        if result:
+            return result
+    return scan_evidence_section(_iter_page_texts(pdf_path, None, stats, backend), stats)
+
+def extract_evidence_section(pdf_path, page_range=SECTION_PAGE_HINT, stats=None, backend=None, fallback=True):
+    """สกัด Section 3 จาก PDF ถ้ามี page_range จะค้นในช่วงนั้นก่อน แล้วค่อยค้นทั้งไฟล์ถ้าไม่เจอ
+    ใช้ backend เร็ว (TEXT_BACKEND) ก่อน แล้วกลับไปใช้ pdfplumber ถ้าหาไม่เจอ, ภาษาไทยเพี้ยน หรือเปิดไฟล์ไม่ได้
+    stats (dict) จะถูกเติม page_count, pages_parsed, chars, text_backend, fallback และเวลา pdf_parse_seconds / regex_seconds
+    ถ้าไฟล์เกินงบของ LOW_MEMORY_MODE จะคืน None และใส่เหตุผลไว้ใน stats["skip_reason"]
+    ถ้าเปิด/อ่านไฟล์ไม่ได้ จะคืน None และใส่ข้อความ error ไว้ใน stats["extract_error"]"""
+    stats = stats if stats is not None else {}
+    backend = backend or TEXT_BACKEND
+    start = time.perf_counter()
+    result = None
+    fallback_reason = None
+    try:
+        if LOW_MEMORY_MODE and MAX_PDF_MB and os.path.getsize(pdf_path) > MAX_PDF_MB * 1024 * 1024:
+            raise PdfBudgetExceeded(f"pdf_over_byte_budget: {os.path.getsize(pdf_path) // (1024 * 1024)} MB > {MAX_PDF_MB} MB")
+        try:
+            result = _scan_pdf(pdf_path, page_range, stats, backend)
+            if not result:
+                fallback_reason = "no_match"
+            elif looks_broken_thai(result):
+                fallback_reason = "broken_thai"
+        except PdfBudgetExceeded:
+            raise
+        except Exception as e:
+            result = None
+            fallback_reason = "error"
+            stats["extract_error"] = f"{type(e).__name__}: {e}"
+        stats["text_backend"] = backend
+
+        if fallback and fallback_reason and backend != "pdfplumber":
+            stats["fallback"] = fallback_reason
+            stats["text_backend"] = "pdfplumber"
+            try:
+                result = _scan_pdf(pdf_path, page_range, stats, "pdfplumber")
+                stats.pop("extract_error", None)  # pdfplumber อ่านได้ ถือว่าผลนี้เชื่อถือได้
+            except PdfBudgetExceeded:
+                raise
+            except Exception as e:
+                result = None
+                stats["extract_error"] = f"{type(e).__name__}: {e}"
+    except PdfBudgetExceeded as e:
+        result = None
+        stats["skip_reason"] = str(e)
+    finally:
+        elapsed = time.perf_counter() - start
+        stats["regex_seconds"] = max(0.0, elapsed - stats.get("pdf_parse_seconds", 0))
+        stats["chars"] = len(result or "")
+    return result
+
+# ================= EXTRACTION CACHE =================
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _extract_cache_path(digest):
+    return os.path.join(EXTRACT_CACHE_DIR, EXTRACTOR_VERSION, digest[:2], f"{digest}.json")
+
+def extract_cache_get(digest):
+    """คืนค่า (hit, text) โดย text เป็น None หมายถึงเคยสกัดแล้วไม่เจอ Section"""
+    path = _extract_cache_path(digest)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+        os.utime(path)  # อัปเดตเวลาใช้งานล่าสุด สำหรับ LRU eviction
+        return True, entry.get("text")
+    except (OSError, ValueError):
+        return False, None
+
+def extract_cache_put(digest, text):
+    path = _extract_cache_path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"status": "match" if text else "no_match", "text": text}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)  # เขียนแบบ atomic กันหลาย worker เขียนชนกัน
+
+def extract_section_cached(pdf_path, stats=None):
+    """ห่อ extract_evidence_section ด้วย cache ไฟล์ที่ไม่เปลี่ยนจะไม่ต้องเปิดด้วย pdfplumber อีก
+    เวลารวมของไฟล์ (รวม hash และอ่าน/เขียน cache) อยู่ใน stats["extract_file_seconds"]"""
+    stats = stats if stats is not None else {}
+    start = time.perf_counter()
+    try:
+        if not EXTRACT_CACHE_ENABLED:
+            return extract_evidence_section(pdf_path, stats=stats)
+
+        digest = file_sha256(pdf_path)
+        hit, text = extract_cache_get(digest)
+        stats["cache"] = "hit" if hit else "miss"
+        if hit:
+            stats["chars"] = len(text or "")
+            return text
+
+        text = extract_evidence_section(pdf_path, stats=stats)
+        if not stats.get("skip_reason") and not stats.get("extract_error"):
+            # เก็บ cache เฉพาะผลจริง (เจอ/ไม่เจอ Section) ไฟล์ที่ถูกข้ามเพราะเกินงบหรืออ่านไม่ได้
+            # ไม่เก็บ เผื่อปรับงบหรือแก้ปัญหาชั่วคราวแล้วรันใหม่
+            extract_cache_put(digest, text)
+        return text
+    finally:
+        stats["extract_file_seconds"] = time.perf_counter() - start
+
+def prune_extract_cache():
+    """ลบ cache ของ extractor เวอร์ชันเก่า แล้วลบไฟล์ที่ใช้งานนานที่สุดจนขนาดรวมไม่เกิน EXTRACT_CACHE_MAX_MB"""
+    if not os.path.isdir(EXTRACT_CACHE_DIR):
+        return 0
+
+    removed = 0
+    for name in os.listdir(EXTRACT_CACHE_DIR):
+        if name != EXTRACTOR_VERSION:
+            shutil.rmtree(os.path.join(EXTRACT_CACHE_DIR, name), ignore_errors=True)
+
+    entries = []
+    total_size = 0
+    for root, _, files in os.walk(os.path.join(EXTRACT_CACHE_DIR, EXTRACTOR_VERSION)):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total_size += st.st_size
+
+    max_bytes = EXTRACT_CACHE_MAX_MB * 1024 * 1024
+    entries.sort()
+    for _, size, path in entries:
+        if total_size <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_size -= size
+        removed += 1
+    return removed
+
+# ================= PROCESS POOL ENGINE =================
+
+def _raise_extraction_timeout(signum, frame):
+    raise ExtractionTimeout()
+
+def extract_chunk_worker(file_paths, timeout=EXTRACT_TIMEOUT, progress=None):
+    """รันใน worker process: สกัดข้อความทีละไฟล์ในกลุ่ม
+    คืนค่าเป็น list ของ tuple (filename, text, error, stats) ซึ่ง pickle ได้เร็วกว่า object ใหญ่ๆ
+    progress (dict ของ Manager) ได้รับผลของแต่ละไฟล์ทันทีที่เสร็จ ให้ parent เก็บผลไว้ได้แม้ worker ถูกฆ่ากลาง chunk"""
+    use_alarm = hasattr(signal, "SIGALRM")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_extraction_timeout)
+
+    results = []
+    for path in file_paths:
+        filename = os.path.basename(path)
+        stats = {}
+        try:
+            if use_alarm:
+                signal.alarm(timeout)
+            text = extract_section_cached(path, stats=stats)
+            results.append((filename, text, None, stats))
+        except ExtractionTimeout:
+            results.append((filename, None, "TIMEOUT", stats))
+        finally:
+            if use_alarm:
+                signal.alarm(0)
+        if progress is not None:
+            progress[filename] = results[-1]
+    return results
+
+def _new_extract_pool():
+    # max_tasks_per_child นับเป็นจำนวน "งาน" (chunk) ไม่ใช่จำนวนไฟล์
+    tasks_per_child = max(1, FILES_PER_WORKER // PROCESS_CHUNK_SIZE)
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=PROCESS_WORKERS,
+        max_tasks_per_child=tasks_per_child
+    )
+
+def _kill_extract_pool(pool):
+    """ฆ่า worker ทั้งหมดของ pool (ใช้เมื่อ worker ค้างในโค้ด C จน SIGALRM ไม่ทำงาน)"""
+    for proc in list((pool._processes or {}).values()):
+        proc.kill()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+# Process Pool และ dict ความคืบหน้าใช้ตลอดอายุ process (daemon / worker เรียก extract_with_process_pool ทุกรอบ
+# โดยไม่ต้องเสียเวลาเริ่ม interpreter ใหม่) pool ถูกสร้างใหม่เฉพาะเมื่อต้องฆ่า worker ที่ค้าง
+_extract_pool = {"pool": None, "manager": None, "progress": None, "slots": None, "slots_loop": None}
+
+def get_extract_pool():
+    """คืนค่า (pool, progress) ที่ใช้ร่วมกันทั้ง process สร้างเมื่อเรียกครั้งแรก"""
+    if _extract_pool["manager"] is None:
+        _extract_pool["manager"] = multiprocessing.Manager()
+        _extract_pool["progress"] = _extract_pool["manager"].dict()
+        atexit.register(shutdown_extract_pool)
+    if _extract_pool["pool"] is None:
+        _extract_pool["pool"] = _new_extract_pool()
+    return _extract_pool["pool"], _extract_pool["progress"]
+
+def _extract_slots():
+    """Semaphore จำนวน PROCESS_WORKERS ที่ใช้ร่วมกันทุกการเรียก extract_with_process_pool ใน event loop เดียวกัน
+    (daemon อาจสกัดหลายกลุ่มพร้อมกัน) chunk จึงไม่ต่อคิวใน pool จน deadline ของไฟล์หมดก่อน worker ได้เริ่ม"""
+    loop = asyncio.get_running_loop()
+    if _extract_pool["slots_loop"] is not loop:
+        _extract_pool["slots"] = asyncio.Semaphore(PROCESS_WORKERS)
+        _extract_pool["slots_loop"] = loop
+    return _extract_pool["slots"]
+
+def _replace_extract_pool(pool):
+    """ฆ่า pool ที่มี worker ค้าง/พัง (ถ้ายังไม่ถูกแทนที่โดยงานอื่น) ครั้งถัดไปที่เรียก get_extract_pool จะได้ pool ใหม่"""
+    if _extract_pool["pool"] is pool:
+        _extract_pool["pool"] = None
+        _kill_extract_pool(pool)
+
+def shutdown_extract_pool():
+    if _extract_pool["pool"] is not None:
+        _extract_pool["pool"].shutdown(wait=True)
+        _extract_pool["pool"] = None
+    if _extract_pool["manager"] is not None:
+        _extract_pool["manager"].shutdown()
+        _extract_pool["manager"] = _extract_pool["progress"] = None
+
+async def extract_with_process_pool(filenames):
+    """สกัดข้อความด้วย Process Pool แบบแบ่ง chunk คืนค่า dict {filename: (text, error, stats)}
+    แต่ละไฟล์มีเวลาไม่เกิน hard_timeout (นับใหม่ทุกครั้งที่ worker รายงานไฟล์เสร็จผ่าน progress)
+    ถ้า worker ค้างจนต้องฆ่า: ไฟล์ที่เสร็จแล้วใน chunk นั้นใช้ผลเดิม, เฉพาะไฟล์ที่ค้างเป็น TIMEOUT, ไฟล์ที่ยังไม่ได้เริ่มถูกส่งใหม่
+    chunk อื่นที่ถูกฆ่าไปด้วย (ไม่ได้ค้างเอง) ส่งไฟล์ที่เหลือใหม่ทั้งหมดโดยไม่นับเป็นความผิดพลาด"""
+    loop = asyncio.get_running_loop()
+    chunks = [filenames[i:i + PROCESS_CHUNK_SIZE] for i in range(0, len(filenames), PROCESS_CHUNK_SIZE)]
+    # ส่งงานไม่เกินจำนวน worker เพื่อให้ timeout นับจากเวลาที่ worker เริ่มทำงานจริง
+    sem = _extract_slots()
+    # เผื่อเวลาให้ SIGALRM ใน worker ทำงานก่อน แล้วค่อยฆ่าจากฝั่ง parent
+    hard_timeout = EXTRACT_TIMEOUT + 30
+
+    async def wait_chunk(future, remaining, progress):
+        """รอผลของ chunk คืนค่า list ผลลัพธ์ หรือ raise asyncio.TimeoutError เมื่อไฟล์ปัจจุบันใช้เวลาเกิน hard_timeout"""
+        done_count = 0
+        deadline = loop.time() + hard_timeout
+        while True:
+            finished, _ = await asyncio.wait({future}, timeout=min(1, max(0, deadline - loop.time())))
+            if finished:
+                return future.result()
+            # worker ทำไฟล์ตามลำดับ: ไฟล์ถัดไปเสร็จแล้ว = เริ่มนับเวลาของไฟล์ใหม่
+            while done_count < len(remaining) and remaining[done_count] in progress:
+                done_count += 1
+                deadline = loop.time() + hard_timeout
+            if loop.time() >= deadline:
+                future.cancel()
+                raise asyncio.TimeoutError
+
+    async def run_chunk(chunk):
+        results = []
+        remaining = list(chunk)
+        crashes = 0  # จำนวนครั้งที่ pool พังระหว่างทำไฟล์ remaining[0] โดยไม่มี chunk อื่นค้าง
+        async with sem:
+            while remaining:
+                pool, progress = get_extract_pool()
+                paths = [os.path.join(INPUT_FOLDER, f) for f in remaining]
+                try:
+                    future = loop.run_in_executor(pool, extract_chunk_worker, paths, EXTRACT_TIMEOUT, progress)
+                    results += await wait_chunk(future, remaining, progress)
+                    break
+                except (asyncio.TimeoutError, BrokenProcessPool) as e:
+                    # pool ถูกแทนที่ไปแล้ว = chunk อื่นฆ่า worker ทิ้งเพราะไฟล์ของตัวเองค้าง
+                    killed_by_other = _extract_pool["pool"] is not pool
+                    _replace_extract_pool(pool)
+                    # worker ทำไฟล์ตามลำดับ ผลที่อยู่ใน progress จึงเป็นไฟล์ช่วงต้นของ remaining
+                    done = []
+                    for f in remaining:
+                        if f not in progress:
+                            break
+                        done.append(progress[f])
+                    results += done
+                    remaining = remaining[len(done):]
+                    if done:
+                        crashes = 0
+                    if not remaining:
+                        break
+                    if isinstance(e, asyncio.TimeoutError):
+                        print(f"   ⏱️ Worker ค้าง ฆ่าทิ้งแล้วสร้างใหม่: {remaining[0]}")
+                        results.append((remaining[0], None, "TIMEOUT", {}))
+                        remaining = remaining[1:]
+                    elif not killed_by_other:
+                        # worker ตายเอง (เช่น crash ในโค้ด C) ลองใหม่ 1 ครั้ง ถ้าพังที่ไฟล์เดิมอีกถือว่าไฟล์นั้นเสีย
+                        crashes += 1
+                        if crashes > 1:
+                            print(f"   💥 Worker พังซ้ำที่ไฟล์เดิม ข้าม: {remaining[0]}")
+                            results.append((remaining[0], None, "TIMEOUT", {}))
+                            remaining = remaining[1:]
+                            crashes = 0
+            for f in chunk:
+                progress.pop(f, None)
+        return results
+
+    chunk_results = await asyncio.gather(*(run_chunk(c) for c in chunks))
+    return {
+        filename: (text, error, stats)
+        for chunk_result in chunk_results
+        for filename, text, error, stats in chunk_result
+    }
+
+# ================= TOKEN ACCOUNTING =================
+
+@functools.lru_cache(maxsize=1)
+def _get_encoding():
+    try:
+        try:
+            return tiktoken.encoding_for_model(MODEL_NAME)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # ครั้งแรก tiktoken ต้องดาวน์โหลดไฟล์ encoding (เครื่อง offline ให้ตั้ง TIKTOKEN_CACHE_DIR ไว้ล่วงหน้า)
+        print(f"⚠️  โหลด tiktoken encoding ไม่ได้ ({type(e).__name__}) ใช้ค่าประมาณ {CHARS_PER_TOKEN} ตัวอักษร/token แทน")
+        return None
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+@functools.lru_cache(maxsize=1)
+def shared_prefix_tokens():
+    # system prompt + prefix ข้อความ user เหมือนกันทุก request นับครั้งเดียวพอ
+    return count_tokens(SYSTEM_PROMPT) + count_tokens(USER_MESSAGE_PREFIX)
+
+def request_tokens(body):
+    """จำนวน input token ของ 1 request (ไม่รวม overhead เล็กน้อยของ chat format)"""
+    section = body["messages"][-1]["content"][len(USER_MESSAGE_PREFIX):]
+    return shared_prefix_tokens() + count_tokens(section)
+
+def split_by_tokens(text, max_tokens):
+    """แบ่งข้อความเป็นส่วนๆ ที่แต่ละส่วนไม่เกิน max_tokens"""
+    encoding = _get_encoding()
+    if encoding is None:
+        size = max_tokens * CHARS_PER_TOKEN
+        return [text[i:i + size] for i in range(0, len(text), size)]
+    tokens = encoding.encode(text)
+    return [
+        # ตัดตรงกลางตัวอักษรได้ (UTF-8 หลาย byte) จึง decode แบบ ignore
+        encoding.decode_bytes(tokens[i:i + max_tokens]).decode("utf-8", errors="ignore")
+        for i in range(0, len(tokens), max_tokens)
+    ]
+
+def section_hash(text):
+    """hash ของข้อความ Section 3 หลัง normalize ช่องว่าง รวม MODEL_NAME และ PROMPT_VERSION (ไฟล์ที่ได้ hash เดียวกันใช้ผลร่วมกัน)"""
+    return hashlib.sha256(f"{MODEL_NAME}|{PROMPT_VERSION}|{clean_text(text)}".encode("utf-8")).hexdigest()
+
+def section_request_id(digest):
+    return f"{SECTION_ID_PREFIX}{digest}"
+
+def request_section_hash(request_id):
+    """คืนค่า hash จาก request_id แบบ sec:<hash> หรือ None ถ้าเป็น request ของไฟล์เดียว (เวอร์ชันก่อน)"""
+    return request_id[len(SECTION_ID_PREFIX):] if request_id.startswith(SECTION_ID_PREFIX) else None
+
+def make_custom_id(filename, part=1, parts=1):
+    return filename if parts == 1 else f"{filename}#p{part}of{parts}"
+
+def parse_custom_id(custom_id):
+    """คืนค่า (filename, part, parts) จาก custom_id"""
+    match = re.match(r"^(.*)#p(\d+)of(\d+)$", custom_id)
+    if not match:
+        return custom_id, 1, 1
+    return match.group(1), int(match.group(2)), int(match.group(3))
+
+def _merge_values(a, b):
+    if isinstance(a, dict) and isinstance(b, dict):
+        return {key: _merge_values(a.get(key), b.get(key)) for key in {**a, **b}}
+    if isinstance(a, list) and isinstance(b, list):
+        return a + [item for item in b if item not in a]
+    return a if a not in (None, "", []) else b
+
+def collect_part_result(partials, row):
+    """สะสมผลลัพธ์ของ request ที่ถูกแบ่ง (split) คืนค่า row ที่รวมครบทุกส่วนแล้ว หรือ None ถ้ายังไม่ครบ"""
+    if row["parts"] == 1:
+        return row
+    received = partials.setdefault(row["id"], {})
+    received[row["part"]] = row["data"]
+    if len(received) < row["parts"]:
+        return None
+    del partials[row["id"]]
+    merged = functools.reduce(_merge_values, (received[i] for i in sorted(received)))
+    return {"id": row["id"], "data": merged, "part": 1, "parts": 1}
+
+def summarize_request_tokens(tasks):
+    """แสดงสรุป token (รวม / p50 / p99) และค่าใช้จ่ายโดยประมาณก่อนส่ง Batch"""
+    if not tasks:
         return
+    counts = sorted(request_tokens(task["body"]) for task in tasks)
+    total = sum(counts)
+    p50 = counts[(len(counts) - 1) // 2]
+    p99 = counts[int((len(counts) - 1) * 0.99)]
+    cost = (total * PRICE_INPUT_PER_1M + len(counts) * EST_OUTPUT_TOKENS * PRICE_OUTPUT_PER_1M) / 1_000_000
+    source = "tiktoken" if _get_encoding() else f"ประมาณ {CHARS_PER_TOKEN} ตัวอักษร/token"
+    print(f"\n--- 🧮 สรุป Token ({source}) ---")
+    print(f"   Requests: {len(counts)} | รวม {total:,} tokens | p50 {p50:,} | p99 {p99:,} | สูงสุด {counts[-1]:,}")
+    print(f"   ค่าใช้จ่ายโดยประมาณ: ${cost * BATCH_DISCOUNT:,.2f} (Batch) / ${cost:,.2f} (Realtime)")
+
+# ================= ASYNC PROCESS (STEP 1) =================
+
+def build_batch_request(custom_id, extracted_text):
+    # system prompt ต้องอยู่ก่อนและเหมือนกันทุก byte ในทุก request เพื่อให้ provider cache prefix ได้
+    # ข้อมูลเฉพาะไฟล์จึงอยู่ใน user message เท่านั้น
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": MODEL_NAME,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": f"{USER_MESSAGE_PREFIX}{extracted_text}"}
+            ],
+            "response_format": {"type": "json_object"},
+            "temperature": 0.1
+        }
+    }
+
+async def process_single_file(sem, filename, skip_ids, file_stats):
+    async with sem:
+        project_id = os.path.splitext(filename)[0]
+
+        if project_id in skip_ids:
+            return "SKIPPED"
+
+        file_path = os.path.join(INPUT_FOLDER, filename)
+        stats = file_stats.setdefault(filename, {})
+        start = time.perf_counter()
+        extracted_text = await asyncio.to_thread(extract_section_cached, file_path, stats=stats)
+        if extracted_text:
+            stats["section_hash"] = section_hash(extracted_text)
+            result = prepare_requests(section_request_id(stats["section_hash"]), extracted_text)
+        else:
+            result = "TOO_LARGE" if stats.get("skip_reason") else "REGEX_FAILED"
+        record_file_metrics(filename, result, stats, time.perf_counter() - start)
+        return result
+
+def prepare_requests(request_id, extracted_text):
+    """สร้าง request ตามนโยบาย OVERSIZE_POLICY คืนค่า list ของ request หรือ "OVERSIZED" ถ้าข้าม
+    request_id คือ filename หรือ sec:<hash> ใช้เป็น custom_id (ต่อท้าย #pNofM เมื่อแบ่ง)"""
+    if count_tokens(extracted_text) <= MAX_SECTION_TOKENS:
+        return [build_batch_request(request_id, extracted_text)]
+
+    if OVERSIZE_POLICY == "skip":
+        return "OVERSIZED"
+
+    parts = split_by_tokens(extracted_text, MAX_SECTION_TOKENS)
+    if OVERSIZE_POLICY == "split":
+        return [
+            build_batch_request(make_custom_id(request_id, i, len(parts)), part)
+            for i, part in enumerate(parts, 1)
+        ]
+    # truncate: ใช้เฉพาะส่วนแรก
+    return [build_batch_request(request_id, parts[0])]
+
+# ผลลัพธ์จาก process_single_file ที่ถือว่าล้มเหลว -> เหตุผลที่บันทึกใน file_state
+FAILURE_REASONS = {
+    "REGEX_FAILED": "section_not_found",
+    "TIMEOUT": "extract_timeout",
+    "OVERSIZED": f"section_over_{MAX_SECTION_TOKENS}_tokens",
+    "TOO_LARGE": "pdf_over_budget",  # เหตุผลละเอียดอยู่ใน stats["skip_reason"]
+}
+
+def failure_reason(result, stats):
+    stats = stats or {}
+    if stats.get("skip_reason"):
+        return stats["skip_reason"]
+    if result == "REGEX_FAILED" and stats.get("extract_error"):
+        return "extract_error"  # อ่านไฟล์ไม่ได้ ไม่ใช่ไม่มี Section
+    return FAILURE_REASONS[result]
+
+async def process_files_in_pool(pdf_files, skip_ids, file_stats):
+    """เวอร์ชัน Process Pool ของ process_single_file คืนค่าผลลัพธ์รูปแบบเดียวกัน (เรียงตาม pdf_files)"""
+    pending = [f for f in pdf_files if os.path.splitext(f)[0] not in skip_ids]
+    extracted = await extract_with_process_pool(pending)
+
+    results = []
+    for filename in pdf_files:
+        if filename not in extracted:
+            results.append("SKIPPED")
+            continue
+        text, error, stats = extracted[filename]
+        file_stats[filename] = stats
+        if error == "TIMEOUT":
+            result = "TIMEOUT"
+        elif stats.get("skip_reason"):
+            result = "TOO_LARGE"
+        elif not text:
+            result = "REGEX_FAILED"
+        else:
+            stats["section_hash"] = section_hash(text)
+            result = prepare_requests(section_request_id(stats["section_hash"]), text)
+        record_file_metrics(filename, result, stats, stats.get("extract_file_seconds", 0))
+        results.append(result)
+    return results
+
+async def aplan_section_requests(tasks, section_files):
+    """ลด request ของ Section ที่ซ้ำกัน tasks คือ request ของ Section ที่ไม่ซ้ำกัน (custom_id = sec:<hash>)
+    และ section_files คือ {hash: [filename, ...]} ของไฟล์ที่สถานะ extracted แล้ว
+    - Section ที่มีผลใน section_results แล้ว -> บันทึกให้ทุกไฟล์ทันทีโดยไม่ส่ง request
+    - Section ที่รอผลจาก Batch อื่นอยู่ -> ผูกไฟล์เข้ากับ Batch นั้น แล้วรับผลตอน Batch นั้นเสร็จ
+    คืนค่า tasks ที่ต้องส่งจริง"""
+    if not section_files:
+        return tasks
+    hashes = list(section_files)
+    async with get_db_pool().connection("plan_sections") as conn:
+        cur = await conn.execute("""
+            SELECT section_hash, json FROM batch_data.section_results
+            WHERE section_hash = ANY(%s);
+        """, (hashes,), prepare=DB_PREPARE)
+        cached = await cur.fetchall()
+        cur = await conn.execute("""
+            SELECT DISTINCT ON (section_hash) section_hash, batch_id
+            FROM batch_data.file_state
+            WHERE section_hash = ANY(%s) AND status = 'submitted' AND batch_id IS NOT NULL
+            ORDER BY section_hash, updated_at DESC;
+        """, (hashes,), prepare=DB_PREPARE)
+        inflight = {digest: batch_id for digest, batch_id in await cur.fetchall()}
+    reused_files = await asave_results_to_db(
+        [{"id": section_request_id(digest), "data": data} for digest, data in cached]
+    ) if cached else 0
+
+    cached_hashes = {digest for digest, _ in cached}
+    inflight = {digest: batch_id for digest, batch_id in inflight.items() if digest not in cached_hashes}
+    for batch_id in set(inflight.values()):
+        await aupdate_section_states([(d, None) for d, b in inflight.items() if b == batch_id], "submitted", batch_id)
+
+    done = cached_hashes | set(inflight)
+    remaining = [task for task in tasks if request_section_hash(parse_custom_id(task["custom_id"])[0]) not in done]
+    file_count = sum(len(files) for files in section_files.values())
+    sent = len(section_files) - len(cached_hashes) - len(inflight)
+    ratio = 1 - sent / file_count
+    print("\n--- ♻️  สรุป Section ซ้ำ ---")
+    print(f"   {file_count} ไฟล์ มี Section ไม่ซ้ำกัน {len(section_files)} แบบ")
+    print(f"   ใช้ผลเดิม: {len(cached_hashes)} แบบ ({reused_files} ไฟล์) | รอผลจาก Batch อื่นอยู่แล้ว: {len(inflight)} แบบ")
+    print(f"   ต้องส่งจริง: {sent} แบบ ({len(remaining)} requests) | ลดจำนวน request ได้ {ratio:.1%}")
+    metrics.inc("sections_total", file_count)
+    metrics.inc("sections_sent_total", sent)
+    metrics.event("dedup", files=file_count, unique=len(section_files), reused=len(cached_hashes),
+                  inflight=len(inflight), sent=sent, ratio=round(ratio, 4))
+    return remaining
+
+async def create_batch_file_async():
+    if not os.path.exists(INPUT_FOLDER):
+        print(f"❌ ไม่พบโฟลเดอร์ {INPUT_FOLDER}")
+        return None
+
+    pdf_files = [f for f in os.listdir(INPUT_FOLDER) if f.lower().endswith('.pdf')]
+    if not pdf_files:
+        print("❌ ไม่พบไฟล์ PDF")
+        return None
+
+    print("⏳ กำลังเตรียม Database...")
+    await asyncio.to_thread(init_db)
+    candidates = {
+        os.path.splitext(f)[0]: datetime.fromtimestamp(os.path.getmtime(os.path.join(INPUT_FOLDER, f)), timezone.utc)
+        for f in pdf_files
+    }
+    new_ids = await afilter_new_project_ids(candidates)
+    skip_ids = set(candidates) - new_ids
+    print(f"📋 ต้องประมวลผล {len(new_ids)} จาก {len(candidates)} ไฟล์ (มีใน DB แล้วหรือกำลังรอผล {len(skip_ids)} ไฟล์)")
+
+    await aupdate_file_states(
+        [(f, None) for f in pdf_files if os.path.splitext(f)[0] not in skip_ids],
+        "discovered"
+    )
+
+    file_stats = {}
+    metrics.reset_slow_files()
+    if EXTRACT_MODE == "process":
+        print(f"🚀 เริ่มประมวลผล {len(pdf_files)} ไฟล์ (Process Pool {PROCESS_WORKERS} workers, chunk ละ {PROCESS_CHUNK_SIZE} ไฟล์)...")
+        results = await process_files_in_pool(pdf_files, skip_ids, file_stats)
+    else:
+        print(f"🚀 เริ่มประมวลผล {len(pdf_files)} ไฟล์ (พร้อมกัน {CONCURRENT_LIMIT} threads)...")
+
+        sem = asyncio.Semaphore(CONCURRENT_LIMIT)
+        tasks = []
+        for filename in pdf_files:
+            tasks.append(process_single_file(sem, filename, skip_ids, file_stats))
+
+        results = await asyncio.gather(*tasks)
+
+    valid_tasks = []
+    section_files = {}  # section_hash -> ไฟล์ทั้งหมดที่ได้ Section นี้ (ส่ง request เฉพาะไฟล์แรก)
+    skipped_count = 0
+    regex_failed_count = 0
+    timeout_count = 0
+    oversized_count = 0
+    too_large_count = 0
+    failed_states = []
+
+    for filename, res in zip(pdf_files, results):
+        if res == "SKIPPED":
+            skipped_count += 1
+        elif res == "REGEX_FAILED":
+            regex_failed_count += 1
+            failed_states.append((filename, failure_reason(res, file_stats.get(filename))))
+        elif res == "TIMEOUT":
+            timeout_count += 1
+            failed_states.append((filename, failure_reason(res, file_stats.get(filename))))
+        elif res == "OVERSIZED":
+            oversized_count += 1
+            failed_states.append((filename, failure_reason(res, file_stats.get(filename))))
+        elif res == "TOO_LARGE":
+            too_large_count += 1
+            reason = failure_reason(res, file_stats.get(filename))
+            failed_states.append((filename, reason))
+            print(f"   🐘 ข้าม {filename}: {reason}")
+        elif isinstance(res, list):
+            digest = file_stats[filename]["section_hash"]
+            if digest not in section_files:
+                valid_tasks.extend(res)
+            section_files.setdefault(digest, []).append(filename)
+
+    await aupdate_file_states(failed_states, "failed")
+    extracted_files = sorted(f for files in section_files.values() for f in files)
+    await aupdate_file_states(
+        [(f, None) for f in extracted_files], "extracted",
+        section_hashes={f: digest for digest, files in section_files.items() for f in files}
+    )
+
+    print(f"\n--- สรุปผลการเตรียมข้อมูล ---")
+    print(f"⏩ ข้าม (มีใน DB แล้ว / รอผลอยู่): {skipped_count}")
+    print(f"⚠️  ข้าม (หา Section ไม่เจอ): {regex_failed_count}")
+    if timeout_count:
+        print(f"⏱️  ข้าม (ใช้เวลาเกิน {EXTRACT_TIMEOUT} วินาที): {timeout_count}")
+    if oversized_count:
+        print(f"📏 ข้าม (Section เกิน {MAX_SECTION_TOKENS:,} tokens): {oversized_count}")
+    if too_large_count:
+        print(f"🐘 ข้าม (PDF เกินงบ {MAX_PDF_PAGES} หน้า / {MAX_PDF_MB} MB): {too_large_count}")
+    if file_stats:
+        pages_parsed = sum(st.get("pages_parsed", 0) for st in file_stats.values())
+        page_count = sum(st.get("page_count", 0) for st in file_stats.values())
+        cache_hits = sum(1 for st in file_stats.values() if st.get("cache") == "hit")
+        print(f"📄 อ่านจริง {pages_parsed} จาก {page_count} หน้า (ใช้ Cache {cache_hits} ไฟล์)")
+    metrics.report_slowest()
+    if EXTRACT_CACHE_ENABLED:
+        evicted = await asyncio.to_thread(prune_extract_cache)
+        if evicted:
+            print(f"🧹 ลบ Extraction Cache เก่า {evicted} ไฟล์")
+    print(f"✅ พร้อมส่ง (งานใหม่): {len(extracted_files)} ไฟล์ / {len(valid_tasks)} requests")
+
+    valid_tasks = await aplan_section_requests(valid_tasks, section_files)
+    realtime_tasks, valid_tasks = route_tasks(valid_tasks, section_files)
+    if realtime_tasks:
+        valid_tasks += await run_realtime(realtime_tasks)
+
+    if not valid_tasks:
+        print("❌ ไม่มีงานใหม่ให้ส่ง")
+        return None
+
+    summarize_request_tokens(valid_tasks)
+    shard_paths = write_batch_shards(valid_tasks)
+    print(f"💾 สร้างไฟล์ Batch เรียบร้อย {len(shard_paths)} shard: {', '.join(shard_paths)}")
+    return shard_paths
+
+def write_batch_shards(tasks):
+    """แบ่ง tasks เป็นหลายไฟล์ JSONL ตามจำนวน request และขนาดไฟล์สูงสุดต่อ shard"""
+    base, ext = os.path.splitext(BATCH_FILE_NAME)
+    shard_paths = []
+    current = None
+    count = 0
+    size = 0
+    try:
+        for task in tasks:
+            line = (json.dumps(task, ensure_ascii=False) + "\n").encode("utf-8")
+            if current is None or count >= BATCH_MAX_REQUESTS or size + len(line) > BATCH_MAX_BYTES:
+                if current:
+                    current.close()
+                path = f"{base}_{len(shard_paths) + 1:03d}{ext}"
+                current = open(path, "wb")
+                shard_paths.append(path)
+                count = 0
+                size = 0
+            current.write(line)
+            count += 1
+            size += len(line)
+    finally:
+        if current:
+            current.close()
+    return shard_paths
+
+# ================= RESULT VALIDATION =================
+
+def compile_validator(example, path="$"):
+    """สร้างฟังก์ชันตรวจค่าจากตัวอย่างใน TARGET_JSON_SCHEMA ครั้งเดียวตอน import คืนค่า check(value) -> ข้อความ error หรือ None
+    dict = object ที่ต้องมี key ครบและห้ามมี key อื่น, list = array ของชนิดเดียวกับสมาชิกตัวแรก (list ว่าง = string)
+    ค่าอื่น = string หรือ null ตรงตามที่ prompt กำหนด ([] เมื่อไม่มีรายการ, null เมื่อไม่มีข้อความ)
+    object และ array จึงเป็น null ไม่ได้ทุกระดับ"""
+    if isinstance(example, dict):
+        fields = {key: compile_validator(value, f"{path}.{key}") for key, value in example.items()}
+
+        def check_object(value):
+            if not isinstance(value, dict):
+                return f"{path}: expected object"
+            for key, item in value.items():
+                if key not in fields:
+                    return f"{path}: unexpected key '{key}'"
+            for key, field in fields.items():
+                if key not in value:
+                    return f"{path}: missing key '{key}'"
+                error = field(value[key])
+                if error:
+                    return error
+            return None
+        return check_object
+
+    if isinstance(example, list):
+        check_item = compile_validator(example[0] if example else "", f"{path}[]")
+
+        def check_array(value):
+            if not isinstance(value, list):
+                return f"{path}: expected array"
+            for item in value:
+                error = check_item(item)
+                if error:
+                    return error
+            return None
+        return check_array
+
+    def check_string(value):
+        if value is None or isinstance(value, str):
+            return None
+        return f"{path}: expected string"
+    return check_string
+
+RESULT_SCHEMA = json.loads(TARGET_JSON_SCHEMA)
+_check_result = compile_validator(RESULT_SCHEMA)
+
+def validate_result(data):
+    """ตรวจผลลัพธ์ของ model กับ TARGET_JSON_SCHEMA คืนค่าข้อความ error หรือ None ถ้าถูกต้อง"""
+    return _check_result(data)
+
+def strict_retry_body(body):
+    """body ของ request สำหรับส่งใหม่: ต่อ RETRY_PROMPT_SUFFIX ท้าย system prompt (ครั้งเดียว) และ temperature 0"""
+    messages = [dict(message) for message in body["messages"]]
+    if not messages[0]["content"].endswith(RETRY_PROMPT_SUFFIX):
+        messages[0]["content"] += RETRY_PROMPT_SUFFIX
+    return {**body, "messages": messages, "temperature": 0}
+
+# ================= LLM BACKEND =================
+
+class LLMRateLimitError(Exception):
+    """429 จาก backend ที่ไม่ใช่ OpenAI SDK (เช่น FakeBatchBackend) retry_after เป็นวินาที"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class LLMBackend:
+    """Interface ของผู้ให้บริการ LLM: submit (ส่ง Batch), retrieve (ตรวจสถานะ), iter_file_lines (อ่านผลลัพธ์)
+    และ complete (ส่ง request เดี่ยวสำหรับ realtime)
+    job ที่ retrieve คืนมาต้องมี id, status, request_counts, errors, output_file_id, error_file_id แบบเดียวกับ OpenAI Batch"""
+
+    name = "base"
+
+    def submit(self, jsonl_file):
+        """อัปโหลดไฟล์ JSONL และสร้าง Batch คืนค่า Batch ID"""
+        raise NotImplementedError
+
+    def retrieve(self, batch_id):
+        raise NotImplementedError
 
-    batch_id = upload_and_submit_batch(jsonl_path)
-    if not batch_id:
+    async def aretrieve(self, batch_id):
+        return await asyncio.to_thread(self.retrieve, batch_id)
+
+    def iter_file_lines(self, file_id):
+        """อ่าน output / error file ทีละบรรทัด (stream ไม่โหลดทั้งไฟล์)"""
+        raise NotImplementedError
+
+    async def complete(self, body):
+        """ส่ง 1 request ไป Chat Completions คืนค่าข้อความที่ model ตอบ
+        429 ให้ raise LLMRateLimitError (หรือ openai.RateLimitError) เพื่อให้ retry ทำงานเหมือนกัน"""
+        raise NotImplementedError
+
+class OpenAIBatchBackend(LLMBackend):
+    name = "openai"
+
+    def __init__(self):
+        if not API_KEY:
+            raise ValueError("❌ Error: OPENAI_API_KEY not found in .env file")
+        self.client = OpenAI(api_key=API_KEY)
+        self.aclient = AsyncOpenAI(api_key=API_KEY)
+        # ปิด retry ของ SDK สำหรับ realtime เพราะ send_realtime_request จัดการ retry + backoff เอง
+        self.realtime_client = self.aclient.with_options(max_retries=0)
+
+    def submit(self, jsonl_file):
+        with open(jsonl_file, "rb") as f:
+            batch_input_file = self.client.files.create(
+                file=f,
+                purpose="batch"
+            )
+
+        batch_job = self.client.batches.create(
+            input_file_id=batch_input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        return batch_job.id
+
+    def retrieve(self, batch_id):
+        return self.client.batches.retrieve(batch_id)
+
+    async def aretrieve(self, batch_id):
+        return await self.aclient.batches.retrieve(batch_id)
+
+    def iter_file_lines(self, file_id):
+        with self.client.files.with_streaming_response.content(file_id) as response:
+            yield from response.iter_lines()
+
+    async def complete(self, body):
+        response = await self.realtime_client.chat.completions.create(**body)
+        return response.choices[0].message.content
+
+def fake_extraction_result(section_text):
+    """ผลลัพธ์จำลองตาม TARGET_JSON_SCHEMA: แต่ละรายการ (๑) (๒) ... ของ section เป็นเอกสาร 1 รายการ"""
+    items = [item.strip() for item in re.split(r"\([๐-๙0-9]+\)", section_text)[1:] if item.strip()]
+    return {
+        "bid_submission_documents_part_1": {
+            "1_legal_entity_documents": {
+                "case_partnership": {"description": "ห้างหุ้นส่วนสามัญหรือห้างหุ้นส่วนจำกัด", "required_documents": []},
+                "case_company": {"description": "บริษัทจำกัดหรือบริษัทมหาชนจำกัด", "required_documents": []},
+            },
+            "2_individual_documents": {"description": "บุคคลธรรมดา", "required_documents": []},
+            "3_joint_venture_documents": {"description": "ผู้ร่วมค้า", "required_documents": []},
+            "4_financial_capability_evidence": {"description": "หลักฐานการเงิน", "options": [], "note": None},
+            "5_general_documents": {"description": "เอกสารอื่นๆ", "required_documents": items},
+        }
+    }
+
+class FakeBatchBackend(LLMBackend):
+    """Backend จำลองในเครื่องสำหรับ load test: ไม่เรียก API จริง ผลลัพธ์ deterministic ตาม FAKE_SEED
+    สถานะ Batch เก็บเป็นไฟล์ใน FAKE_BACKEND_DIR จึงใช้ข้าม process ได้ (ส่งด้วยเมนู 1 แล้วรับด้วยเมนู 2)
+    จำลองได้ทั้ง latency ต่อ API call, request ที่ error, ผลลัพธ์ที่ผิด schema, Batch ที่ failed และ 429 ของ realtime"""
+
+    name = "fake"
+
+    def __init__(self, state_dir=FAKE_BACKEND_DIR):
+        self.state_dir = state_dir
+        self.random = random.Random(FAKE_SEED)
+        os.makedirs(state_dir, exist_ok=True)
+
+    def _path(self, batch_id, suffix):
+        return os.path.join(self.state_dir, f"{batch_id}.{suffix}")
+
+    def _content(self, key, body):
+        """คำตอบของ model: ผลลัพธ์จำลองตาม schema หรือ JSON ที่ผิด schema ด้วยสัดส่วน FAKE_INVALID_OUTPUT_RATE"""
+        result = fake_extraction_result(body["messages"][-1]["content"])
+        if self._fails(f"invalid:{key}", FAKE_INVALID_OUTPUT_RATE):
+            result["bid_submission_documents_part_1"]["5_general_documents"] = {"required_documents": [{"name": "?"}]}
+            result["confidence"] = 0.5
+        return json.dumps(result, ensure_ascii=False)
+
+    def _fails(self, key, rate):
+        """สุ่มแบบ deterministic จาก key: คืนค่า True ด้วยความน่าจะเป็น rate"""
+        if rate <= 0:
+            return False
+        digest = hashlib.sha256(f"{FAKE_SEED}:{key}".encode("utf-8")).digest()
+        return int.from_bytes(digest[:4], "big") / 0xFFFFFFFF < rate
+
+    def submit(self, jsonl_file):
+        time.sleep(FAKE_API_LATENCY)
+        digest = file_sha256(jsonl_file)[:16]
+        n = 0
+        while os.path.exists(self._path(f"batch_fake_{digest}_{n}", "json")):
+            n += 1
+        batch_id = f"batch_fake_{digest}_{n}"
+
+        shutil.copyfile(jsonl_file, self._path(batch_id, "jsonl"))
+        total = failed = 0
+        with open(jsonl_file, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    total += 1
+                    failed += self._fails(f"{batch_id}:{json.loads(line)['custom_id']}", FAKE_REQUEST_FAIL_RATE)
+        with open(self._path(batch_id, "json"), "w", encoding="utf-8") as f:
+            json.dump({"created_at": time.time(), "total": total, "failed": failed}, f)
+        return batch_id
+
+    def retrieve(self, batch_id):
+        time.sleep(FAKE_API_LATENCY)
+        with open(self._path(batch_id, "json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+
+        total, failed = meta["total"], meta["failed"]
+        created_at = meta["created_at"]
+        progress = (time.time() - created_at) / max(FAKE_BATCH_SECONDS, 1e-9)
+        job = types.SimpleNamespace(
+            id=batch_id, status="validating", errors=None, output_file_id=None, error_file_id=None,
+            input_file_id=f"{batch_id}:input",
+            request_counts=types.SimpleNamespace(total=total, completed=0, failed=0),
+            created_at=int(created_at), in_progress_at=None, completed_at=None, failed_at=None,
+        )
+        if progress < 0.1:
+            return job
+        job.in_progress_at = int(created_at + 0.1 * FAKE_BATCH_SECONDS)
+        if progress < 0.9:
+            job.status = "in_progress"
+            job.request_counts.completed = int((total - failed) * progress)
+            job.request_counts.failed = int(failed * progress)
+            return job
+        if progress < 1:
+            job.status = "finalizing"
+        elif self._fails(batch_id, FAKE_BATCH_FAIL_RATE):
+            job.status = "failed"
+            job.failed_at = int(created_at + FAKE_BATCH_SECONDS)
+            job.errors = {"data": [{"code": "fake_failure", "message": "injected batch failure"}]}
+            return job
+        else:
+            job.status = "completed"
+            job.completed_at = int(created_at + FAKE_BATCH_SECONDS)
+            job.output_file_id = f"{batch_id}:output" if failed < total else None
+            job.error_file_id = f"{batch_id}:errors" if failed else None
+        job.request_counts.completed = total - failed
+        job.request_counts.failed = failed
+        return job
+
+    def iter_file_lines(self, file_id):
+        time.sleep(FAKE_API_LATENCY)
+        batch_id, kind = file_id.rsplit(":", 1)
+        with open(self._path(batch_id, "jsonl"), "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                if kind == "input":
+                    yield line.rstrip("\n")
+                    continue
+                request = json.loads(line)
+                custom_id = request["custom_id"]
+                failed = self._fails(f"{batch_id}:{custom_id}", FAKE_REQUEST_FAIL_RATE)
+                if kind == "errors" and failed:
+                    yield json.dumps({
+                        "custom_id": custom_id,
+                        "response": None,
+                        "error": {"code": "fake_error", "message": "injected request failure"},
+                    }, ensure_ascii=False)
+                elif kind == "output" and not failed:
+                    content = self._content(f"{batch_id}:{custom_id}", request["body"])
+                    yield json.dumps({
+                        "custom_id": custom_id,
+                        "response": {"status_code": 200, "body": {"choices": [{"message": {"role": "assistant", "content": content}}]}},
+                        "error": None,
+                    }, ensure_ascii=False)
+
+    async def complete(self, body):
+        await asyncio.sleep(FAKE_API_LATENCY)
+        if FAKE_RATE_LIMIT_RATE > 0 and self.random.random() < FAKE_RATE_LIMIT_RATE:
+            raise LLMRateLimitError("injected rate limit", retry_after=1)
+        return self._content(f"{self.random.random()}", body)
+
+LLM_BACKENDS = {
+    "openai": OpenAIBatchBackend,
+    "fake": FakeBatchBackend,
+}
+
+_backend = None
+
+def get_backend():
+    """สร้าง backend ตาม LLM_BACKEND ครั้งแรกที่ถูกเรียก (ไม่สร้าง client ตอน import)"""
+    global _backend
+    if _backend is None:
+        if LLM_BACKEND not in LLM_BACKENDS:
+            raise ValueError(f"❌ Error: LLM_BACKEND ต้องเป็น {' / '.join(LLM_BACKENDS)} (ได้ '{LLM_BACKEND}')")
+        _backend = LLM_BACKENDS[LLM_BACKEND]()
+    return _backend
+
+# ================= SHARED LOGIC (SUBMIT & PROCESS) =================
+
+def upload_and_submit_batch(jsonl_file):
+    """ส่ง Batch ผ่าน LLM backend ที่เลือกไว้ และคืนค่า Batch ID"""
+    print(f"\n☁️  กำลังอัปโหลดและส่งคำสั่ง ({jsonl_file})...")
+    try:
+        with metrics.timer("upload", file=jsonl_file, bytes=os.path.getsize(jsonl_file)) as extra:
+            batch_id = extra["batch_id"] = get_backend().submit(jsonl_file)
+
+        with open(jsonl_file, "r", encoding="utf-8") as f:
+            custom_ids = [json.loads(line)["custom_id"] for line in f if line.strip()]
+        metrics.inc("requests_submitted_total", len(custom_ids))
+        request_ids = {parse_custom_id(custom_id)[0] for custom_id in custom_ids}
+        update_request_states([(request_id, None) for request_id in sorted(request_ids)], "submitted", batch_id)
+            
+        print(f"✅ ส่งคำสั่งสำเร็จ! Batch ID: {batch_id}")
+        return batch_id
+        
+    except Exception as e:
+        print(f"❌ Submit Error: {e}")
+        return None
+
+def parse_result_line(line):
+    """แปลง 1 บรรทัดของ output file คืนค่า (request_id, row, reason)
+    row เป็น {"id", "data", "part", "parts"} เมื่อผลลัพธ์ผ่านการตรวจ schema ไม่เช่นนั้นเป็น None และ reason บอกสาเหตุ"""
+    try:
+        data = json.loads(line)
+        request_id, part, parts = parse_custom_id(data['custom_id'])
+    except (ValueError, KeyError, TypeError) as e:
+        return None, None, f"invalid_output_line: {e}"
+
+    response = data.get('response') or {}
+    response_body = response.get('body') or {}
+    if response.get('status_code', 200) != 200 or data.get('error') or not response_body.get('choices'):
+        error = data.get('error') or response_body.get('error') or {}
+        reason = f"api_error: {response.get('status_code') or ''} {error.get('code') or ''} {error.get('message') or 'no choices'}"
+        return request_id, None, " ".join(reason.split())[:500]
+
+    choice = response_body['choices'][0]
+    if choice.get('finish_reason') == "length":
+        return request_id, None, "truncated_output"
+    try:
+        parsed_json = json.loads(choice['message']['content'])
+    except (ValueError, KeyError, TypeError) as e:
+        return request_id, None, f"invalid_json: {e}"[:500]
+    error = validate_result(parsed_json)
+    if error:
+        return request_id, None, f"schema_error: {error}"[:500]
+
+    return request_id, {
+        "id": os.path.splitext(request_id)[0],
+        "data": parsed_json,
+        "part": part,
+        "parts": parts
+    }, None
+
+def read_batch_errors(error_file_id):
+    """อ่าน error file ของ Batch คืนค่า {request_id: reason}"""
+    failures = {}
+    for line in get_backend().iter_file_lines(error_file_id):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError:
+            continue
+        error = data.get("error") or ((data.get("response") or {}).get("body") or {}).get("error") or {}
+        reason = f"api_error: {error.get('code') or ''} {error.get('message') or ''}".strip()
+        failures[parse_custom_id(data["custom_id"])[0]] = reason[:500]
+    return failures
+
+def submit_retry_batch(batch_id, batch_job, saved_ids):
+    """ส่ง request ของ Batch นี้ที่ยังไม่ได้ผลที่ใช้ได้ (error / JSON เสีย / ผิด schema / ไม่มีผล) ใหม่เป็น retry batch
+    ด้วย prompt ที่เข้มขึ้น อ่าน request เดิมจาก input file ของ Batch จำกัดไม่เกิน LLM_MAX_ATTEMPTS ครั้งต่อ request
+    คืนค่า set ของ request_id ที่ถูกส่งใหม่"""
+    attempt = get_shard_attempt(batch_id)
+    input_file_id = getattr(batch_job, "input_file_id", None)
+    if attempt >= LLM_MAX_ATTEMPTS or batch_job.status == "cancelled" or not input_file_id:
+        return set()
+
+    base, ext = os.path.splitext(BATCH_FILE_NAME)
+    path = f"{base}_retry_{batch_id}{ext}"
+    request_ids = set()
+    with open(path, "w", encoding="utf-8") as f:
+        for line in get_backend().iter_file_lines(input_file_id):
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            request_id = parse_custom_id(request["custom_id"])[0]
+            if request_id in saved_ids:
+                continue
+            request["body"] = strict_retry_body(request["body"])
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+            request_ids.add(request_id)
+
+    if not request_ids:
+        os.remove(path)
+        return set()
+    retry_id = upload_and_submit_batch(path)
+    if not retry_id:
+        return set()
+    add_manifest_shard(path, retry_id, attempt=attempt + 1, retry_of=batch_id)
+    metrics.inc("retry_batches_total")
+    metrics.inc("requests_retried_total", len(request_ids))
+    print(f"🔁 ส่งใหม่ {len(request_ids)} รายการเป็น Batch {retry_id} (ครั้งที่ {attempt + 1}/{LLM_MAX_ATTEMPTS})")
+    return request_ids
+
+def record_batch_metrics(batch_job):
+    """บันทึกเวลารอคิว (created -> in_progress) และเวลารวมของ Batch (created -> จบ) จาก timestamp ของ API"""
+    created_at = getattr(batch_job, "created_at", None)
+    in_progress_at = getattr(batch_job, "in_progress_at", None)
+    finished_at = next(
+        (t for t in (getattr(batch_job, f"{s}_at", None) for s in ("completed", "failed", "expired", "cancelled")) if t),
+        None
+    ) or time.time()
+    metrics.inc("batches_total", status=batch_job.status)
+    if not created_at:
         return
+    fields = {"batch_id": batch_job.id, "status": batch_job.status, "turnaround_seconds": round(finished_at - created_at, 1)}
+    metrics.observe("batch_turnaround", finished_at - created_at)
+    if in_progress_at:
+        metrics.observe("batch_queue_wait", in_progress_at - created_at)
+        fields["queue_wait_seconds"] = round(in_progress_at - created_at, 1)
+    metrics.event("batch", **fields)
+
+def download_and_save_results(batch_id, batch_job=None):
+    """โหลดผลลัพธ์แบบ stream ทีละบรรทัด ตรวจ schema และบันทึกลง DB ทีละ chunk (commit ทุก chunk)
+    รองรับ Batch ที่เสร็จไม่ครบ (expired/cancelled/failed) โดยบันทึกเท่าที่มี output และ error file
+    request ที่ไม่ได้ผลที่ใช้ได้ถูกส่งใหม่เป็น retry batch (ถ้ายังไม่ครบ LLM_MAX_ATTEMPTS) ที่เหลือเป็น failed"""
+    print(f"⬇️  กำลังดาวน์โหลดผลลัพธ์ (ID: {batch_id})...")
+    start = time.perf_counter()
+    saved_count = 0
+    try:
+        if batch_job is None:
+            batch_job = get_backend().retrieve(batch_id)
+        record_batch_metrics(batch_job)
+
+        failures = {}     # request_id -> เหตุผลที่ใช้ผลไม่ได้
+        saved_ids = set()  # เฉพาะรายการที่ commit ลง DB แล้ว
+        if batch_job.output_file_id:
+            chunk = []
+            chunk_ids = []
+            partials = {}  # ผลลัพธ์ของ request ที่ถูก split ซึ่งยังได้รับไม่ครบทุกส่วน
+            for line in get_backend().iter_file_lines(batch_job.output_file_id):
+                if not line.strip():
+                    continue
+                request_id, row, reason = parse_result_line(line)
+                if reason:
+                    metrics.inc("results_invalid_total", reason=reason.split(":")[0])
+                    if request_id:
+                        failures[request_id] = reason
+                    continue
+                row = collect_part_result(partials, row)
+                if row:
+                    chunk.append(row)
+                    chunk_ids.append(request_id)
+                if len(chunk) >= INGEST_CHUNK_SIZE:
+                    # บันทึกไม่สำเร็จจะ raise ออกไป shard จึงยังไม่ saved และ output file ถูกอ่านใหม่รอบถัดไป
+                    saved_count += save_results_to_db(chunk)
+                    saved_ids.update(chunk_ids)
+                    print(f"   💾 บันทึกแล้ว {saved_count} รายการ...")
+                    chunk = []
+                    chunk_ids = []
+
+            if chunk:
+                saved_count += save_results_to_db(chunk)
+                saved_ids.update(chunk_ids)
+            for request_id in partials:
+                failures.setdefault(request_id, "missing_part")
+
+        if batch_job.error_file_id:
+            failures.update(read_batch_errors(batch_job.error_file_id))
+        # รายการที่ถูก split และมีบางส่วนใช้ไม่ได้ ต้องส่งใหม่ทั้งชุด
+        saved_ids -= failures.keys()
+        if failures:
+            print(f"⚠️  ผลลัพธ์ที่ใช้ไม่ได้ {len(failures)} รายการ")
+            for request_id, reason in list(failures.items())[:5]:
+                print(f"   - {request_id}: {reason}")
+
+        if failures or batch_job.status != "completed":
+            retried = submit_retry_batch(batch_id, batch_job, saved_ids)
+            failed = [(request_id, reason) for request_id, reason in failures.items() if request_id not in retried]
+            if failed:
+                update_request_states(failed, "failed", batch_id)
+                print(f"⚠️  ล้มเหลว {len(failed)} รายการ (ส่งครบ {LLM_MAX_ATTEMPTS} ครั้งแล้ว จะถูกส่งใหม่รอบถัดไป)")
+
+        reason = "no_valid_result" if batch_job.status == "completed" else f"batch_{batch_job.status}"
+        missing_count = fail_unsaved_batch_files(batch_id, reason)
+        if missing_count:
+            print(f"⚠️  ไม่มีผลลัพธ์ที่ใช้ได้ {missing_count} ไฟล์ (จะถูกส่งใหม่รอบถัดไป)")
+
+        if saved_count:
+            print(f"✅ บันทึกเสร็จสิ้น {saved_count} รายการ")
+            return True
+    except Exception as e:
+        print(f"❌ Save Error: {e}")
+        return False
+    finally:
+        seconds = time.perf_counter() - start
+        metrics.observe("ingest", seconds)
+        metrics.event("ingest", batch_id=batch_id, saved=saved_count, seconds=round(seconds, 4))
+
+# ================= BATCH MANIFEST =================
+
+# Manifest ถูกแก้ทั้งจาก event loop และจาก thread ของ download_and_save_results (retry batch)
+# ทุกการ load -> แก้ -> save ต้องถือ lock นี้ ไม่เช่นนั้น shard ที่ thread อื่นเพิ่งเขียนจะหาย
+_manifest_lock = threading.RLock()
+
+def load_manifest():
+    if os.path.exists(BATCH_MANIFEST):
+        with open(BATCH_MANIFEST, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    manifest = {"shards": []}
+    if os.path.exists(BATCH_ID_LOG):
+        # รองรับไฟล์ current_batch_id.txt จากเวอร์ชันก่อน
+        with open(BATCH_ID_LOG, "r") as f:
+            batch_id = f.read().strip()
+        if batch_id:
+            manifest["shards"].append({"file": None, "batch_id": batch_id, "status": "submitted", "saved": False})
+    return manifest
+
+def save_manifest(manifest):
+    tmp_path = f"{BATCH_MANIFEST}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, BATCH_MANIFEST)
+
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+def is_shard_finished(shard):
+    return shard["saved"] or shard["status"] in ("failed", "expired", "cancelled")
+
+async def submit_batch_shards(shard_paths):
+    """อัปโหลดและส่งทุก shard พร้อมกัน แล้วบันทึกลง Manifest คืนค่า list ของ Batch ID ที่ส่งสำเร็จ"""
+    batch_ids = await asyncio.gather(
+        *(asyncio.to_thread(upload_and_submit_batch, path) for path in shard_paths)
+    )
+
+    submitted = []
+    with _manifest_lock:
+        manifest = load_manifest()
+        # เก็บเฉพาะ shard ที่ยังไม่จบ เพื่อไม่ให้ Manifest โตขึ้นเรื่อยๆ
+        manifest["shards"] = [shard for shard in manifest["shards"] if not is_shard_finished(shard)]
+        for path, batch_id in zip(shard_paths, batch_ids):
+            if not batch_id:
+                continue
+            manifest["shards"].append({"file": path, "batch_id": batch_id, "status": "submitted", "saved": False, "attempt": 1})
+            submitted.append(batch_id)
+        save_manifest(manifest)
+
+    print(f"📒 บันทึก {len(submitted)}/{len(shard_paths)} shard ลง {BATCH_MANIFEST}")
+    return submitted
+
+def check_and_save_shards(batch_ids=None):
+    """ตรวจสถานะทุก shard ใน Manifest (หรือเฉพาะ batch_ids) และบันทึกผลทันทีที่ shard นั้นเสร็จ
+    คืนค่าจำนวน shard ที่ยังไม่เสร็จ"""
+    if batch_ids is None:
+        # กู้ Batch ที่ส่งไปแล้วแต่ไม่อยู่ใน Manifest (เช่นโปรแกรมหยุดก่อนเขียน Manifest)
+        inflight_ids = get_inflight_batch_ids()
+        with _manifest_lock:
+            manifest = load_manifest()
+            known = {shard["batch_id"] for shard in manifest["shards"]}
+            for batch_id in inflight_ids:
+                if batch_id not in known:
+                    manifest["shards"].append({"file": None, "batch_id": batch_id, "status": "submitted", "saved": False})
+            save_manifest(manifest)
+    else:
+        manifest = load_manifest()
+
+    pending = 0
+    for shard in manifest["shards"]:
+        if is_shard_finished(shard) or (batch_ids is not None and shard["batch_id"] not in batch_ids):
+            continue
+
+        batch_id = shard["batch_id"]
+        try:
+            job = get_backend().retrieve(batch_id)
+        except Exception as e:
+            print(f"⚠️ [{batch_id}] Error checking status: {e}")
+            pending += 1
+            continue
+
+        shard["status"] = job.status
+        print(f"   📦 [{batch_id}] Status: {job.status.upper()}")
+
+        if job.status in BATCH_TERMINAL_STATUSES:
+            if job.errors:
+                print(f"   Errors: {job.errors}")
+            shard["saved"] = download_and_save_results(batch_id, job) is not False
+            if not shard["saved"] and job.status == "completed":
+                pending += 1
+            # retry batch ที่เพิ่งส่งจะถูกตรวจในการเรียกครั้งถัดไป
+            pending += len(get_retry_shard_ids(batch_id))
+        else:
+            pending += 1
+
+        # บันทึกทุกครั้งที่ shard เปลี่ยนสถานะ กันข้อมูลหายถ้าโปรแกรมหยุดกลางทาง
+        # (อัปเดตเฉพาะ shard นี้ เพื่อไม่ทับ retry batch ที่ download_and_save_results เพิ่มลง Manifest)
+        update_manifest_shard(batch_id, status=shard["status"], saved=shard["saved"])
+    return pending
+
+def update_manifest_shard(batch_id, **fields):
+    with _manifest_lock:
+        manifest = load_manifest()
+        for shard in manifest["shards"]:
+            if shard["batch_id"] == batch_id:
+                shard.update(fields)
+        save_manifest(manifest)
+
+def add_manifest_shard(path, batch_id, **fields):
+    with _manifest_lock:
+        manifest = load_manifest()
+        manifest["shards"].append({"file": path, "batch_id": batch_id, "status": "submitted", "saved": False, **fields})
+        save_manifest(manifest)
+
+def get_shard_attempt(batch_id):
+    """ครั้งที่ส่งของ Batch นี้ (1 = ส่งครั้งแรก, retry batch = 2, 3, ...)"""
+    for shard in load_manifest()["shards"]:
+        if shard["batch_id"] == batch_id:
+            return shard.get("attempt", 1)
+    return 1
+
+def get_retry_shard_ids(batch_id):
+    return [shard["batch_id"] for shard in load_manifest()["shards"] if shard.get("retry_of") == batch_id]
+
+def get_pending_shard_ids():
+    return [shard["batch_id"] for shard in load_manifest()["shards"] if not is_shard_finished(shard)]
+
+# ================= ASYNC BATCH SCHEDULER =================
+
+def _next_poll_delay(job, interval):
+    """คำนวณเวลารอรอบถัดไปตามสถานะ คืนค่า (delay, interval ใหม่)"""
+    if job.status == "finalizing":
+        return POLL_FINALIZING_INTERVAL, POLL_MIN_INTERVAL
+
+    if job.status == "in_progress":
+        counts = job.request_counts
+        if counts and counts.total and (counts.completed + counts.failed) >= counts.total * 0.95:
+            # เกือบครบแล้ว กลับมาเช็คถี่ๆ
+            interval = POLL_MIN_INTERVAL
+        else:
+            interval = min(interval * POLL_BACKOFF, INTERVAL_TIME)
+        return interval, interval
+
+    # validating หรือสถานะอื่น
+    return POLL_MIN_INTERVAL, interval
+
+# asyncio task ของ watch_batch -> future ของ download_and_save_results (thread) ที่กำลังบันทึกผลอยู่
+_ingesting = {}
+
+async def watch_batch(batch_id, start_time):
+    """ติดตาม Batch เดียวแบบ non-blocking และบันทึกผลทันทีที่จบ คืนค่าสถานะสุดท้าย"""
+    interval = POLL_MIN_INTERVAL
+    error_count = 0
+    last_status = None
 
-    # 2. Polling Loop
-    print(f"\n--- 🔄 เข้าสู่โหมดติดตามสถานะอัตโนมัติ (ตรวจสอบทุก 2 นาที) ---")
-    start_time = time.time()
-    
     while True:
         try:
-            batch_job = client.batches.retrieve(batch_id)
-            status = batch_job.status
+            job = await get_backend().aretrieve(batch_id)
+            error_count = 0
+        except Exception as e:
+            error_count += 1
+            delay = min(POLL_MIN_INTERVAL * 2 ** error_count, INTERVAL_TIME)
+            print(f"⚠️ [{batch_id}] Error checking status: {e} (ลองใหม่ใน {delay} วินาที)")
+            await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+            continue
+
+        if job.status != last_status:
             elapsed = int((time.time() - start_time) / 60)
-            
-            print(f"⏱️  [{elapsed} นาที] Status: {status.upper()}")
+            print(f"⏱️  [{elapsed} นาที] [{batch_id}] Status: {job.status.upper()}")
+            last_status = job.status
+            update_manifest_shard(batch_id, status=job.status)
 
-            if status == "completed":
-                print("🎉 งานเสร็จสิ้นแล้ว! เริ่มกระบวนการบันทึกข้อมูล...")
-                download_and_save_results(batch_id)
-                print("✅ Auto Pilot เสร็จสมบูรณ์")
-                break
-            
-            elif status in ["failed", "expired", "cancelled"]:
-                print(f"❌ งานล้มเหลว (Status: {status})")
-                if batch_job.errors:
-                    print(f"Errors: {batch_job.errors}")
-                break
-                
+        if job.status in BATCH_TERMINAL_STATUSES:
+            if job.errors:
+                print(f"   Errors: {job.errors}")
+            task = asyncio.current_task()
+            _ingesting[task] = asyncio.ensure_future(asyncio.to_thread(download_and_save_results, batch_id, job))
+            try:
+                saved = await _ingesting[task]
+            finally:
+                _ingesting.pop(task, None)
+            update_manifest_shard(batch_id, saved=saved is not False)
+            # ติดตาม retry batch ต่อ (ถ้ามี) สถานะสุดท้ายคือสถานะของ retry batch ล่าสุด
+            retry_ids = get_retry_shard_ids(batch_id)
+            if retry_ids:
+                return await watch_batch(retry_ids[-1], start_time)
+            return job.status
+
+        delay, interval = _next_poll_delay(job, interval)
+        # jitter กันหลาย Batch ยิง request พร้อมกัน
+        await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+
+async def stop_watching(tasks):
+    """หยุด task ของ watch_batch ตอนปิดโปรแกรม: task ที่รอสถานะอยู่ถูก cancel ทันที ส่วนที่กำลังบันทึกผลรอให้ thread จบก่อน
+    (ถ้า cancel ระหว่างบันทึก run_async จะปิด pool ขณะ thread ยังเรียก DB อยู่) Batch ที่ยังไม่เสร็จอยู่ใน Manifest
+    และ file_state แล้ว จะถูกติดตามต่อเมื่อเริ่มใหม่"""
+    tasks = list(tasks)
+    ingests = [_ingesting[task] for task in tasks if task in _ingesting]
+    for task in tasks:
+        if task not in _ingesting:
+            task.cancel()
+    if ingests:
+        print(f"⏳ รอบันทึกผล {len(ingests)} Batch ที่กำลังดาวน์โหลดให้เสร็จ...")
+        await asyncio.gather(*ingests, return_exceptions=True)
+    # task ที่บันทึกเสร็จแล้วอาจเริ่มติดตาม retry batch ต่อ
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def watch_batches(batch_ids):
+    """ติดตามหลาย Batch พร้อมกัน แต่ละ Batch ถูกบันทึกทันทีที่เสร็จโดยไม่ต้องรอกัน"""
+    start_time = time.time()
+    statuses = await asyncio.gather(*(watch_batch(batch_id, start_time) for batch_id in batch_ids))
+    return dict(zip(batch_ids, statuses))
+
+# ================= REALTIME MODE =================
+
+class TokenBucket:
+    """Rate limiter ฝั่ง client: เติม capacity ต่อเนื่องตามอัตราต่อนาที"""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+def load_priority_ids():
+    if not os.path.exists(REALTIME_PRIORITY_FILE):
+        return set()
+    with open(REALTIME_PRIORITY_FILE, "r", encoding="utf-8") as f:
+        return {os.path.splitext(line.strip())[0] for line in f if line.strip()}
+
+def route_tasks(tasks, section_files=None):
+    """แยกงานด่วน (อยู่ใน priority list หรือ section สั้นกว่า REALTIME_MAX_CHARS) ไปโหมด realtime
+    ตัดสินใจราย request_id เพื่อให้ request ที่ถูก split ของไฟล์/Section เดียวกันไปทางเดียวกันเสมอ
+    Section ที่ใช้ร่วมกันหลายไฟล์ (section_files = {hash: [filename]}) ถือว่าด่วนถ้ามีไฟล์ใดอยู่ใน priority list
+    คืนค่า (realtime_tasks, batch_tasks)"""
+    priority_ids = load_priority_ids()
+    section_files = section_files or {}
+    section_chars = {}
+    for task in tasks:
+        request_id = parse_custom_id(task["custom_id"])[0]
+        content = task["body"]["messages"][-1]["content"]
+        section_chars[request_id] = section_chars.get(request_id, 0) + len(content) - len(USER_MESSAGE_PREFIX)
+
+    realtime_tasks = []
+    batch_tasks = []
+    for task in tasks:
+        request_id = parse_custom_id(task["custom_id"])[0]
+        filenames = section_files.get(request_section_hash(request_id), [request_id])
+        is_priority = any(os.path.splitext(filename)[0] in priority_ids for filename in filenames)
+        if is_priority or (REALTIME_MAX_CHARS and section_chars[request_id] <= REALTIME_MAX_CHARS):
+            realtime_tasks.append(task)
+        else:
+            batch_tasks.append(task)
+    return realtime_tasks, batch_tasks
+
+def _retry_delay(error, attempt):
+    retry_after = getattr(error, "retry_after", None)
+    if isinstance(error, openai.APIStatusError):
+        retry_after = error.response.headers.get("retry-after")
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return min(60, 2 ** attempt) * random.uniform(0.5, 1.0)
+
+REALTIME_DEFERRED = "realtime_retries_exhausted"  # reason ของ request ที่โดน 429 / 5xx จนครบ ย้ายไปส่งเป็น Batch
+
+async def send_realtime_request(task, rpm_limiter, tpm_limiter, sem):
+    """ส่ง 1 request ไป Chat Completions คืนค่า (row, reason) โดย row เป็น None ถ้าไม่สำเร็จ
+    งบลองใหม่แยกกัน: 429 / 5xx ลองได้ REALTIME_MAX_RETRIES ครั้ง (ครบแล้ว reason = REALTIME_DEFERRED ให้ไปรอบ Batch)
+    ส่วนคำตอบที่ใช้ไม่ได้ส่งใหม่ด้วย prompt เข้มขึ้นได้ไม่เกิน LLM_MAX_ATTEMPTS ครั้งเหมือน retry batch"""
+    body = task["body"]
+    filename, part, parts = parse_custom_id(task["custom_id"])
+    project_id = os.path.splitext(filename)[0]
+    backend = get_backend()
+    sends = 0  # จำนวนคำตอบที่ได้รับ
+    attempt = 0  # จำนวนครั้งที่โดน 429 / 5xx
+
+    async with sem:
+        while True:
+            await rpm_limiter.acquire(1)
+            await tpm_limiter.acquire(request_tokens(body) + EST_OUTPUT_TOKENS)
+            try:
+                start = time.perf_counter()
+                ai_content = await backend.complete(body)
+                metrics.observe("realtime_request", time.perf_counter() - start)
+                sends += 1
+                data = json.loads(ai_content)
+                error = validate_result(data)
+                if not error:
+                    return {"id": project_id, "data": data, "part": part, "parts": parts}, None
+                metrics.inc("results_invalid_total", reason="schema_error")
+                if sends >= LLM_MAX_ATTEMPTS:
+                    return None, f"schema_error: {error}"[:500]
+                body = strict_retry_body(body)
+            except (LLMRateLimitError, openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError) as e:
+                if attempt == REALTIME_MAX_RETRIES:
+                    return None, REALTIME_DEFERRED
+                delay = _retry_delay(e, attempt)
+                attempt += 1
+                print(f"   🔁 [{task['custom_id']}] {type(e).__name__} ลองใหม่ใน {delay:.1f} วินาที")
+                await asyncio.sleep(delay)
+            except openai.APIStatusError as e:
+                return None, f"realtime_error: {e}"[:500]
+            except (TypeError, ValueError) as e:
+                # content เป็น null หรือ JSON เสีย ถือเป็นคำตอบที่ใช้ไม่ได้เหมือน parse_result_line
+                metrics.inc("results_invalid_total", reason="invalid_json")
+                if sends >= LLM_MAX_ATTEMPTS:
+                    return None, f"invalid_json: {e}"[:500]
+                body = strict_retry_body(body)
+
+async def run_realtime(tasks):
+    """ส่งงานด่วนตรงไป Chat Completions แบบจำกัด concurrency/RPM/TPM แล้วบันทึกผ่าน save_results_to_db
+    คืนค่า list ของ task ที่ลอง 429 / 5xx จนครบแล้ว ให้ผู้เรียกรวมเข้า Batch รอบนี้แทนการ mark failed
+    (request ที่ถูก split ย้ายไปทั้งชุด เพราะ part ต้องรวมกันจากโหมดเดียวกัน)"""
+    print(f"\n⚡ ส่งงานด่วนแบบ Realtime {len(tasks)} ไฟล์ (พร้อมกัน {REALTIME_CONCURRENCY})...")
+    rpm_limiter = TokenBucket(REALTIME_RPM)
+    tpm_limiter = TokenBucket(REALTIME_TPM)
+    sem = asyncio.Semaphore(REALTIME_CONCURRENCY)
+
+    outcomes = await asyncio.gather(
+        *(send_realtime_request(task, rpm_limiter, tpm_limiter, sem) for task in tasks)
+    )
+
+    deferred_ids = {
+        parse_custom_id(task["custom_id"])[0]
+        for task, (_, reason) in zip(tasks, outcomes) if reason == REALTIME_DEFERRED
+    }
+    partials = {}
+    failed = {}
+    rows = []
+    for task, (row, reason) in zip(tasks, outcomes):
+        request_id = parse_custom_id(task["custom_id"])[0]
+        if request_id in deferred_ids:
+            continue
+        if not row:
+            failed[request_id] = reason
+        elif merged := collect_part_result(partials, row):
+            rows.append(merged)
+    if rows:
+        try:
+            saved_count = await asave_results_to_db(rows)
+            print(f"✅ Realtime บันทึกเสร็จสิ้น {saved_count} รายการ")
+        except Exception:
+            # ไฟล์ยังไม่ถูกบันทึก (สถานะเดิมไม่เปลี่ยน) จะถูกส่งใหม่รอบถัดไป
+            pass
+    if failed:
+        await aupdate_request_states(list(failed.items()), "failed")
+        print(f"⚠️  Realtime ล้มเหลว {len(failed)} ไฟล์ (จะถูกส่งใหม่รอบถัดไป)")
+    deferred = [task for task in tasks if parse_custom_id(task["custom_id"])[0] in deferred_ids]
+    if deferred:
+        metrics.inc("realtime_deferred_total", len(deferred_ids))
+        print(f"📦 Realtime โดนจำกัด rate จนครบ {REALTIME_MAX_RETRIES} ครั้ง ย้าย {len(deferred_ids)} ไฟล์ไปส่งเป็น Batch")
+    return deferred
+
+# ================= OPTION 3: AUTO PILOT =================
+
+async def run_auto_pilot():
+    print("\n" + "="*40)
+    print("   🚀 STARTING AUTO PILOT MODE")
+    print("="*40)
+    
+    # 1. Prepare & Submit
+    shard_paths = await create_batch_file_async()
+    if not shard_paths:
+        return
+
+    if not await submit_batch_shards(shard_paths):
+        return
+
+    # 2. Polling (รวม shard ที่ค้างจากรอบก่อนด้วย แต่ละ shard ถูกบันทึกทันทีที่เสร็จ)
+    batch_ids = get_pending_shard_ids()
+    print(f"\n--- 🔄 เข้าสู่โหมดติดตามสถานะอัตโนมัติ {len(batch_ids)} shard ---")
+    statuses = await watch_batches(batch_ids)
+    await asyncio.to_thread(refresh_analytics_views, 0)
+
+    failed = [batch_id for batch_id, status in statuses.items() if status != "completed"]
+    if failed:
+        print(f"⚠️  Batch ที่ไม่สำเร็จ {len(failed)} shard: {', '.join(failed)} (บันทึกเท่าที่มีผลลัพธ์แล้ว)")
+    metrics.report_stages()
+    print("✅ Auto Pilot เสร็จสมบูรณ์")
+
+# ================= DAEMON MODE =================
+
+class FolderWatcher:
+    """ตรวจหาไฟล์ PDF ใหม่/เปลี่ยนแปลงแบบ incremental
+    - สแกนโฟลเดอร์เฉพาะเมื่อ mtime ของโฟลเดอร์เปลี่ยน (มีไฟล์เพิ่ม/ลบ/เปลี่ยนชื่อ) หรือครบรอบ DAEMON_RESCAN_EVERY
+    - ไฟล์ที่กำลังถูกคัดลอกจะถูก stat ซ้ำรอบถัดไป และส่งต่อเมื่อขนาด/เวลาไม่เปลี่ยนแล้วเท่านั้น"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.dir_mtime = None
+        self.known = {}      # filename -> (mtime_ns, size) ที่ส่งต่อไปแล้ว
+        self.unstable = {}   # filename -> (mtime_ns, size) ที่เห็นครั้งล่าสุด (อาจยังเขียนไม่เสร็จ)
+        self.cycles = 0
+
+    def _stat(self, name):
+        try:
+            st = os.stat(os.path.join(self.folder, name))
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def poll(self):
+        """คืนค่า list ของ (filename, mtime) ที่ใหม่หรือถูกแก้ไข และเขียนเสร็จแล้ว"""
+        self.cycles += 1
+        dir_mtime = os.stat(self.folder).st_mtime_ns
+        candidates = {}
+
+        if dir_mtime != self.dir_mtime or self.cycles % DAEMON_RESCAN_EVERY == 0:
+            self.dir_mtime = dir_mtime
+            with os.scandir(self.folder) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.lower().endswith(".pdf"):
+                        st = entry.stat()
+                        candidates[entry.name] = (st.st_mtime_ns, st.st_size)
+            for name in set(self.known) - set(candidates):
+                del self.known[name]
+            for name in set(self.unstable) - set(candidates):
+                del self.unstable[name]
+        else:
+            for name in list(self.unstable):
+                sig = self._stat(name)
+                if sig is None:
+                    del self.unstable[name]
+                else:
+                    candidates[name] = sig
+
+        ready = []
+        for name, sig in candidates.items():
+            if self.known.get(name) == sig:
+                continue
+            if self.unstable.get(name) == sig:
+                del self.unstable[name]
+                self.known[name] = sig
+                ready.append((name, datetime.fromtimestamp(sig[0] / 1e9, timezone.utc)))
             else:
-                # validating, in_progress, finalizing
-                print(f"💤 ยังไม่เสร็จ... รอตรวจสอบใหม่ใน {INTERVAL_TIME // 60} นาที")
-                await asyncio.sleep(INTERVAL_TIME)  # รอ INTERVAL_TIME วินาที (2 นาที)
-                
+                self.unstable[name] = sig
+        return ready
+
+def install_stop_signals(stop):
+    """ตั้งให้ Ctrl+C / SIGTERM set asyncio.Event ``stop`` เพื่อหยุด loop แบบ graceful"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, AttributeError, ValueError):
+            # Windows ไม่รองรับ add_signal_handler
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stop.set))
+
+async def dispatch_tasks(tasks, section_files):
+    """ใช้ผลเดิม/ผูก Batch ที่รออยู่สำหรับ Section ซ้ำ ส่งงานด่วนแบบ realtime และส่งที่เหลือเป็น Batch
+    คืนค่า list ของ Batch ID ที่ส่งใหม่"""
+    tasks = await aplan_section_requests(tasks, section_files)
+    realtime_tasks, batch_tasks = route_tasks(tasks, section_files)
+    if realtime_tasks:
+        batch_tasks += await run_realtime(realtime_tasks)
+    if not batch_tasks:
+        return []
+    summarize_request_tokens(batch_tasks)
+    shard_paths = write_batch_shards(batch_tasks)
+    return await submit_batch_shards(shard_paths)
+
+async def run_daemon():
+    """โหมดทำงานต่อเนื่อง: เฝ้า INPUT_FOLDER, สกัดไฟล์ทันทีที่เข้ามา, ส่ง micro-batch เมื่อครบ N ไฟล์หรือ T วินาที
+    และติดตาม/บันทึกผล Batch ใน loop เดียวกัน หยุดด้วย Ctrl+C หรือ SIGTERM"""
+    print("\n" + "="*40)
+    print("   🛰️  STARTING DAEMON MODE")
+    print("="*40)
+
+    if not os.path.exists(INPUT_FOLDER):
+        print(f"❌ ไม่พบโฟลเดอร์ {INPUT_FOLDER}")
+        return
+    await asyncio.to_thread(init_db)
+
+    stop = asyncio.Event()
+    install_stop_signals(stop)
+
+    watcher = FolderWatcher(INPUT_FOLDER)
+    sem = asyncio.Semaphore(CONCURRENT_LIMIT)
+    ready_tasks = []          # request ที่สกัดเสร็จแล้ว รอรวมเป็น micro-batch
+    ready_sections = {}       # section_hash -> ไฟล์ที่รอผลของ Section นี้ในรอบเดียวกัน
+    first_ready_at = None
+    extracting = set()        # asyncio task ของกลุ่มไฟล์ที่กำลังสกัด
+    watching = {}             # batch_id -> asyncio task ที่ติดตาม Batch
+    next_refresh_at = 0       # เวลา (monotonic) ที่จะตรวจว่าต้อง refresh สถิติไหม
+
+    def start_watching(batch_ids):
+        for batch_id in batch_ids:
+            if batch_id not in watching:
+                watching[batch_id] = asyncio.create_task(watch_batch(batch_id, time.time()))
+
+    async def queue_result(filename, res, file_stats):
+        nonlocal first_ready_at
+        if isinstance(res, list):
+            # บันทึก hash ก่อนเข้าคิว เพื่อให้ flush ที่ใช้ผลเดิมจาก section_results เห็นไฟล์นี้เสมอ
+            digest = file_stats[filename]["section_hash"]
+            await aupdate_file_states([(filename, None)], "extracted", section_hashes={filename: digest})
+            if not ready_tasks:
+                first_ready_at = time.monotonic()
+            if digest not in ready_sections:
+                ready_tasks.extend(res)
+            ready_sections.setdefault(digest, []).append(filename)
+        elif res in FAILURE_REASONS:
+            reason = failure_reason(res, file_stats.get(filename))
+            await aupdate_file_states([(filename, reason)], "failed")
+        print(f"   📄 {filename}: {'พร้อมส่ง' if isinstance(res, list) else res}")
+
+    async def extract_one(filename):
+        file_stats = {}
+        await queue_result(filename, await process_single_file(sem, filename, set(), file_stats), file_stats)
+
+    async def extract_files(filenames):
+        """สกัดไฟล์ที่พบในรอบเดียวกัน: EXTRACT_MODE=process ส่งทั้งชุดเข้า Process Pool แบบเดียวกับ worker
+        โหมด thread เข้าคิวทีละไฟล์ทันทีที่สกัดเสร็จ"""
+        if EXTRACT_MODE == "process":
+            file_stats = {}
+            results = await process_files_in_pool(filenames, set(), file_stats)
+            for filename, res in zip(filenames, results):
+                await queue_result(filename, res, file_stats)
+        else:
+            await asyncio.gather(*(extract_one(f) for f in filenames))
+
+    async def flush():
+        """ส่ง micro-batch ถ้า dispatch ล้มเหลวจะคืนงานกลับเข้าคิว (ก่อนงานที่เข้ามาระหว่างส่ง) แล้ว raise ต่อ
+        ให้ loop หลักลองใหม่รอบถัดไป งานจึงไม่หายเพราะ DB / API ล่มชั่วคราว"""
+        nonlocal first_ready_at
+        tasks = ready_tasks[:]
+        sections = dict(ready_sections)
+        ready_at = first_ready_at
+        ready_tasks.clear()
+        ready_sections.clear()
+        first_ready_at = None
+
+        try:
+            batch_ids = await dispatch_tasks(tasks, sections)
+        except BaseException:
+            # Section ที่เข้ามาซ้ำระหว่างส่งใช้ request เดิมในคิว ไม่ต้องมี request ซ้ำ
+            queued = [t for t in ready_tasks if request_section_hash(parse_custom_id(t["custom_id"])[0]) not in sections]
+            ready_tasks[:] = tasks + queued
+            for digest, filenames in sections.items():
+                ready_sections[digest] = filenames + ready_sections.get(digest, [])
+            first_ready_at = ready_at
+            raise
+        start_watching(batch_ids)
+
+    # ติดตาม Batch ที่ค้างจากรอบก่อนด้วย
+    start_watching(get_pending_shard_ids())
+    print(f"👀 เฝ้าโฟลเดอร์ {INPUT_FOLDER} (ส่งเมื่อครบ {DAEMON_BATCH_SIZE} ไฟล์ หรือ {DAEMON_FLUSH_SECONDS} วินาที)")
+
+    while not stop.is_set():
+        try:
+            changed = await asyncio.to_thread(watcher.poll)
+            if changed:
+                candidates = {os.path.splitext(name)[0]: mtime for name, mtime in changed}
+                new_ids = await afilter_new_project_ids(candidates)
+                new_files = [name for name, _ in changed if os.path.splitext(name)[0] in new_ids]
+                if new_files:
+                    print(f"📥 พบไฟล์ใหม่ {len(new_files)} ไฟล์")
+                    await aupdate_file_states([(f, None) for f in new_files], "discovered")
+                if new_files:
+                    task = asyncio.create_task(extract_files(new_files))
+                    extracting.add(task)
+                    task.add_done_callback(extracting.discard)
+
+            waited = time.monotonic() - first_ready_at if first_ready_at else 0
+            if len(ready_tasks) >= DAEMON_BATCH_SIZE or (ready_tasks and waited >= DAEMON_FLUSH_SECONDS):
+                await flush()
+
+            finished = [b for b, task in watching.items() if task.done()]
+            for batch_id in finished:
+                del watching[batch_id]
+            if time.monotonic() >= next_refresh_at:
+                next_refresh_at = time.monotonic() + ANALYTICS_REFRESH_SECONDS
+                await asyncio.to_thread(refresh_analytics_views)
+        except Exception as e:
+            print(f"⚠️ Daemon Error: {e}")
+
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=DAEMON_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+    # Graceful shutdown: สกัดไฟล์ที่ค้างให้เสร็จ แล้วส่ง micro-batch สุดท้าย
+    print("\n🛑 กำลังหยุด Daemon... รอไฟล์ที่กำลังสกัดให้เสร็จ")
+    if extracting:
+        await asyncio.gather(*extracting, return_exceptions=True)
+    if ready_tasks:
+        try:
+            await flush()
+        except Exception as e:
+            # ไฟล์ยังอยู่ในสถานะ extracted จะถูกสกัดและส่งใหม่เมื่อเริ่ม Daemon รอบหน้า
+            print(f"⚠️ ส่ง micro-batch สุดท้ายไม่สำเร็จ ({len(ready_tasks)} requests จะถูกส่งเมื่อเริ่มใหม่): {e}")
+    await stop_watching(watching.values())
+    metrics.report_slowest()
+    metrics.report_stages()
+    print("✅ Daemon หยุดเรียบร้อย")
+
+# ================= WORK QUEUE MODE =================
+
+async def run_worker():
+    """Worker: จองไฟล์จากคิวใน Postgres ทีละ WORK_CLAIM_SIZE ไฟล์ สกัด Section 3 แล้วเก็บ request ไว้ให้ coordinator
+    รันได้หลาย process / หลายเครื่องพร้อมกัน (ต้องเห็น INPUT_FOLDER ที่ path เดียวกัน) หยุดด้วย Ctrl+C หรือ SIGTERM"""
+    print("\n" + "="*40)
+    print(f"   🐝 STARTING WORKER ({WORKER_ID})")
+    print("="*40)
+    await asyncio.to_thread(init_db)
+
+    stop = asyncio.Event()
+    install_stop_signals(stop)
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(WORK_HEARTBEAT_SECONDS)
+            try:
+                await arenew_leases(WORKER_ID)
+            except Exception as e:
+                print(f"⚠️ Heartbeat Error: {e}")
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    sem = asyncio.Semaphore(CONCURRENT_LIMIT)
+    done_count = failed_count = 0
+    start = time.perf_counter()
+    try:
+        while not stop.is_set():
+            try:
+                filenames = await aclaim_work_items(WORKER_ID)
+                if filenames:
+                    file_stats = {}
+                    if EXTRACT_MODE == "process":
+                        results = await process_files_in_pool(filenames, set(), file_stats)
+                    else:
+                        results = await asyncio.gather(
+                            *(process_single_file(sem, f, set(), file_stats) for f in filenames)
+                        )
+                    done, failed = await acomplete_work_items(WORKER_ID, list(zip(filenames, results)), file_stats)
+                    done_count += done
+                    failed_count += failed
+                    rate = (done_count + failed_count) / (time.perf_counter() - start)
+                    print(f"   🐝 สกัดแล้ว {done_count} ไฟล์ / ล้มเหลว {failed_count} ไฟล์ ({rate:.1f} ไฟล์/วินาที)")
+                    continue
+            except Exception as e:
+                print(f"⚠️ Worker Error: {e}")
+
+            # คิวว่าง (หรือ error) -> รอแล้วลองใหม่
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=DAEMON_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        heartbeat_task.cancel()
+        await arelease_work_items(WORKER_ID)
+    metrics.report_stages()
+    print(f"✅ Worker หยุดเรียบร้อย (สกัด {done_count} ไฟล์ / ล้มเหลว {failed_count} ไฟล์)")
+
+async def run_coordinator():
+    """Coordinator: เพิ่มไฟล์ใหม่จาก INPUT_FOLDER เข้าคิว, รวม request ที่ worker สกัดเสร็จเป็น Batch
+    (ครบ DAEMON_BATCH_SIZE ไฟล์ / รอครบ DAEMON_FLUSH_SECONDS / คิวหมดแล้ว) และติดตาม/บันทึกผล Batch
+    ควรรันเพียง 1 ตัวต่อฐานข้อมูล หยุดด้วย Ctrl+C หรือ SIGTERM"""
+    print("\n" + "="*40)
+    print("   🧭 STARTING COORDINATOR")
+    print("="*40)
+
+    if not os.path.exists(INPUT_FOLDER):
+        print(f"❌ ไม่พบโฟลเดอร์ {INPUT_FOLDER}")
+        return
+    await asyncio.to_thread(init_db)
+
+    stop = asyncio.Event()
+    install_stop_signals(stop)
+
+    watcher = FolderWatcher(INPUT_FOLDER)
+    watching = {}  # batch_id -> asyncio task ที่ติดตาม Batch
+    next_refresh_at = 0  # เวลา (monotonic) ที่จะตรวจว่าต้อง refresh สถิติไหม
+
+    def start_watching(batch_ids):
+        for batch_id in batch_ids:
+            if batch_id not in watching:
+                watching[batch_id] = asyncio.create_task(watch_batch(batch_id, time.time()))
+
+    start_watching(get_pending_shard_ids())
+    print(f"👀 เฝ้าโฟลเดอร์ {INPUT_FOLDER} (ส่งเมื่อครบ {DAEMON_BATCH_SIZE} ไฟล์ หรือ {DAEMON_FLUSH_SECONDS} วินาที)")
+
+    while not stop.is_set():
+        try:
+            changed = await asyncio.to_thread(watcher.poll)
+            if changed:
+                candidates = {os.path.splitext(name)[0]: mtime for name, mtime in changed}
+                new_ids = await afilter_new_project_ids(candidates)
+                new_files = [name for name, _ in changed if os.path.splitext(name)[0] in new_ids]
+                queued = await aenqueue_files(new_files)
+                if queued:
+                    print(f"📥 เพิ่มไฟล์เข้าคิว {queued} ไฟล์")
+
+            ready, oldest, queued = await aget_extracted_backlog()
+            if ready and (ready >= DAEMON_BATCH_SIZE or oldest >= DAEMON_FLUSH_SECONDS or not queued):
+                tasks, section_files = await aload_extracted_requests()
+                workers = await aget_active_workers()
+                print(f"📦 รวม {ready} ไฟล์ที่สกัดเสร็จ (คิวเหลือ {queued} ไฟล์, worker ที่ทำงานอยู่ {len(workers)} ตัว)")
+                start_watching(await dispatch_tasks(tasks, section_files))
+
+            finished = [b for b, task in watching.items() if task.done()]
+            for batch_id in finished:
+                del watching[batch_id]
+            if time.monotonic() >= next_refresh_at:
+                next_refresh_at = time.monotonic() + ANALYTICS_REFRESH_SECONDS
+                await asyncio.to_thread(refresh_analytics_views)
         except Exception as e:
-            print(f"⚠️ Error checking status: {e}")
-            await asyncio.sleep(60) # ถ้า Error ให้รอ 1 นาทีแล้วลองใหม่
+            print(f"⚠️ Coordinator Error: {e}")
+
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=DAEMON_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+    await stop_watching(watching.values())
+    metrics.report_stages()
+    print("✅ Coordinator หยุดเรียบร้อย")
+
+# ================= TEXT BACKEND COMPARISON =================
+
+def compare_text_backends(folder=INPUT_FOLDER, backends=tuple(PAGE_TEXT_BACKENDS)):
+    """สกัดทุกไฟล์ในโฟลเดอร์ด้วยทุก backend (ไม่ใช้ fallback และ cache) แล้วเทียบความเร็ว,
+    อัตราที่หา Section เจอ, ภาษาไทยเพี้ยน และความตรงกับผลของ pdfplumber"""
+    pdf_files = sorted(f for f in os.listdir(folder) if f.lower().endswith(".pdf"))
+    if not pdf_files:
+        print("❌ ไม่พบไฟล์ PDF")
+        return None
+
+    print(f"🔬 เทียบ Text Backend {', '.join(backends)} กับ {len(pdf_files)} ไฟล์...")
+    summary = {backend: {"seconds": 0.0, "pages": 0, "matched": 0, "broken": 0, "agree": 0} for backend in backends}
+    disagreements = []
+    for filename in pdf_files:
+        path = os.path.join(folder, filename)
+        texts = {}
+        for backend in backends:
+            stats = {}
+            start = time.perf_counter()
+            text = extract_evidence_section(path, stats=stats, backend=backend, fallback=False)
+            row = summary[backend]
+            row["seconds"] += time.perf_counter() - start
+            row["pages"] += stats.get("pages_parsed", 0)
+            row["matched"] += bool(text)
+            row["broken"] += bool(text) and looks_broken_thai(text)
+            texts[backend] = re.sub(r"\s+", "", text or "")
+
+        reference = texts.get("pdfplumber")
+        for backend in backends:
+            if reference is None or texts[backend] == reference:
+                summary[backend]["agree"] += 1
+        if reference is not None and any(texts[backend] != reference for backend in backends):
+            disagreements.append(filename)
+
+    print(f"\n{'backend':<12} {'files/s':>9} {'pages':>7} {'พบ Section':>11} {'ไทยเพี้ยน':>10} {'ตรงกับ pdfplumber':>18}")
+    for backend, row in summary.items():
+        rate = len(pdf_files) / row["seconds"] if row["seconds"] else 0
+        print(
+            f"{backend:<12} {rate:>9.2f} {row['pages']:>7} "
+            f"{row['matched'] / len(pdf_files):>11.1%} {row['broken']:>10} {row['agree'] / len(pdf_files):>18.1%}"
+        )
+    if disagreements:
+        print(f"\n⚠️  ผลไม่ตรงกับ pdfplumber {len(disagreements)} ไฟล์: {', '.join(disagreements[:20])}")
+    metrics.event("compare_text_backends", files=len(pdf_files), summary=summary, disagreements=disagreements)
+    return summary
+
+# ================= OPTION 4: PIPELINE STATUS =================
+
+async def print_pipeline_status():
+    await asyncio.to_thread(init_db)
+    counts, stuck = await aget_pipeline_status()
+    print("\n--- 📊 สถานะไฟล์ทั้งหมด ---")
+    for status, count in counts:
+        print(f"   {status:<12} {count}")
+
+    workers = await aget_active_workers()
+    if workers:
+        print("\n--- 🐝 Worker ที่ถือ lease อยู่ ---")
+        for worker, count in workers:
+            print(f"   {worker:<32} {count} ไฟล์")
+
+    if stuck:
+        print(f"\n--- ⚠️  ไฟล์ที่ล้มเหลวหรือค้าง (ไม่ขยับเกิน {STUCK_AFTER_HOURS} ชม.) {len(stuck)} ไฟล์ ---")
+        for filename, status, batch_id, reason, updated_at in stuck[:50]:
+            print(f"   {filename} [{status}] batch={batch_id or '-'} reason={reason or '-'} ({updated_at})")
+        if len(stuck) > 50:
+            print(f"   ... และอีก {len(stuck) - 50} ไฟล์")
 
 # ================= MAIN MENU =================
 
-def main_menu():
+async def main_menu():
     print("\n=========================================")
     print("   TOR PDF EXTRACTOR (PGSQL + BATCH)   ")
     print("=========================================")
     print("1. ส่งงาน (Submit Only) - สร้าง Batch แล้วจบ")
-    print("2. รับงาน (Check & Save) - ตรวจสอบ ID ล่าสุด")
+    print("2. รับงาน (Check & Save) - ตรวจสอบทุก Batch ที่ค้างอยู่")
     print("3. ออโต้ (Auto Pilot) - ส่งงาน + รอจนเสร็จ + บันทึก")
+    print("4. สถานะไฟล์ (Pipeline Status) - ดูไฟล์ที่ค้าง/ล้มเหลว")
+    print("5. เฝ้าโฟลเดอร์ (Daemon) - สกัดและส่งไฟล์ใหม่อัตโนมัติตลอดเวลา")
     
-    choice = input("\nเลือกคำสั่ง (1/2/3): ").strip()
+    choice = input("\nเลือกคำสั่ง (1/2/3/4/5): ").strip()
     
     if choice == "1":
-        jsonl_path = asyncio.run(create_batch_file_async())
-        if jsonl_path:
-            upload_and_submit_batch(jsonl_path)
+        shard_paths = await create_batch_file_async()
+        if shard_paths:
+            await submit_batch_shards(shard_paths)
             
     elif choice == "2":
-        if os.path.exists(BATCH_ID_LOG):
-            with open(BATCH_ID_LOG, "r") as f:
-                batch_id = f.read().strip()
-            
-            # เช็คสถานะก่อน
-            try:
-                job = client.batches.retrieve(batch_id)
-                print(f"Status: {job.status}")
-                if job.status == "completed":
-                    download_and_save_results(batch_id)
-                else:
-                    print("⏳ งานยังไม่เสร็จครับ")
-            except Exception as e:
-                print(f"Error: {e}")
+        await asyncio.to_thread(init_db)
+        if load_manifest()["shards"] or await aget_inflight_batch_ids():
+            pending = await asyncio.to_thread(check_and_save_shards)
+            await asyncio.to_thread(refresh_analytics_views, 0)
+            if pending:
+                print(f"⏳ งานยังไม่เสร็จอีก {pending} shard ครับ")
+            else:
+                print("✅ ทุก shard เสร็จสิ้นแล้ว")
+            metrics.report_stages()
         else:
             print("❌ ไม่พบ Batch ID เดิม")
             
     elif choice == "3":
-        asyncio.run(run_auto_pilot())
+        await run_auto_pilot()
+
+    elif choice == "4":
+        await print_pipeline_status()
+
+    elif choice == "5":
+        await run_daemon()
         
     else:
         print("ตัวเลือกไม่ถูกต้อง")
 
 if __name__ == "__main__":
-    main_menu()
\ No newline at end of file
+    if METRICS_PORT:
+        start_metrics_server()
+    if len(sys.argv) > 1 and sys.argv[1] == "daemon":
+        run_async(run_daemon())
+    elif len(sys.argv) > 1 and sys.argv[1] == "worker":
+        run_async(run_worker())
+    elif len(sys.argv) > 1 and sys.argv[1] == "coordinator":
+        run_async(run_coordinator())
+    elif len(sys.argv) > 1 and sys.argv[1] == "backfill-requirements":
+        init_db()
+        run_async(abackfill_document_requirements())
+    elif len(sys.argv) > 1 and sys.argv[1] == "compare-text":
+        compare_text_backends(sys.argv[2] if len(sys.argv) > 2 else INPUT_FOLDER)
+    else:
+        run_async(main_menu())
\ No newline at end of file
@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def estimated_tokens(monkeypatch):
+    # นับ token แบบประมาณ (CHARS_PER_TOKEN ตัวอักษร/token) ไม่ต้องโหลดหรือดาวน์โหลด encoding ของ tiktoken
+    monkeypatch.setattr(main, "_get_encoding", lambda: None)
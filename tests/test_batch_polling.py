@@ -0,0 +1,36 @@
+from types import SimpleNamespace
+
+import main
+
+
+def job(status, total=0, completed=0, failed=0):
+    return SimpleNamespace(status=status, request_counts=SimpleNamespace(total=total, completed=completed, failed=failed))
+
+
+def test_validating_polls_at_minimum_interval_and_keeps_backoff():
+    assert main._next_poll_delay(job("validating"), 40) == (main.POLL_MIN_INTERVAL, 40)
+
+
+def test_in_progress_backs_off_up_to_interval_time():
+    delay, interval = main._next_poll_delay(job("in_progress", total=100, completed=10), main.POLL_MIN_INTERVAL)
+    assert delay == interval == main.POLL_MIN_INTERVAL * main.POLL_BACKOFF
+
+    delay, interval = main._next_poll_delay(job("in_progress", total=100, completed=10), main.INTERVAL_TIME)
+    assert delay == interval == main.INTERVAL_TIME
+
+
+def test_in_progress_near_completion_polls_at_minimum_interval():
+    nearly_done = job("in_progress", total=100, completed=90, failed=5)
+    assert main._next_poll_delay(nearly_done, main.INTERVAL_TIME) == (main.POLL_MIN_INTERVAL, main.POLL_MIN_INTERVAL)
+
+
+def test_in_progress_without_counts_backs_off():
+    no_counts = SimpleNamespace(status="in_progress", request_counts=None)
+    delay, _ = main._next_poll_delay(no_counts, main.POLL_MIN_INTERVAL)
+    assert delay == main.POLL_MIN_INTERVAL * main.POLL_BACKOFF
+
+
+def test_finalizing_polls_at_finalizing_interval_and_resets_backoff():
+    assert main._next_poll_delay(job("finalizing"), main.INTERVAL_TIME) == (
+        main.POLL_FINALIZING_INTERVAL, main.POLL_MIN_INTERVAL
+    )
@@ -0,0 +1,45 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import main
+
+
+class TerminalBackend:
+    """backend ที่ Batch "ingest" เสร็จแล้ว ส่วน Batch อื่นยังรันอยู่ตลอด"""
+
+    async def aretrieve(self, batch_id):
+        status = "completed" if batch_id == "ingest" else "in_progress"
+        return SimpleNamespace(id=batch_id, status=status, errors=None,
+                               request_counts=SimpleNamespace(total=1, completed=0, failed=0))
+
+
+def test_stop_watching_waits_for_running_ingest(monkeypatch):
+    started = threading.Event()
+    finished = []
+
+    def slow_ingest(batch_id, job):
+        started.set()
+        time.sleep(0.3)
+        finished.append(batch_id)
+        return True
+
+    manifest = []
+    monkeypatch.setattr(main, "get_backend", lambda: TerminalBackend())
+    monkeypatch.setattr(main, "download_and_save_results", slow_ingest)
+    monkeypatch.setattr(main, "update_manifest_shard", lambda batch_id, **fields: manifest.append((batch_id, fields)))
+    monkeypatch.setattr(main, "get_retry_shard_ids", lambda batch_id: [])
+
+    async def scenario():
+        ingesting = asyncio.create_task(main.watch_batch("ingest", time.time()))
+        polling = asyncio.create_task(main.watch_batch("polling", time.time()))
+        await asyncio.to_thread(started.wait, 5)
+        await main.stop_watching([ingesting, polling])
+        return ingesting, polling
+
+    ingesting, polling = asyncio.run(scenario())
+    assert finished == ["ingest"]
+    assert ("ingest", {"saved": True}) in manifest
+    assert polling.cancelled()
+    assert main._ingesting == {}
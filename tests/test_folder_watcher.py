@@ -0,0 +1,76 @@
+import os
+
+import main
+
+
+def write(path, data, mtime_ns):
+    with open(path, "ab") as f:
+        f.write(data)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def names(ready):
+    return [name for name, _ in ready]
+
+
+def test_new_file_is_reported_once_stable(tmp_path):
+    watcher = main.FolderWatcher(str(tmp_path))
+    write(tmp_path / "a.pdf", b"%PDF", 1_000_000_000)
+    (tmp_path / "notes.txt").write_text("ไม่ใช่ PDF")
+
+    assert watcher.poll() == []  # เห็นครั้งแรก ยังไม่รู้ว่าเขียนเสร็จหรือไม่
+    ready = watcher.poll()
+    assert names(ready) == ["a.pdf"]
+    assert ready[0][1].timestamp() == 1.0
+    assert watcher.poll() == []
+
+
+def test_file_still_being_written_waits_until_size_stops_changing(tmp_path):
+    watcher = main.FolderWatcher(str(tmp_path))
+    path = tmp_path / "big.pdf"
+    write(path, b"%PDF", 1_000_000_000)
+    assert watcher.poll() == []
+
+    write(path, b"more", 2_000_000_000)  # ยังคัดลอกไม่เสร็จ
+    assert watcher.poll() == []
+    assert names(watcher.poll()) == ["big.pdf"]
+
+
+def test_modified_file_is_reported_again_on_full_rescan(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DAEMON_RESCAN_EVERY", 1)
+    watcher = main.FolderWatcher(str(tmp_path))
+    path = tmp_path / "a.pdf"
+    write(path, b"%PDF", 1_000_000_000)
+    watcher.poll()
+    assert names(watcher.poll()) == ["a.pdf"]
+
+    write(path, b"v2", 3_000_000_000)  # เขียนทับโดยไม่เปลี่ยนชื่อ
+    assert watcher.poll() == []
+    assert names(watcher.poll()) == ["a.pdf"]
+
+
+def test_removed_file_is_forgotten(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DAEMON_RESCAN_EVERY", 1)
+    watcher = main.FolderWatcher(str(tmp_path))
+    write(tmp_path / "a.pdf", b"%PDF", 1_000_000_000)
+    write(tmp_path / "b.pdf", b"%PDF", 1_000_000_000)
+    watcher.poll()
+    assert sorted(names(watcher.poll())) == ["a.pdf", "b.pdf"]
+
+    os.remove(tmp_path / "a.pdf")
+    assert watcher.poll() == []
+    assert set(watcher.known) == {"b.pdf"}
+
+    # ไฟล์ชื่อเดิมที่วางกลับมาถือเป็นไฟล์ใหม่
+    write(tmp_path / "a.pdf", b"%PDF", 1_000_000_000)
+    watcher.poll()
+    assert names(watcher.poll()) == ["a.pdf"]
+
+
+def test_unstable_file_removed_before_it_settles_is_dropped(tmp_path):
+    watcher = main.FolderWatcher(str(tmp_path))
+    write(tmp_path / "a.pdf", b"%PDF", 1_000_000_000)
+    watcher.poll()
+    os.remove(tmp_path / "a.pdf")
+    assert watcher.poll() == []
+    assert watcher.unstable == {}
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import main
+
+
+def task(custom_id, text="ข้อความ"):
+    return main.build_batch_request(custom_id, text)
+
+
+def test_route_tasks_by_priority_and_length(monkeypatch):
+    monkeypatch.setattr(main, "load_priority_ids", lambda: {"urgent"})
+    monkeypatch.setattr(main, "REALTIME_MAX_CHARS", 10)
+    tasks = [task("urgent.pdf", "ก" * 50), task("short.pdf", "สั้น"), task("long.pdf", "ก" * 50)]
+    realtime, batch = main.route_tasks(tasks)
+    assert [t["custom_id"] for t in realtime] == ["urgent.pdf", "short.pdf"]
+    assert [t["custom_id"] for t in batch] == ["long.pdf"]
+
+
+def test_route_tasks_keeps_split_parts_together(monkeypatch):
+    monkeypatch.setattr(main, "load_priority_ids", lambda: set())
+    monkeypatch.setattr(main, "REALTIME_MAX_CHARS", 10)
+    # แต่ละส่วนสั้นกว่า 10 ตัวอักษร แต่รวมกันยาวกว่า จึงต้องไป Batch ทั้งชุด
+    parts = [task(main.make_custom_id("a.pdf", i, 2), "ก" * 6) for i in (1, 2)]
+    realtime, batch = main.route_tasks(parts)
+    assert realtime == []
+    assert len(batch) == 2
+
+
+def test_route_tasks_shared_section_is_urgent_if_any_file_is(monkeypatch):
+    monkeypatch.setattr(main, "load_priority_ids", lambda: {"b"})
+    monkeypatch.setattr(main, "REALTIME_MAX_CHARS", 0)
+    shared = task(main.section_request_id("abc"), "ก" * 50)
+    realtime, batch = main.route_tasks([shared], {"abc": ["a.pdf", "b.pdf"]})
+    assert realtime == [shared]
+    assert batch == []
+
+
+def test_token_bucket_allows_burst_then_waits_for_refill():
+    async def scenario():
+        bucket = main.TokenBucket(600)  # 10 ต่อวินาที
+        start = time.monotonic()
+        await bucket.acquire(600)
+        burst = time.monotonic() - start
+        await bucket.acquire(1)
+        return burst, time.monotonic() - start
+
+    burst, total = asyncio.run(scenario())
+    assert burst < 0.05
+    assert total >= 0.08
+
+
+def test_token_bucket_caps_request_at_capacity():
+    async def scenario():
+        bucket = main.TokenBucket(60)
+        await asyncio.wait_for(bucket.acquire(10_000), timeout=1)
+
+    asyncio.run(scenario())
+
+
+class ScriptedBackend:
+    """backend ที่ตอบตามลำดับใน script: Exception จะถูก raise, ค่าอื่นคืนเป็นข้อความคำตอบ (หมด script แล้วได้ 429 ตลอด)"""
+
+    fallback = main.LLMRateLimitError("rate limited")
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.calls = 0
+
+    async def complete(self, body):
+        self.calls += 1
+        step = self.script.pop(0) if self.script else self.fallback
+        if isinstance(step, Exception):
+            raise step
+        return step
+
+
+@pytest.fixture
+def realtime_env(monkeypatch):
+    saved, states = [], []
+
+    async def save(rows):
+        saved.extend(rows)
+        return len(rows)
+
+    async def update_states(rows, status, batch_id=None):
+        states.append((status, rows))
+
+    monkeypatch.setattr(main, "asave_results_to_db", save)
+    monkeypatch.setattr(main, "aupdate_request_states", update_states)
+    monkeypatch.setattr(main, "_retry_delay", lambda error, attempt: 0)
+    monkeypatch.setattr(main, "REALTIME_MAX_RETRIES", 1)
+    monkeypatch.setattr(main, "LLM_MAX_ATTEMPTS", 3)
+    return saved, states
+
+
+def use_backend(monkeypatch, backend):
+    monkeypatch.setattr(main, "get_backend", lambda: backend)
+
+
+def test_rate_limits_do_not_use_up_invalid_output_retries(monkeypatch, realtime_env):
+    saved, states = realtime_env
+    valid = json.dumps(main.fake_extraction_result("(๑) เอกสาร"), ensure_ascii=False)
+    use_backend(monkeypatch, ScriptedBackend(["{", main.LLMRateLimitError("429"), "{", valid]))
+    deferred = asyncio.run(main.run_realtime([task("a.pdf")]))
+    assert deferred == []
+    assert [row["id"] for row in saved] == ["a"]
+    assert states == []
+
+
+def test_exhausted_rate_limit_goes_to_batch_instead_of_failing(monkeypatch, realtime_env):
+    saved, states = realtime_env
+    use_backend(monkeypatch, ScriptedBackend([]))
+    parts = [task(main.make_custom_id("a.pdf", i, 2)) for i in (1, 2)]
+    deferred = asyncio.run(main.run_realtime(parts + [task("b.pdf")]))
+    assert deferred == parts + [task("b.pdf")]
+    assert saved == []
+    assert states == []
+
+
+def test_invalid_output_fails_after_llm_max_attempts(monkeypatch, realtime_env):
+    saved, states = realtime_env
+    backend = ScriptedBackend(["{", "{", "{"])
+    use_backend(monkeypatch, backend)
+    deferred = asyncio.run(main.run_realtime([task("a.pdf")]))
+    assert deferred == []
+    assert backend.calls == 3
+    assert [(status, [request_id for request_id, _ in rows]) for status, rows in states] == [("failed", ["a.pdf"])]
+
+
+def test_null_content_counts_as_invalid_json(monkeypatch, realtime_env):
+    saved, states = realtime_env
+    backend = ScriptedBackend([None, None, None])
+    use_backend(monkeypatch, backend)
+    deferred = asyncio.run(main.run_realtime([task("a.pdf")]))
+    assert deferred == []
+    assert backend.calls == 3
+    [(status, [(request_id, reason)])] = states
+    assert (status, request_id) == ("failed", "a.pdf")
+    assert reason.startswith("invalid_json: ")
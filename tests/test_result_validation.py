@@ -0,0 +1,158 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+import main
+
+
+def valid_result():
+    return main.fake_extraction_result("1. สำเนาหนังสือรับรองการจดทะเบียนนิติบุคคล\n2. บัญชีเอกสารส่วนที่ 2")
+
+
+def test_fake_result_matches_schema():
+    assert main.validate_result(valid_result()) is None
+
+
+@pytest.mark.parametrize("mutate, error", [
+    (lambda d: d["bid_submission_documents_part_1"].pop("5_general_documents"),
+     "$.bid_submission_documents_part_1: missing key '5_general_documents'"),
+    (lambda d: d.update(extra="x"), "$: unexpected key 'extra'"),
+    (lambda d: d.update(bid_submission_documents_part_1=None), "$.bid_submission_documents_part_1: expected object"),
+    (lambda d: d["bid_submission_documents_part_1"]["2_individual_documents"].update(required_documents=None),
+     "$.bid_submission_documents_part_1.2_individual_documents.required_documents: expected array"),
+    (lambda d: d["bid_submission_documents_part_1"]["5_general_documents"].update(required_documents=[{"name": "?"}]),
+     "$.bid_submission_documents_part_1.5_general_documents.required_documents[]: expected string"),
+])
+def test_validate_result_reports_first_error_path(mutate, error):
+    data = valid_result()
+    mutate(data)
+    assert main.validate_result(data) == error
+
+
+def test_string_leaves_may_be_null():
+    data = valid_result()
+    data["bid_submission_documents_part_1"]["4_financial_capability_evidence"]["note"] = None
+    assert main.validate_result(data) is None
+
+
+def test_compile_validator_treats_empty_example_list_as_strings():
+    check = main.compile_validator({"items": [], "nested": {"value": ""}})
+    assert check({"items": ["a", None], "nested": {"value": None}}) is None
+    assert check({"items": [1], "nested": {"value": ""}}) == "$.items[]: expected string"
+    assert check({"items": [], "nested": {}}) == "$.nested: missing key 'value'"
+    assert check([]) == "$: expected object"
+
+
+def test_strict_retry_body_appends_suffix_once():
+    body = main.build_batch_request("a.pdf", "ข้อความ")["body"]
+    retry = main.strict_retry_body(main.strict_retry_body(body))
+    assert retry["messages"][0]["content"] == main.SYSTEM_PROMPT + main.RETRY_PROMPT_SUFFIX
+    assert retry["temperature"] == 0
+    assert body["messages"][0]["content"] == main.SYSTEM_PROMPT
+
+
+# ===== batch -> validate -> retry -> fail กับ FakeBatchBackend =====
+
+@pytest.fixture
+def fake_batch(tmp_path, monkeypatch):
+    """FakeBatchBackend ที่ Batch เสร็จทันที และแทนที่การเขียน DB ด้วยการบันทึกไว้ในหน่วยความจำ"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "FAKE_BATCH_SECONDS", 0)
+    monkeypatch.setattr(main, "LLM_MAX_ATTEMPTS", 3)
+    backend = main.FakeBatchBackend(str(tmp_path / "fake"))
+    monkeypatch.setattr(main, "_backend", backend)
+
+    db = {"saved": [], "states": []}
+    monkeypatch.setattr(main, "save_results_to_db", lambda rows: db["saved"].extend(rows) or len(rows))
+    monkeypatch.setattr(main, "update_request_states",
+                        lambda rows, state, batch_id=None: db["states"].append((state, batch_id, list(rows))))
+    monkeypatch.setattr(main, "fail_unsaved_batch_files", lambda batch_id, reason: 0)
+    monkeypatch.setattr(main, "get_inflight_batch_ids", lambda: [])
+
+    with open(main.BATCH_FILE_NAME, "w", encoding="utf-8") as f:
+        for name in ("a.pdf", "b.pdf"):
+            f.write(json.dumps(main.build_batch_request(name, f"เอกสาร {name}"), ensure_ascii=False) + "\n")
+    db["batch_id"] = asyncio.run(main.submit_batch_shards([main.BATCH_FILE_NAME]))[0]
+    return backend, db
+
+
+def run_until_done(limit=10):
+    for _ in range(limit):
+        if not main.check_and_save_shards():
+            return
+    raise AssertionError("shard ยังไม่เสร็จ")
+
+
+def retry_inputs(backend, batch_id):
+    return [json.loads(line) for line in backend.iter_file_lines(f"{batch_id}:input")]
+
+
+def test_invalid_output_is_retried_with_strict_prompt(fake_batch, monkeypatch):
+    backend, db = fake_batch
+    monkeypatch.setattr(main, "FAKE_INVALID_OUTPUT_RATE", 1)
+    assert main.check_and_save_shards() == 1  # มี retry batch รออยู่
+
+    [retry_id] = main.get_retry_shard_ids(db["batch_id"])
+    requests = retry_inputs(backend, retry_id)
+    assert sorted(r["custom_id"] for r in requests) == ["a.pdf", "b.pdf"]
+    assert all(r["body"]["messages"][0]["content"].endswith(main.RETRY_PROMPT_SUFFIX) for r in requests)
+
+    monkeypatch.setattr(main, "FAKE_INVALID_OUTPUT_RATE", 0)
+    run_until_done()
+    assert sorted(row["id"] for row in db["saved"]) == ["a", "b"]
+    assert not [s for s in db["states"] if s[0] == "failed"]
+
+
+def test_invalid_output_fails_after_max_attempts(fake_batch, monkeypatch):
+    backend, db = fake_batch
+    monkeypatch.setattr(main, "FAKE_INVALID_OUTPUT_RATE", 1)
+    run_until_done()
+
+    shards = main.load_manifest()["shards"]
+    assert sorted(shard.get("attempt", 1) for shard in shards) == [1, 2, 3]
+    assert db["saved"] == []
+
+    [(state, batch_id, rows)] = [s for s in db["states"] if s[0] == "failed"]
+    assert batch_id == next(shard["batch_id"] for shard in shards if shard.get("attempt") == 3)
+    assert sorted(request_id for request_id, _ in rows) == ["a.pdf", "b.pdf"]
+    assert all(reason.startswith("schema_error: ") for _, reason in rows)
+
+
+def test_concurrent_manifest_writes_keep_every_shard(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def add_shards(worker):
+        for i in range(50):
+            main.add_manifest_shard(None, f"batch_{worker}_{i}", attempt=2, retry_of="batch_0")
+
+    threads = [threading.Thread(target=add_shards, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(main.get_retry_shard_ids("batch_0")) == 200
+    assert list(tmp_path.glob("*.tmp")) == []
+
+
+def test_failed_db_write_leaves_shard_unsaved_for_next_check(fake_batch, monkeypatch):
+    backend, db = fake_batch
+
+    def broken_save(rows):
+        raise RuntimeError("pool timeout")
+    monkeypatch.setattr(main, "save_results_to_db", broken_save)
+    failed_files = []
+    monkeypatch.setattr(main, "fail_unsaved_batch_files", lambda batch_id, reason: failed_files.append(batch_id) or 0)
+
+    assert main.check_and_save_shards() == 1
+    [shard] = main.load_manifest()["shards"]
+    assert shard["saved"] is False
+    assert main.get_retry_shard_ids(db["batch_id"]) == []
+    assert failed_files == [] and db["states"] == [("submitted", db["batch_id"], [("a.pdf", None), ("b.pdf", None)])]
+
+    # DB กลับมาใช้ได้: อ่าน output file เดิมซ้ำและบันทึกครบ
+    monkeypatch.setattr(main, "save_results_to_db", lambda rows: db["saved"].extend(rows) or len(rows))
+    run_until_done()
+    assert sorted(row["id"] for row in db["saved"]) == ["a", "b"]
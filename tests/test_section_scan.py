@@ -0,0 +1,74 @@
+import main
+
+HEADER = "๓. หลักฐานการยื่นข้อเสนอ"
+
+
+def pages_reader(pages, pulled):
+    """generator ของข้อความทีละหน้าที่จดจำนวนหน้าที่ถูกอ่านจริงไว้ใน pulled"""
+    for text in pages:
+        pulled.append(text)
+        yield text
+
+
+def test_section_on_one_page_stops_at_end_marker():
+    pages = [
+        "ส่วนนำ",
+        f"{HEADER}\n(๑) สำเนาหนังสือรับรอง\n(๒) บัญชีรายชื่อ\n๓.๒ เอกสารส่วนที่ ๒",
+        "หน้าที่ไม่ควรถูกอ่าน",
+    ]
+    pulled, stats = [], {}
+    result = main.scan_evidence_section(pages_reader(pages, pulled), stats)
+    assert result == "(๑) สำเนาหนังสือรับรอง (๒) บัญชีรายชื่อ"
+    assert len(pulled) == 2
+    assert stats["pages_parsed"] == 2
+
+
+def test_section_content_spans_pages():
+    pages = [
+        f"{HEADER}\n(๑) สำเนาหนังสือรับรอง",
+        "(๒) หนังสือมอบอำนาจ",
+        "(๓) บัญชีเอกสาร\nส่วนที่ ๒ ข้อเสนอด้านเทคนิค",
+        "ท้ายเอกสาร",
+    ]
+    pulled = []
+    result = main.scan_evidence_section(pages_reader(pages, pulled))
+    assert result == "(๑) สำเนาหนังสือรับรอง (๒) หนังสือมอบอำนาจ (๓) บัญชีเอกสาร"
+    assert len(pulled) == 3
+
+
+def test_header_split_across_pages():
+    pages = ["ข้อความก่อนหน้า ๓.", "หลักฐานการยื่นข้อเสนอ\n(๑) สำเนาบัตรประจำตัวประชาชน\n3.2 อื่นๆ"]
+    assert main.scan_evidence_section(iter(pages)) == "(๑) สำเนาบัตรประจำตัวประชาชน"
+
+
+def test_end_marker_split_at_page_boundary():
+    pages = [f"{HEADER}\n(๑) สำเนาหนังสือรับรอง\n", "ส่วนที่ ๒\nข้อเสนอด้านเทคนิค"]
+    assert main.scan_evidence_section(iter(pages)) == "(๑) สำเนาหนังสือรับรอง"
+
+
+def test_missing_header_or_end_marker_returns_none():
+    assert main.scan_evidence_section(iter(["ไม่มีหัวข้อ", "๓.๒ หัวข้อถัดไป"])) is None
+    assert main.scan_evidence_section(iter([f"{HEADER}\n(๑) เอกสาร", "ไม่มีหัวข้อถัดไป"])) is None
+
+
+def fake_page_texts(pages):
+    def iter_page_texts(pdf_path, page_range=None, stats=None, backend="pdfplumber"):
+        first, last = page_range or (1, len(pages))
+        return iter(pages[first - 1:last])
+    return iter_page_texts
+
+
+def test_page_hint_is_scanned_first(monkeypatch):
+    pages = [f"{HEADER}\n(๑) เอกสาร\n๓.๒ ถัดไป", "หน้า 2", "หน้า 3", "หน้า 4"]
+    monkeypatch.setattr(main, "_iter_page_texts", fake_page_texts(pages))
+    stats = {}
+    assert main._scan_pdf("x.pdf", (1, 2), stats, "pdfplumber") == "(๑) เอกสาร"
+    assert stats["pages_parsed"] == 1
+
+
+def test_page_hint_falls_back_to_whole_file(monkeypatch):
+    pages = ["หน้า 1", "หน้า 2", f"{HEADER}\n(๑) เอกสาร", "ส่วนที่ ๒"]
+    monkeypatch.setattr(main, "_iter_page_texts", fake_page_texts(pages))
+    stats = {}
+    assert main._scan_pdf("x.pdf", (1, 2), stats, "pdfplumber") == "(๑) เอกสาร"
+    assert stats["pages_parsed"] == 2 + 4
@@ -0,0 +1,27 @@
+import main
+
+
+def test_clean_thai_text_is_not_broken():
+    text = "ผู้ยื่นข้อเสนอจะต้องเสนอเอกสารหลักฐานยื่นมาพร้อมกับการเสนอราคาทางระบบจัดซื้อจัดจ้าง " * 5
+    assert not main.looks_broken_thai(text)
+
+
+def test_text_without_thai_is_not_broken():
+    assert not main.looks_broken_thai("Section 3 Evidence 123")
+    assert not main.looks_broken_thai("")
+
+
+def test_floating_vowels_and_tone_marks_are_broken():
+    # สระบน/วรรณยุกต์แยกออกจากพยัญชนะ และสระหน้าถูกย้ายไปไว้หลังพยัญชนะ
+    text = "ผ ู ้ย ื ่นข ้อเสนอ กเ ขแ ้ " * 3
+    assert main.looks_broken_thai(text)
+
+
+def test_legacy_font_glyphs_are_broken():
+    # glyph ตำแหน่งพิเศษ (U+F700-F71F) ที่ฟอนต์ไทยรุ่นเก่าใช้แทนสระ/วรรณยุกต์ และอักขระที่แปลงไม่ได้
+    assert main.looks_broken_thai("เอกสาร\uf70a\uf70b\uf70cหลักฐาน\ufffd")
+
+
+def test_few_glitches_in_long_text_are_tolerated():
+    text = "เอกสารหลักฐานการเสนอราคา" * 100 + " ่ ้"
+    assert not main.looks_broken_thai(text)
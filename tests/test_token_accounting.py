@@ -0,0 +1,77 @@
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def small_sections(monkeypatch):
+    # token นับแบบประมาณ (ดู estimated_tokens ใน conftest.py) ข้อความ 10 ตัวอักษร = 5 tokens
+    monkeypatch.setattr(main, "MAX_SECTION_TOKENS", 5)
+
+
+def section_of(request):
+    return request["body"]["messages"][-1]["content"][len(main.USER_MESSAGE_PREFIX):]
+
+
+def test_custom_id_round_trip():
+    assert main.parse_custom_id(main.make_custom_id("sec:abc", 2, 3)) == ("sec:abc", 2, 3)
+    assert main.make_custom_id("a.pdf") == "a.pdf"
+    assert main.parse_custom_id("a.pdf") == ("a.pdf", 1, 1)
+
+
+def test_parse_custom_id_keeps_hash_sign_in_filename():
+    assert main.parse_custom_id("งาน#1.pdf#p1of2") == ("งาน#1.pdf", 1, 2)
+    assert main.parse_custom_id("งาน#1.pdf") == ("งาน#1.pdf", 1, 1)
+
+
+def test_merge_values_prefers_first_non_empty_and_unions_lists():
+    a = {"name": "", "items": ["x"], "nested": {"k": None, "v": "1"}}
+    b = {"name": "B", "items": ["x", "y"], "nested": {"k": "2", "v": "3"}, "extra": "e"}
+    assert main._merge_values(a, b) == {
+        "name": "B", "items": ["x", "y"], "nested": {"k": "2", "v": "1"}, "extra": "e"
+    }
+
+
+def test_collect_part_result_waits_for_all_parts_in_order():
+    partials = {}
+    single = {"id": "one", "data": {"a": 1}, "part": 1, "parts": 1}
+    assert main.collect_part_result(partials, single) is single
+
+    # ส่วนที่ 2 มาก่อน ค่าที่ไม่ว่างของส่วนที่ 1 ต้องชนะ
+    assert main.collect_part_result(partials, {"id": "s", "data": {"a": "", "b": ["y"]}, "part": 2, "parts": 2}) is None
+    merged = main.collect_part_result(partials, {"id": "s", "data": {"a": "A", "b": ["x"]}, "part": 1, "parts": 2})
+    assert merged == {"id": "s", "data": {"a": "A", "b": ["x", "y"]}, "part": 1, "parts": 1}
+    assert partials == {}
+
+
+def test_split_by_tokens_without_encoding_uses_char_estimate():
+    size = 3 * main.CHARS_PER_TOKEN
+    text = "ก" * (size * 2 + 1)
+    parts = main.split_by_tokens(text, 3)
+    assert [len(p) for p in parts] == [size, size, 1]
+    assert "".join(parts) == text
+
+
+def test_prepare_requests_within_limit_is_single_request(monkeypatch):
+    monkeypatch.setattr(main, "OVERSIZE_POLICY", "skip")
+    requests = main.prepare_requests("a.pdf", "ก" * 10)
+    assert [r["custom_id"] for r in requests] == ["a.pdf"]
+
+
+def test_prepare_requests_truncate_keeps_first_part(monkeypatch):
+    monkeypatch.setattr(main, "OVERSIZE_POLICY", "truncate")
+    requests = main.prepare_requests("a.pdf", "ก" * 10 + "ข" * 10)
+    assert [r["custom_id"] for r in requests] == ["a.pdf"]
+    assert section_of(requests[0]) == "ก" * 10
+
+
+def test_prepare_requests_split_numbers_every_part(monkeypatch):
+    monkeypatch.setattr(main, "OVERSIZE_POLICY", "split")
+    requests = main.prepare_requests("sec:abc", "ก" * 10 + "ข" * 10 + "ค")
+    assert [r["custom_id"] for r in requests] == ["sec:abc#p1of3", "sec:abc#p2of3", "sec:abc#p3of3"]
+    assert [section_of(r) for r in requests] == ["ก" * 10, "ข" * 10, "ค"]
+
+
+def test_prepare_requests_skip_marks_oversized(monkeypatch):
+    monkeypatch.setattr(main, "OVERSIZE_POLICY", "skip")
+    assert main.prepare_requests("a.pdf", "ก" * 11) == "OVERSIZED"